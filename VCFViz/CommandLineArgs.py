@@ -5,7 +5,7 @@ the right args to the right function.
 2022-05-29: Matthew Wells
 """
 import argparse
-import VCFViz.InputOptions as InputOptions
+import importlib
 import os
 from typing import Any
 import sys
@@ -18,44 +18,141 @@ class Argparser:
     """
     args = []
 
+    # handlers are imported only for the run mode called so that heavy
+    # optional dependencies (pandas, openpyxl) do not slow down start up
     functions_call = {
-                    "input-file": InputOptions.process_submission_sheet, 
-                    "directory-glob": InputOptions.glob_directories, 
-                    "wastewater-run": InputOptions.wastewater_run,
-                    "summarize-excel": InputOptions.create_summary_excel_report
+                    "input-file": ("VCFViz.InputOptions", "process_submission_sheet"), 
+                    "directory-glob": ("VCFViz.InputOptions", "glob_directories"), 
+                    "wastewater-run": ("VCFViz.InputOptions", "wastewater_run"),
+                    "summarize-excel": ("VCFViz.InputOptions", "create_summary_excel_report"),
+                    "append": ("VCFViz.InputOptions", "append_samples"),
+                    "trend": ("VCFViz.TrendReport", "trend_report"),
+                    "render": ("VCFViz.InputOptions", "render_results"),
+                    "watch": ("VCFViz.WatchRuns", "watch_runs"),
+                    "plan": ("VCFViz.ShardRuns", "plan_shards"),
+                    "shard": ("VCFViz.ShardRuns", "run_shard"),
+                    "merge": ("VCFViz.ShardRuns", "merge_shards"),
+                    "export": ("VCFViz.ExportResults", "export_results")
                     }
+
+    def resolve_handler(self, run_mode):
+        """
+        Import the module of a run mode and return the function to call
+        """
+        module_name, function_name = self.functions_call[run_mode]
+        return getattr(importlib.import_module(module_name), function_name)
+
     def __call__(self) -> Any:
        
         parser = argparse.ArgumentParser(description="A VCFParser edit with minor changes.")
         subparsers = parser.add_subparsers(help="Pick a run mode for vcfparser.")
+        # options shared by several run modes, added to their parsers as parents
+        mnp_options = argparse.ArgumentParser(add_help=False)
+        mnp_options.add_argument("--mnp-cv-threshold", help="Maximum coefficient of variation (%%) of depth and alt frequency for MNP bases to be combined, default is 2.5", default=2.5, type=float)
+        threads_options = argparse.ArgumentParser(add_help=False)
+        threads_options.add_argument("-t", "--threads", help="Number of input files to read at once, default is 8 or the number of cpus if fewer", default=min(8, os.cpu_count() or 1), type=int)
+        report_options = argparse.ArgumentParser(add_help=False)
+        report_options.add_argument("--report-style", help="classic writes a html table per lineage, data writes one compact report drawn in the browser, paginated writes a report page per --page-size samples, default is classic", default="classic", choices=["classic", "data", "paginated"])
+        report_options.add_argument("--page-size", help="Number of samples per page of a paginated report, default is 100", default=100, type=int)
+        report_options.add_argument("--page-order", help="Order samples are placed on report pages, sheet order or by the collection date column of the sample sheet, default is sheet", default="sheet", choices=["sheet", "date"])
+        database_options = argparse.ArgumentParser(add_help=False)
+        database_options.add_argument("--database", help="SQLite database the matched results of the run are added to, created if it does not exist", default=None)
+        scaling_options = argparse.ArgumentParser(add_help=False)
+        scaling_options.add_argument("--batch-size", help="Match samples this many at a time, spilling each batches results to disk so memory does not grow with the number of samples, default is 0 (all at once)", default=0, type=int)
+        scaling_options.add_argument("--pipeline", help="Read input files, find depths with samtools and match samples at the same time rather than one step after another, ignored with --batch-size", action="store_true")
+        ivar_cache_options = argparse.ArgumentParser(add_help=False)
+        ivar_cache_options.add_argument("--ivar-cache", help="Directory of a cache of parsed ivar files, unchanged files are loaded from it rather than parsed again, by default no cache is used", default=None)
+        ivar_cache_options.add_argument("--ivar-cache-size", help="Size cap of the parsed ivar cache in MB, the least recently used files are removed past it, default is 1024", default=1024, type=int)
+        verbose_options = argparse.ArgumentParser(add_help=False)
+        verbose_options.add_argument("-v", "--verbose", help="Log every variant that does not match the metadata sheet, by default only a summary is logged", action="store_true")
         #--- Submission Sheet Entry ---
-        parser_1 = subparsers.add_parser("input-file", help="Run vcfparser with an input file.")
+        parser_1 = subparsers.add_parser("input-file", help="Run vcfparser with an input file.", parents=[mnp_options, threads_options, report_options, database_options, scaling_options, ivar_cache_options, verbose_options])
         parser_1.add_argument("-s", "--sample-sheet", help="Input file of samples names and paths to use")
         parser_1.add_argument("-o", "--output-directory", help="The output directory to use, default is current directory", 
         default=os.getcwd())
         parser_1.add_argument("-c", "--coverage-threshold", help="Set the minimum depth of coverage for allele prescence, default is 0", default=0, type=int)
-        parser_1.add_argument("-m", "--metadata", help="The metadata sheet to use for subsetting VCF files.")
+        parser_1.add_argument("-m", "--metadata", help="The metadata sheets to use for subsetting VCF files, with more than one the samples are read once and a report is written per sheet to a subdirectory of the output directory named after the sheet.", nargs="+")
 
         #--- Directory Glob Entry ---
-        parser_2 = subparsers.add_parser("directory-glob", help="Run vcfparser by passing in directories with a glob pattern.")
+        parser_2 = subparsers.add_parser("directory-glob", help="Run vcfparser by passing in directories with a glob pattern.", parents=[mnp_options, threads_options, report_options, database_options, scaling_options, ivar_cache_options, verbose_options])
         parser_2.add_argument("-i", "--ivar-directory", help="The directory containing ivar outputs files.")
         parser_2.add_argument("-b", "--bam-directory", help="The directory containing the bamfiles matching the Ivar filies")
         parser_2.add_argument("-o", "--output-directory", help="The output directory to use, default is current directory", 
         default=os.getcwd())
         parser_2.add_argument("-c", "--coverage-threshold", help="Set the minimum depth of coverage for allele prescence, default is 0", default=0, type=int)
-        parser_2.add_argument("-m", "--metadata", help="The metadata sheet to use for subsetting VCF files.")
+        parser_2.add_argument("-m", "--metadata", help="The metadata sheets to use for subsetting VCF files, with more than one the samples are read once and a report is written per sheet to a subdirectory of the output directory named after the sheet.", nargs="+")
 
         #--- Wastewater Directory Run ---
-        parser_3 = subparsers.add_parser("wastewater-run", help="Run vcfparser on a reportable directory setup by the wastewater group.")
+        parser_3 = subparsers.add_parser("wastewater-run", help="Run vcfparser on a reportable directory setup by the wastewater group.", parents=[mnp_options, threads_options, report_options, database_options, scaling_options, ivar_cache_options, verbose_options])
         parser_3.add_argument("-i", "--input-directory", help="Input of wastewater data configured directory")
         parser_3.add_argument("-c", "--coverage-threshold", help="Set the minimum depth of coverage for allele prescencem default is 30", default=30, type=int)
-        parser_3.add_argument("-m", "--metadata", help="The metadata sheet to use for subsetting VCF files.")
+        parser_3.add_argument("-m", "--metadata", help="The metadata sheets to use for subsetting VCF files, with more than one the samples are read once and a report is written per sheet to a subdirectory of the output directory named after the sheet.", nargs="+")
 
         #--- Post run to optionally summarize html reports into a spreadsheet
         parser_4 = subparsers.add_parser("summarize-excel", help="Create a summary excel file of the final html data.")
         parser_4.add_argument("-d", "--directory-html", help="The directory containing the html run data.")
         parser_4.add_argument("-o", "--output-path", help="Place to output summary data as an excel file.")
 
+        #--- Append new samples to an existing report
+        parser_5 = subparsers.add_parser("append", help="Add new samples to the results saved with an existing report and render it again.", parents=[mnp_options, threads_options, report_options, database_options, ivar_cache_options, verbose_options])
+        parser_5.add_argument("-i", "--ivar-directory", help="The directory containing ivar outputs files, samples already in the report are skipped.")
+        parser_5.add_argument("-b", "--bam-directory", help="The directory containing the bamfiles matching the Ivar filies")
+        parser_5.add_argument("-o", "--output-directory", help="The output directory of the existing report, default is current directory", 
+        default=os.getcwd())
+        parser_5.add_argument("-c", "--coverage-threshold", help="Set the minimum depth of coverage for allele prescence, default is 0", default=0, type=int)
+        parser_5.add_argument("-m", "--metadata", help="The metadata sheet to use for subsetting VCF files, default is the sheet the report was created with.")
+        #--- Trend of saved results across runs
+        parser_6 = subparsers.add_parser("trend", help="Create a report of how each lineages mutations change over time at each site from the results saved by previous runs.")
+        parser_6.add_argument("-i", "--input-directory", help="Directory searched for the results saved by each run, e.g. a wastewater run directory.")
+        parser_6.add_argument("-o", "--output-directory", help="The output directory of the trend report, default is current directory", 
+        default=os.getcwd())
+        parser_6.add_argument("-c", "--coverage-threshold", help="Set the minimum depth of coverage for a sample to count towards a mutations frequency, default is 0", default=0, type=int)
+        parser_6.add_argument("--site-pattern", help="Regular expression with a named group site matched against sample names, default takes the second underscore delimited field", 
+        default=r"^[^_]+_(?P<site>[^_]+)")
+        parser_6.add_argument("-l", "--lineages", help="Only report these lineages, default is all lineages", nargs="+", default=None)
+        #--- Render saved results
+        parser_7 = subparsers.add_parser("render", help="Render the results saved by a previous run with a new coverage threshold or style, without reading ivar files or bams.", parents=[report_options])
+        parser_7.add_argument("-r", "--results", help="The saved results file, or the output directory of the run that saved it.")
+        parser_7.add_argument("-o", "--output-directory", help="The output directory of the rendered report, default is current directory", 
+        default=os.getcwd())
+        parser_7.add_argument("-c", "--coverage-threshold", help="Set the minimum depth of coverage for allele prescence, default is 0", default=0, type=int)
+        parser_7.add_argument("--colour-scale", help="Colour scale of the alt frequencies, default is green", default=None, choices=["green", "blue", "grey"])
+        parser_7.add_argument("--excel", help="Also create the Excel summary of the rendered report (classic style only)", action="store_true")
+        #--- Watch a wastewater directory for new runs
+        parser_8 = subparsers.add_parser("watch", help="Watch a directory setup by the wastewater group and process each run once its files stop changing.", parents=[mnp_options, threads_options, report_options, database_options, scaling_options, ivar_cache_options, verbose_options])
+        parser_8.add_argument("-i", "--input-directory", help="Input of wastewater data configured directory")
+        parser_8.add_argument("-c", "--coverage-threshold", help="Set the minimum depth of coverage for allele prescencem default is 30", default=30, type=int)
+        parser_8.add_argument("-m", "--metadata", help="The metadata sheet to use for subsetting VCF files, read again when it changes.")
+        parser_8.add_argument("--interval", help="Seconds between checks of the input directory, default is 60", default=60, type=float)
+        parser_8.add_argument("--settle", help="Seconds the files of a run must be unchanged before it is processed, default is 120", default=120, type=float)
+        parser_8.add_argument("--workers", help="Number of runs processed at once, default is 1", default=1, type=int)
+        #--- Split a run into shards run as separate jobs
+        parser_9 = subparsers.add_parser("plan", help="Split the samples of a run into shard manifests, each shard can then be run as a separate job.", parents=[mnp_options])
+        parser_9.add_argument("-i", "--ivar-directory", help="The directory containing ivar outputs files, used with --bam-directory.", default=None)
+        parser_9.add_argument("-b", "--bam-directory", help="The directory containing the bamfiles matching the Ivar filies", default=None)
+        parser_9.add_argument("-s", "--sample-sheet", help="Input file of samples names and paths to use, instead of an ivar and bam directory", default=None)
+        parser_9.add_argument("-o", "--output-directory", help="The plan directory the shard manifests and partial results are written to, default is current directory", 
+        default=os.getcwd())
+        parser_9.add_argument("-n", "--shards", help="Number of shards to split the samples into", required=True, type=int)
+        parser_9.add_argument("-m", "--metadata", help="The metadata sheets every shard is matched against.", nargs="+")
+        #--- Run a single shard
+        parser_10 = subparsers.add_parser("shard", help="Read, find the depths of and match the samples of one shard, writing its partial results beside the manifest.", parents=[threads_options, ivar_cache_options, verbose_options])
+        parser_10.add_argument("-s", "--shard-manifest", help="The manifest of the shard written by plan.")
+        #--- Merge finished shards into the report
+        parser_11 = subparsers.add_parser("merge", help="Join the partial results of every shard of a plan into the final report and Excel summary.", parents=[report_options, database_options])
+        parser_11.add_argument("-p", "--plan-directory", help="The plan directory of the shards.")
+        parser_11.add_argument("-o", "--output-directory", help="The output directory to use, default is current directory", 
+        default=os.getcwd())
+        parser_11.add_argument("-c", "--coverage-threshold", help="Set the minimum depth of coverage for allele prescence, default is 0", default=0, type=int)
+        parser_11.add_argument("--no-excel", help="Do not create the Excel summary of the report", dest="excel", action="store_false")
+        #--- Export saved results as a long format table
+        parser_12 = subparsers.add_parser("export", help="Export the results saved by previous runs as a long format Parquet or Arrow table, a row per run, sample and mutation.")
+        parser_12.add_argument("-r", "--results", help="The saved results files, or the output directories of the runs that saved them.", nargs="+")
+        parser_12.add_argument("-o", "--output-directory", help="The output directory of the exported table, default is current directory", 
+        default=os.getcwd())
+        parser_12.add_argument("-c", "--coverage-threshold", help="Set the minimum depth of coverage for allele prescence used for the status column, default is 0", default=0, type=int)
+        parser_12.add_argument("-f", "--export-format", help="parquet or arrow (Arrow IPC file), default is parquet", default="parquet", choices=["parquet", "arrow"])
+        parser_12.add_argument("--row-group-size", help="Number of rows written at a time, default is 65536", default=1 << 16, type=int)
 
         if len(self.args) == 0:
             parser.print_help()
@@ -69,7 +166,7 @@ class Argparser:
                 parser.print_help()
                 exit(-1)
             function_to_call = self.args[1]
-            self.functions_call[function_to_call](**parser_args.__dict__)
+            self.resolve_handler(function_to_call)(**parser_args.__dict__)
     
     def __init__(self, *args, **kwargs):
         self.args = args[0]
@@ -82,7 +179,7 @@ def run_main():
     run1()
 
 if __name__ == "__main__":
-    run_main(sys.argv)
+    run_main()
     #test_sub_sheet = "tests/test_vcfparser_subsheet_.txt"
     #test_metadata_sheet = "tests/VCFParser_tester.txt"
     #cov_thresh = 30
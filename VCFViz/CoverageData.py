@@ -10,13 +10,55 @@ the bam then a dictionary of the values and theyre assigned depths.
 """
 
 import datetime
+import hashlib
 import os
 import glob
 import subprocess
+import itertools
+from array import array
+from operator import itemgetter
 from typing import List
 from VCFViz.VCFlogging import VCFLogger as vlog
 import json
+from bisect import bisect_left
+from typing import NamedTuple, Tuple
 
+COVERAGE_CACHE = ".cache_snv_coverages.json"
+DEPTH_BLOCK_SIZE = 1 << 20 # bytes of samtools depth output parsed at a time
+COVERAGE_CHUNK_SIZE = 5 # bams passed to each samtools depth call
+QC_LEVELS = (1, 10, 30, 100) # depths the breadth of coverage of a sample is reported at
+
+
+class SampleQC(NamedTuple):
+    mean_depth: float
+    breadth: Tuple[float, ...] # fraction of positions with a depth of at least each of QC_LEVELS
+
+
+class DepthQC:
+    """
+    Accumulate the coverage QC of a sample a block of depths at a time, so the statistics
+    are gathered while the depths are read rather than in a separate pass over the bam.
+    """
+    __slots__ = ["total", "positions", "covered"]
+
+    def __init__(self) -> None:
+        self.total = 0
+        self.positions = 0
+        self.covered = [0] * len(QC_LEVELS) # positions with a depth of at least each level
+
+    def add(self, depths):
+        if len(depths) == 0:
+            return
+        ordered = sorted(depths)
+        self.total += sum(ordered)
+        self.positions += len(ordered)
+        for idx, level in enumerate(QC_LEVELS):
+            self.covered[idx] += len(ordered) - bisect_left(ordered, level)
+
+    def result(self) -> SampleQC:
+        if self.positions == 0:
+            return SampleQC(0.0, tuple(0.0 for _ in QC_LEVELS))
+        return SampleQC(self.total / self.positions, tuple(i / self.positions for i in self.covered))
 
 
 class SampleMap:
@@ -98,6 +140,185 @@ class SampleMap:
         vlog.logger.critical(f"Could not find bam file for sample {self.sample_name}")
         raise ValueError(f"Could not find bamfile for sample: {self.sample_name}")
 
+class CoverageStore:
+    """
+    Compact storage of the depth information for a set of samples. Each sample
+    holds a single unsigned integer array of its depths with every contig placed
+    back to back, the contig table maps a contig to its offset in the array and
+    its length. Positions are 1 based as in samtools.
+    The coverage QC of samples streamed in order is accumulated as their depths are added,
+    for other samples e.g. those read from the cache it is found from their arrays when asked for.
+    """
+    typecode = "I"
+
+    def __init__(self) -> None:
+        self.contigs = {} # contig: [offset, length]
+        self.samples = {} # sample name: array of depths
+        self.qc = {} # sample name: DepthQC of the depths added in order
+
+    def __contains__(self, sample_name) -> bool:
+        return sample_name in self.samples
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def add_sample(self, sample_name):
+        """
+        Initialize an empty depth array for a sample
+        """
+        if sample_name not in self.samples:
+            self.samples[sample_name] = array(self.typecode)
+
+    def add_depths(self, sample_name, contig, positions, depths):
+        """
+        Place the depths of a contigs positions into the samples array
+        :param sample_name: the sample the depths belong to
+        :param contig: the contig the positions are on
+        :param positions: an array of sorted 1 based positions
+        :param depths: an array of depths matching the positions
+        """
+        if len(positions) == 0:
+            return
+        if self.contigs.get(contig) is None:
+            self.contigs[contig] = [self.size(), 0]
+        offset, length = self.contigs[contig]
+        end = positions[-1]
+        if end > length:
+            if contig != next(reversed(self.contigs)):
+                raise ValueError(f"Contig {contig} for sample {sample_name} is longer than previously seen.")
+            self.contigs[contig][1] = end
+
+        self.add_sample(sample_name)
+        sample_depths = self.samples[sample_name]
+        start = offset + positions[0] - 1
+        contiguous = positions[-1] - positions[0] + 1 == len(positions)
+        if contiguous and start == len(sample_depths):
+            # samtools depth -aa streams every position in order so this is the common case
+            sample_depths.extend(depths)
+            if start == 0:
+                self.qc[sample_name] = DepthQC()
+            if sample_name in self.qc:
+                self.qc[sample_name].add(depths)
+            return
+        self.qc.pop(sample_name, None) # depths are being replaced, found from the array instead
+        if len(sample_depths) < offset + end:
+            sample_depths.extend(array(self.typecode, bytes(sample_depths.itemsize * (offset + end - len(sample_depths)))))
+        if contiguous:
+            sample_depths[start:start + len(depths)] = array(self.typecode, depths)
+        else:
+            for pos, depth in zip(positions, depths):
+                sample_depths[offset + pos - 1] = depth
+
+    def size(self) -> int:
+        """
+        The number of positions over all contigs
+        """
+        return sum(i[1] for i in self.contigs.values())
+
+    def contig_offset(self, contig=None):
+        """
+        Get the offset and length of a contig, the first contig is used when none is given
+        as SARS-CoV-2 references only contain one.
+        """
+        if contig is None:
+            return next(iter(self.contigs.values()), (0, 0))
+        return self.contigs[contig]
+
+    def depth(self, sample_name, position, contig=None) -> int:
+        """
+        Return the depth of a sample at a position, positions outside of the covered
+        contig are reported as having no depth.
+        :param sample_name: The sample to get the depth for
+        :param position: The 1 based position as an int or a string
+        :param contig: The contig name, the first contig is used if not specified
+        """
+        sample_depths = self.samples[sample_name]
+        offset, length = self.contig_offset(contig)
+        position = int(position)
+        idx = offset + position - 1
+        if 0 < position <= length and idx < len(sample_depths):
+            return sample_depths[idx]
+        return 0
+
+    def depths(self, sample_name, positions, contig=None) -> array:
+        """
+        Return an array of the depths of a sample for multiple positions
+        :param sample_name: The sample to get the depth for
+        :param positions: An iterable of 1 based positions
+        :param contig: The contig name, the first contig is used if not specified
+        """
+        sample_depths = self.samples[sample_name]
+        offset, length = self.contig_offset(contig)
+        positions = [int(i) for i in positions]
+        limit = min(length, len(sample_depths) - offset)
+        if len(positions) > 1 and all(0 < i <= limit for i in positions):
+            return array(self.typecode, itemgetter(*[offset + i - 1 for i in positions])(sample_depths))
+        return array(self.typecode, [self.depth(sample_name, i, contig) for i in positions])
+
+    def sample_qc(self, sample_name) -> SampleQC:
+        """
+        Return the coverage QC of a sample over every contig, None if the sample has no depths
+        """
+        accumulated = self.qc.get(sample_name)
+        if accumulated is not None and accumulated.positions == len(self.samples[sample_name]):
+            return accumulated.result()
+        sample_depths = self.samples.get(sample_name)
+        if sample_depths is None:
+            return None
+        accumulated = DepthQC()
+        accumulated.add(sample_depths)
+        self.qc[sample_name] = accumulated
+        return accumulated.result()
+
+    def subset(self, sample_names):
+        """
+        Create a store of only the specified samples, the arrays are shared not copied
+        """
+        store = CoverageStore()
+        store.contigs = {key: list(val) for key, val in self.contigs.items()}
+        store.samples = {i: self.samples[i] for i in sample_names if i in self.samples}
+        store.qc = {i: self.qc[i] for i in store.samples if i in self.qc}
+        return store
+
+    def update(self, other):
+        """
+        Merge the samples of another store into this one, replacing existing samples
+        """
+        if not self.contigs or other.contigs == self.contigs:
+            self.contigs = {key: list(val) for key, val in other.contigs.items()}
+            self.samples.update(other.samples)
+        else:
+            for sample_name, sample_depths in other.samples.items():
+                self.samples.pop(sample_name, None)
+                for contig, (offset, length) in other.contigs.items():
+                    contig_depths = sample_depths[offset:offset + length]
+                    self.add_depths(sample_name, contig, range(1, len(contig_depths) + 1), contig_depths)
+        for sample_name in other.samples: # the QC of a sample does not depend on where its contigs are placed
+            if sample_name in other.qc:
+                self.qc[sample_name] = other.qc[sample_name]
+            else:
+                self.qc.pop(sample_name, None)
+
+    def to_json(self) -> dict:
+        """
+        Create a json serializable copy of the store for caching
+        """
+        return {"contigs": self.contigs, "samples": {key: val.tolist() for key, val in self.samples.items()}}
+
+    @classmethod
+    def from_json(cls, json_data: dict):
+        """
+        Create a store from its json representation, None is returned if the data is in
+        the older position dictionary format.
+        """
+        if set(json_data.keys()) != {"contigs", "samples"}:
+            return None
+        store = cls()
+        store.contigs = {key: list(val) for key, val in json_data["contigs"].items()}
+        store.samples = {key: array(cls.typecode, val) for key, val in json_data["samples"].items()}
+        return store
+
+
 class SamplesCoverage:
     """
     take a list of SampleMap's and calculate their depths.
@@ -105,11 +326,11 @@ class SamplesCoverage:
     All SampleMaps should have a map and index, as SampleMap's
     initializer will throw an error if any sample fails
     """
-    samples_coverage = {} # keep all of the coverage data static
     def __init__(self, samples: List[SampleMap]) -> None:
         self.samples = samples
-        for sample in self.samples: # initialize samples in dictionary
-            self.samples_coverage[sample.sample_name] = {}
+        self.samples_coverage = CoverageStore()
+        for sample in self.samples: # initialize samples in the store
+            self.samples_coverage.add_sample(sample.sample_name)
         #self.retrieve_coverage() # move this out of init
     
     def retrieve_coverage(self):
@@ -117,7 +338,7 @@ class SamplesCoverage:
         call the samtools depth process on the list of samples
         """
         
-        chunks_bam = self.chunk_list(5, self.samples)
+        chunks_bam = self.chunk_list(COVERAGE_CHUNK_SIZE, self.samples)
         for chunk in chunks_bam:
             self.call_coverage_program(chunk)
 
@@ -132,13 +353,10 @@ class SamplesCoverage:
         start = datetime.datetime.now()
         depth_task = subprocess.Popen(samtools_call, stdout=subprocess.PIPE)
         
-        for i in depth_task.stdout:
-            # Passing multiple files to samtools depth returns them in order and as bytes
-            # so it is nessecary to encode the bytes to text for processing
-            depth_data = i.decode("utf-8", "ignore").strip().split("\t")
-            for k, cov in enumerate(depth_data[2:]): # skipping chormosome and postion in output
-                # depth data is 1st pos and keeping as string to match original format
-                self.samples_coverage[samples_list[k].sample_name][depth_data[1]] = int(cov)
+        # Passing multiple files to samtools depth returns them in order, one column per bam
+        for contig, positions, columns in read_depth_stream(depth_task.stdout, len(samples_list)):
+            for sample, depths in zip(samples_list, columns):
+                self.samples_coverage.add_depths(sample.sample_name, contig, positions, depths)
         depth_task.communicate() #testing adding communicate as process kept faileing on the cluster remove if not nesseccary
         status = depth_task.poll()
         end = datetime.datetime.now()
@@ -163,14 +381,72 @@ class SamplesCoverage:
         return chunks
 
 
-def create_sample_coverages(samples: List[str], search_dir: str, sample_maps: List[SampleMap] = None):
+def parse_depth_block(block: bytes, n_samples: int):
+    """
+    Parse a block of complete samtools depth lines into integer arrays. A list of
+    (contig, positions, depth columns) is returned with one depth column per sample,
+    a block spanning multiple contigs is split at the contig boundaries.
+    :param block: bytes of samtools depth output ending on a line boundary
+    :param n_samples: the number of bams passed to samtools depth
+    """
+    width = n_samples + 2 # chromosome and position preceed the depths
+    fields = block.split() # reference names can not contain white space
+    if len(fields) % width != 0:
+        raise ValueError(f"Expected {width} fields per line of samtools depth output.")
+    contigs = fields[0::width]
+    positions = array("I", map(int, fields[1::width]))
+    columns = [array("I", map(int, fields[2 + k::width])) for k in range(n_samples)]
+    if contigs[0] == contigs[-1]: # samtools output is sorted so this is a single contig
+        return [(contigs[0].decode("utf-8", "ignore"), positions, columns)]
+
+    segments = []
+    start = 0
+    for contig, lines in itertools.groupby(contigs):
+        end = start + sum(1 for _ in lines)
+        segments.append((contig.decode("utf-8", "ignore"), positions[start:end], [i[start:end] for i in columns]))
+        start = end
+    return segments
+
+
+def read_depth_stream(stream, n_samples: int, block_size: int = DEPTH_BLOCK_SIZE):
+    """
+    Incrementally read samtools depth output in large blocks, yielding the parsed
+    (contig, positions, depth columns) of each block so only a block is held in memory.
+    :param stream: a binary file like object e.g. the stdout of the samtools process
+    :param n_samples: the number of bams passed to samtools depth
+    :param block_size: the number of bytes to read at a time
+    """
+    remainder = b""
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        block = remainder + block
+        cut = block.rfind(b"\n") + 1 # only parse up to the last full line
+        remainder = block[cut:]
+        if cut:
+            yield from parse_depth_block(block[:cut], n_samples)
+    if remainder.strip():
+        yield from parse_depth_block(remainder, n_samples)
+
+
+def samples_cache_name(sample_names: List[str]) -> str:
+    """
+    The name of a depth cache holding only the given samples, e.g. for a batch or shard so
+    that each cache never holds more than its samples and runs in parallel do not share a cache
+    """
+    return f".cache_snv_coverages_{hashlib.sha1(chr(9).join(sample_names).encode()).hexdigest()[:16]}.json"
+
+
+def create_sample_coverages(samples: List[str], search_dir: str, sample_maps: List[SampleMap] = None, cache_name: str = COVERAGE_CACHE):
     """
     From all of the sample sheets specified create the sample map objects
     and pass it off to samples coverage to return the coverage obj
     :param samples: A list of sample_names
     :param search_dir: the directory containing bams
+    :param cache_name: the file name of the depth cache in the search directory
     """
-    cache_path = os.path.join(search_dir, ".cache_snv_coverages.json")
+    cache_path = os.path.join(search_dir, cache_name)
     vlog.logger.info(f"Searching {cache_path} for depth cache.")
     if sample_maps is None:
         sample_maps = []
@@ -179,60 +455,74 @@ def create_sample_coverages(samples: List[str], search_dir: str, sample_maps: Li
     
     cov_data = SamplesCoverage(sample_maps)
     if os.path.isfile(cache_path):
-        with open(cache_path, 'r') as cov_data_:
-            try:
-                stage_cov = json.load(cov_data_)
-            except json.decoder.JSONDecodeError:
-                vlog.logger.warning(f"Could not read SNP cache creating new one")
-                cov_data.retrieve_coverage()
-                write_cache(cache_path=cache_path, cov_data=cov_data)
-                return cov_data
-
-            # check that all samples are in cov info
-            samples_to_recall = []
-            for samp in sample_maps:
-                if stage_cov.get(samp.sample_name) is None:
-                    vlog.logger.warning(f"Missing coverage for sample {samp.sample_name}"\
-                        f" in data cache, regenerating coverage information for missing sample.")
-                    samples_to_recall.append(samp)
-                    #cov_data.retrieve_coverage()
-
-            if len(samples_to_recall) != 0:
-                chunks = cov_data.chunk_list(5, samples_to_recall)
-                for chunk in chunks:
-                    vlog.logger.info(f"Updating coverage cache to include samples {[i.sample_name for i in chunk]}")
-                    cov_data.call_coverage_program(chunk)
-                # load and stage data
-                # this needs to be refactored to not be copying this code later
-                write_cache(cache_path=cache_path, cov_data=cov_data, mode='a')
-                return cov_data
-
-            vlog.logger.info(f"Reusing coverage data from previous program run.")
-            for key in stage_cov.keys():
-                for vals in stage_cov[key].keys():
-                    stage_cov[key][vals] = int(stage_cov[key][vals]) 
-            cov_data.samples_coverage = stage_cov
+        stage_cov = read_cache(cache_path)
+        if stage_cov is None:
+            vlog.logger.warning(f"Could not read SNP cache creating new one")
+            cov_data.retrieve_coverage()
+            write_cache(cache_path=cache_path, cov_data=cov_data)
+            return cov_data
+
+        # check that all samples are in cov info
+        samples_to_recall = []
+        for samp in sample_maps:
+            if samp.sample_name not in stage_cov:
+                vlog.logger.warning(f"Missing coverage for sample {samp.sample_name}"\
+                    f" in data cache, regenerating coverage information for missing sample.")
+                samples_to_recall.append(samp)
+
+        # only keep the requested samples in memory
+        cov_data.samples_coverage = stage_cov.subset([i.sample_name for i in sample_maps])
+        if len(samples_to_recall) != 0:
+            chunks = cov_data.chunk_list(COVERAGE_CHUNK_SIZE, samples_to_recall)
+            for chunk in chunks:
+                vlog.logger.info(f"Updating coverage cache to include samples {[i.sample_name for i in chunk]}")
+                cov_data.call_coverage_program(chunk)
+            vlog.logger.info("Appending data to existing cache.")
+            stage_cov.update(cov_data.samples_coverage)
+            write_store(cache_path, stage_cov)
             return cov_data
+
+        vlog.logger.info(f"Reusing coverage data from previous program run.")
+        return cov_data
     else:
         cov_data.retrieve_coverage()
     write_cache(cache_path=cache_path, cov_data=cov_data)
     return cov_data
 
+def read_cache(cache_path):
+    """
+    Read the snv cache into a coverage store, None is returned if the cache can not be used
+    """
+    with open(cache_path, 'r') as cov_file:
+        try:
+            stage_cov = json.load(cov_file)
+        except json.decoder.JSONDecodeError:
+            return None
+    store = CoverageStore.from_json(stage_cov)
+    if store is None:
+        vlog.logger.warning(f"Coverage cache {cache_path} uses the older position format.")
+    return store
+
+def write_store(cache_path, store):
+    """
+    Write a coverage store to the snv cache
+    """
+    with open(cache_path, 'w') as cov_file:
+        vlog.logger.info(f"Creating depth data cache in {cache_path}.")
+        json.dump(store.to_json(), cov_file)
+
 def write_cache(cache_path, cov_data, mode = 'w'):
     """
     A method to write out the snv cache
     """
-    if mode !='a':
-        with open(cache_path, mode) as cov_file:
-            vlog.logger.info(f"Creating depth data cache in {cache_path}.")
-            json.dump(cov_data.samples_coverage, cov_file, indent=2)
-    else:
-        with open(cache_path, 'r') as cov_file:
+    store = cov_data.samples_coverage
+    if mode == 'a' and os.path.isfile(cache_path):
+        existing = read_cache(cache_path)
+        if existing is not None:
             vlog.logger.info("Appending data to existing cache.")
-            json_data = json.load(cov_file)
-            cov_data.samples_coverage = {**json_data, **cov_data.samples_coverage} # merge the dictionaries
-            write_cache(cache_path=cache_path, cov_data=cov_data)
-    
+            existing.update(store)
+            store = existing
+    write_store(cache_path, store)
 
 
 if __name__=="__main__":
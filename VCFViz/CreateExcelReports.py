@@ -17,6 +17,7 @@ import pandas as pd
 
 # My crappy code
 from VCFViz.VCFlogging import VCFLogger as vlog
+from VCFViz.MatchedResults import STAT_ROWS, QC_ROWS
 
 # Nice python library 
 import os
@@ -32,6 +33,8 @@ class HTMLToExcel:
     def __init__(self, directory_recurse, outpath) -> None:
         self.outpath = outpath
         self.html_voc_data = {}
+        self.lineage_stats = {} # statistic rows of each lineage, written as columns of the averages sheet
+        self.coverage_qc = None # QC rows of the samples, the same in every lineage
         self.directory_recurse = directory_recurse
         self.directories = self.recurse_directory()
         [self.read_html_file(i) for i in self.directories] # map call wasnt working for somereason
@@ -45,6 +48,14 @@ class HTMLToExcel:
         df = pd.read_html(fp)
         samples = [i for i in list(df[0].columns)[1:]]
         df[0].rename(columns={"Unnamed: 0": "NucName+AAName"}, inplace=True)
+        qc_rows = df[0]["NucName+AAName"].isin(QC_ROWS)
+        if qc_rows.any():
+            self.coverage_qc = df[0][qc_rows].set_index("NucName+AAName")[samples]
+            df[0] = df[0][~qc_rows].copy()
+        stat_rows = df[0]["NucName+AAName"].isin(STAT_ROWS)
+        if stat_rows.any():
+            self.lineage_stats[sample_name] = df[0][stat_rows].set_index("NucName+AAName")[samples]
+            df[0] = df[0][~stat_rows].copy()
         df[0]["AAName"], df[0]["NucName"] = zip(*df[0]["NucName+AAName"].apply(lambda x: x.split("|"))) # create split columns for indexing
         df[0]["VOC"] = sample_name
         df[0]["Position"] = df[0]["NucName"].apply(lambda x: int(''.join([i for i in x if i.isdigit()])))
@@ -68,6 +79,12 @@ class HTMLToExcel:
         writer = pd.ExcelWriter(os.path.join(self.outpath, "SummaryExcelfile.xlsx"))
         for key in self.html_voc_data.keys():
             self.html_voc_data[key].to_excel(writer, sheet_name=key, index=False)
+        if self.lineage_stats:
+            averages = pd.concat({key: val.T for key, val in sorted(self.lineage_stats.items())}, axis=1)
+            averages.columns = [f"{lineage} {stat}" for lineage, stat in averages.columns]
+            averages.to_excel(writer, sheet_name="Lineage averages", index_label="Sample")
+        if self.coverage_qc is not None:
+            self.coverage_qc.T.to_excel(writer, sheet_name="Coverage QC", index_label="Sample")
         writer.save()
         vlog.logger.info(f"Completed conversion of HTML files to an Excel summary file")
 
@@ -0,0 +1,164 @@
+"""
+Create a data driven report of the matched results. Rather than writing a
+styled table cell for every sample, mutation and lineage the report embeds the
+result matrices as base64 encoded 16 bit integers and a small script draws
+only the cells currently in view, building the lineage navigation from the
+data. Everything is inlined so the report works offline.
+
+Cells are encoded as the alt frequency * 1000 when an allele is present
+above the coverage threshold, otherwise as a negative status code. The
+lineage statistics are encoded the same way as extra rows after the mutations.
+"""
+
+from array import array
+import base64
+from datetime import datetime
+import json
+import math
+import sys
+from VCFViz.MatchedResults import MatchedResults, STAT_ROWS
+
+STATUS_CODES = {"LC": -1, "NC": -2, "WT_LC": -3, "ALT_LC": -4, "WT": -5, "ALT": -6, "NA": -7}
+
+
+def encode_lineage(lineage_results, cov_thresh: int) -> str:
+    """
+    Encode the cell statuses of a lineage followed by its statistic rows as base64 little
+    endian 16 bit integers
+    """
+    codes = array("h")
+    for m_idx in range(len(lineage_results.mutations)):
+        for s_idx in range(lineage_results.n_samples):
+            status = lineage_results.status(m_idx, s_idx, cov_thresh)
+            code = STATUS_CODES.get(status)
+            codes.append(code if code is not None else int(round(float(status) * 1000)))
+    for values in lineage_results.stats(cov_thresh).values():
+        codes.extend([STATUS_CODES["NA"] if math.isnan(i) else int(round(i * 1000)) for i in values])
+    if sys.byteorder != "little":
+        codes.byteswap()
+    return base64.b64encode(codes.tobytes()).decode("ascii")
+
+
+def data_payload(results: MatchedResults, cov_thresh: int, metadata_sheet: str, colours: list) -> dict:
+    """
+    Create the json payload embedded in the report
+    """
+    lineages = []
+    for lineage, lineage_results in results.lineages.items():
+        lineages.append({
+            "name": lineage,
+            "mutations": [f"{i.AAName}|{i.NucName}" for i in lineage_results.mutations] + list(STAT_ROWS),
+            "values": encode_lineage(lineage_results, cov_thresh)})
+    return {"samples": results.samples, "lineages": lineages, "colours": colours,
+            "statuses": {str(val): key for key, val in STATUS_CODES.items()},
+            "banner": [f"VCFParser sheet used: {metadata_sheet}", f"Time combined report created: {datetime.now()}",
+                        f"Depth of Coverage Threshold: {cov_thresh}"]}
+
+
+def data_report_html(results: MatchedResults, cov_thresh: int, metadata_sheet: str, colours: list) -> str:
+    """
+    Return the html of the data driven report
+    """
+    payload = json.dumps(data_payload(results, cov_thresh, metadata_sheet, colours), separators=(",", ":"))
+    payload = payload.replace("</", "<\\/") # the payload can not close its script tag
+    return REPORT_TEMPLATE.replace("@PAYLOAD@", payload).replace("@SCRIPT@", REPORT_SCRIPT)
+
+
+REPORT_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>VCFViz report</title>
+<style>
+body { margin: 0; font-family: "Arial"; display: flex; height: 100vh; }
+#nav { width: 240px; overflow-y: auto; background-color: #111; padding-top: 10px; flex-shrink: 0; }
+#nav a { display: block; padding: 6px 8px 6px 16px; color: coral; text-decoration: none; cursor: pointer; }
+#nav a.active { background-color: #333; }
+#main { flex: 1; display: flex; flex-direction: column; min-width: 0; }
+#banner { padding: 8px 12px; font-size: 13px; border-bottom: 1px solid black; }
+#grid { flex: 1; overflow: auto; position: relative; }
+#canvas { position: relative; }
+.cell { position: absolute; box-sizing: border-box; border: 1px solid black; font-size: 12px; text-align: center;
+        overflow: hidden; white-space: nowrap; color: coral; font-weight: 600; line-height: 22px; background: #fff; }
+.head { z-index: 1; color: black; }
+</style>
+</head>
+<body>
+<div id="nav"></div>
+<div id="main"><div id="banner"></div><div id="grid"><div id="canvas"></div></div></div>
+<script id="vcfviz-data" type="application/json">@PAYLOAD@</script>
+<script>@SCRIPT@</script>
+</body>
+</html>
+"""
+
+REPORT_SCRIPT = """
+(function () {
+  var data = JSON.parse(document.getElementById("vcfviz-data").textContent);
+  var CW = 56, CH = 22, LW = 260, HH = 140;
+  var grid = document.getElementById("grid"), canvas = document.getElementById("canvas");
+  var nav = document.getElementById("nav"), links = [], current = null, pending = false;
+
+  function esc(text) {
+    return String(text).replace(/[&<>"]/g, function (c) { return "&#" + c.charCodeAt(0) + ";"; });
+  }
+  function decode(b64) {
+    var raw = atob(b64), bytes = new Uint8Array(raw.length);
+    for (var i = 0; i < raw.length; i++) { bytes[i] = raw.charCodeAt(i); }
+    return new Int16Array(bytes.buffer);
+  }
+  function cell(x, y, w, h, text, style) {
+    return '<div class="cell' + (style ? " head" : "") + '" style="left:' + x + 'px;top:' + y + 'px;width:' + w +
+      'px;height:' + h + 'px;' + (style || "") + '">' + text + '</div>';
+  }
+  function draw() {
+    pending = false;
+    var lin = current, n = data.samples.length, html = [];
+    var top = grid.scrollTop, left = grid.scrollLeft;
+    var r0 = Math.max(0, Math.floor(top / CH) - 1), r1 = Math.min(lin.mutations.length, Math.ceil((top + grid.clientHeight) / CH));
+    var c0 = Math.max(0, Math.floor(left / CW) - 1), c1 = Math.min(n, Math.ceil((left + grid.clientWidth) / CW));
+    for (var r = r0; r < r1; r++) {
+      for (var c = c0; c < c1; c++) {
+        var v = lin.cells[r * n + c], text, bg = "";
+        if (v >= 0) { text = String(v / 1000); bg = "background:" + data.colours[Math.floor(v / 100)] + ";"; }
+        else { text = data.statuses[v]; }
+        html.push(cell(LW + c * CW, HH + r * CH, CW, CH, text, "").replace('style="', 'style="' + bg));
+      }
+      html.push(cell(left, HH + r * CH, LW, CH, esc(lin.mutations[r]), "text-align:left;padding-left:4px;"));
+    }
+    for (var c = c0; c < c1; c++) {
+      html.push(cell(LW + c * CW, top, CW, HH, esc(data.samples[c]), "writing-mode:vertical-lr;transform:rotate(180deg);line-height:" + CW + "px;"));
+    }
+    html.push(cell(left, top, LW, HH, esc(lin.name), "z-index:2;font-size:20px;line-height:" + HH + "px;"));
+    canvas.innerHTML = html.join("");
+  }
+  function schedule() {
+    if (!pending) { pending = true; window.requestAnimationFrame(draw); }
+  }
+  function select(idx) {
+    current = data.lineages[idx];
+    if (!current.cells) { current.cells = decode(current.values); }
+    links.forEach(function (link, i) { link.className = i === idx ? "active" : ""; });
+    canvas.style.width = (LW + data.samples.length * CW) + "px";
+    canvas.style.height = (HH + current.mutations.length * CH) + "px";
+    grid.scrollTop = 0;
+    grid.scrollLeft = 0;
+    window.location.hash = encodeURIComponent(current.name);
+    schedule();
+  }
+  document.getElementById("banner").innerHTML = data.banner.map(esc).join("<br>");
+  data.lineages.forEach(function (lin, idx) {
+    var link = document.createElement("a");
+    link.textContent = lin.name;
+    link.onclick = function () { select(idx); };
+    nav.appendChild(link);
+    links.push(link);
+  });
+  grid.addEventListener("scroll", schedule);
+  window.addEventListener("resize", schedule);
+  if (data.lineages.length) {
+    var start = data.lineages.map(function (lin) { return lin.name; }).indexOf(decodeURIComponent(window.location.hash.slice(1)));
+    select(Math.max(start, 0));
+  }
+})();
+"""
@@ -0,0 +1,112 @@
+"""
+Export saved results as a long format table, a row per run, sample and mutation, in Parquet
+or Arrow IPC so the results can be read directly by dashboards and analysis tools rather
+than from the Excel summary.
+
+Rows are created a lineage at a time from the result matrices and written in row groups of a
+fixed number of rows, so memory is bounded by the row group size and not by the number of
+runs or samples exported. Rows are ordered by run, lineage and mutation, so the statistics of
+each row group let readers skip the groups of the lineages and mutations they do not need.
+
+pyarrow is only imported when exporting, it is not needed by any other run mode.
+"""
+
+from datetime import datetime
+import math
+import os
+from typing import Iterable, List, Tuple
+from VCFViz.MatchedResults import MatchedResults, RESULTS_FILE
+from VCFViz.VCFlogging import VCFLogger as vlog
+
+EXPORT_FILES = {"parquet": "VCFViz_results.parquet", "arrow": "VCFViz_results.arrow"}
+ROW_GROUP_SIZE = 1 << 16 # rows written at a time
+EXPORT_COLUMNS = ("run", "sample", "collection_date", "lineage", "mutation", "position", "type", "alt_freq", "depth", "status")
+
+
+def long_format_batches(results: MatchedResults, cov_thresh: int, run: str, batch_rows: int = ROW_GROUP_SIZE):
+    """
+    Yield the rows of the results as dictionaries of EXPORT_COLUMNS to lists of at most batch_rows
+    values. Unmatched cells have no alt frequency, the status is decided by the coverage threshold.
+    """
+    columns = {i: [] for i in EXPORT_COLUMNS}
+    dates = [i or None for i in results.sample_dates]
+    for lineage, lineage_results in results.lineages.items(): # a lineage at a time for spilled results
+        for m_idx, mutation in enumerate(lineage_results.mutations):
+            for s_idx, sample in enumerate(results.samples):
+                idx = lineage_results.cell(m_idx, s_idx)
+                alt_freq = lineage_results.alt_freqs[idx]
+                row = (run, sample, dates[s_idx], lineage, mutation.NucName, int(mutation.Position), mutation.Type,
+                        None if math.isnan(alt_freq) else alt_freq, lineage_results.depths[idx],
+                        lineage_results.status(m_idx, s_idx, cov_thresh))
+                for values, value in zip(columns.values(), row):
+                    values.append(value)
+                if len(columns["run"]) >= batch_rows:
+                    yield columns
+                    columns = {i: [] for i in EXPORT_COLUMNS}
+    if columns["run"]:
+        yield columns
+
+
+def write_results_table(runs: Iterable[Tuple[str, MatchedResults]], file_path: str, cov_thresh: int, export_format: str = "parquet",
+                        row_group_size: int = ROW_GROUP_SIZE) -> int:
+    """
+    Write the long format rows of each (run name, results) to a Parquet or Arrow IPC file, runs
+    are taken one at a time so a generator keeps only one run in memory. The file is written
+    under a temporary name and moved into place once complete. Returns the number of rows written.
+    """
+    try:
+        import pyarrow as pa # only needed for exporting
+        import pyarrow.ipc as ipc
+        import pyarrow.parquet as pq
+    except ImportError:
+        vlog.logger.critical("pyarrow is needed to export results, install it with: pip install pyarrow")
+        raise
+    schema = pa.schema([("run", pa.string()), ("sample", pa.string()), ("collection_date", pa.string()), ("lineage", pa.string()),
+                        ("mutation", pa.string()), ("position", pa.int32()), ("type", pa.string()), ("alt_freq", pa.float64()),
+                        ("depth", pa.uint32()), ("status", pa.string())])
+    temp_path = f"{file_path}.{os.getpid()}.tmp"
+    n_rows = 0
+    writer = pq.ParquetWriter(temp_path, schema) if export_format == "parquet" else ipc.new_file(temp_path, schema)
+    try:
+        for run, results in runs:
+            for batch in long_format_batches(results, cov_thresh, run, row_group_size):
+                writer.write_batch(pa.record_batch([pa.array(batch[i.name], type=i.type) for i in schema], schema=schema))
+                n_rows += len(batch["run"])
+    except BaseException:
+        writer.close()
+        os.remove(temp_path)
+        raise
+    writer.close()
+    os.replace(temp_path, file_path)
+    return n_rows
+
+
+def run_names(results_files: List[str]) -> List[str]:
+    """
+    Name each run by the path of the directory its results were saved in, relative to the
+    parent of the directory all the results are in. e.g. the results of the panels of a run
+    with several metadata sheets, run1/voc and run1/markers, are not given the same name.
+    """
+    directories = [os.path.dirname(os.path.abspath(i)) for i in results_files]
+    parent = os.path.dirname(os.path.commonpath(directories))
+    return [os.path.relpath(i, parent).replace(os.sep, "/") for i in directories]
+
+
+def export_results(results: List[str], output_directory: str, coverage_threshold: int, export_format: str = "parquet",
+                    row_group_size: int = ROW_GROUP_SIZE):
+    """
+    Export the saved results of one or more runs to a single long format table in the output
+    directory, see run_names for how each run is named.
+    :param results: saved results files, or the output directories of the runs that saved them
+    """
+    results_files = [os.path.join(i, RESULTS_FILE) if os.path.isdir(i) else i for i in results]
+    missing = [i for i in results_files if not os.path.isfile(i)]
+    if missing:
+        vlog.logger.critical(f"Could not find saved results {missing} to export.")
+        exit(-1)
+    start = datetime.now()
+    os.makedirs(output_directory, exist_ok=True)
+    file_path = os.path.join(output_directory, EXPORT_FILES[export_format])
+    runs = ((name, MatchedResults.load(i)) for name, i in zip(run_names(results_files), results_files))
+    n_rows = write_results_table(runs, file_path, coverage_threshold, export_format, row_group_size)
+    vlog.logger.info(f"Exported {n_rows} rows of {len(results_files)} runs to {file_path} in {datetime.now() - start}")
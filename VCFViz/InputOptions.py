@@ -5,70 +5,308 @@ Handle different input options being either globs, input sheet or specification
 """
 
 from VCFViz.VCFlogging import VCFLogger as vlog
-from VCFViz.VCFToJson import ReadIvar
+from VCFViz.VCFToJson import ReadIvar, ReadVCF
 from VCFViz import RenderHTML
 from VCFViz.RenderHTML import VCFDataHTML
 from VCFViz import CoverageData
+from VCFViz.MatchedResults import MatchedResults, SpilledResults, RESULTS_FILE
+from VCFViz.MatchDiagnostics import MatchDiagnostics, DIAGNOSTICS_FILE
+from VCFViz.MatchSamples import SampleMatcher, DataSheet
+from VCFViz.ResultsWarehouse import store_results
+from VCFViz.SamplePipeline import run_pipeline
+from VCFViz import IvarCache
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import glob
 import os
-from VCFViz.CreateExcelReports import HTMLToExcel
+import shutil
+from typing import List, Union
 
 
+DEFAULT_THREADS = min(8, os.cpu_count() or 1)
+SPILL_DIRECTORY = ".VCFViz_batches" # batch results spilled to the output directory
+
+
+def panel_outputs(metadata: Union[str, DataSheet, List[str]], output_directory: str) -> dict:
+    """
+    Pair each metadata sheet (panel) with the directory its report is written to. A single
+    sheet is written to the output directory, with several sheets each is written to a
+    subdirectory of the output directory named after the sheet.
+    """
+    sheets = list(dict.fromkeys(metadata)) if isinstance(metadata, (list, tuple)) else [metadata] # a path or a read DataSheet
+    if len(sheets) == 1:
+        return {sheets[0]: output_directory}
+    panels = {}
+    for sheet in sheets:
+        name = os.path.splitext(os.path.basename(sheet))[0]
+        panel_dir = os.path.join(output_directory, name)
+        duplicate = 1
+        while panel_dir in panels.values(): # sheets of the same name from different directories
+            duplicate += 1
+            panel_dir = os.path.join(output_directory, f"{name}_{duplicate}")
+        os.makedirs(panel_dir, exist_ok=True)
+        panels[sheet] = panel_dir
+    return panels
+
 #Submission sheet input (Retain sample order)
-def process_submission_sheet(sample_sheet: str, metadata: str, coverage_threshold: int, output_directory: str):
+def process_submission_sheet(sample_sheet: str, metadata: Union[str, List[str]], coverage_threshold: int, output_directory: str, mnp_cv_threshold: float = 2.5,
+                            threads: int = DEFAULT_THREADS, report_style: str = "classic", page_size: int = 100, page_order: str = "sheet",
+                            database: str = None, verbose: bool = False, batch_size: int = 0, pipeline: bool = False,
+                            ivar_cache: str = None, ivar_cache_size: int = IvarCache.DEFAULT_CACHE_SIZE):
     """
     Process a submission sheet that provides:
         - sample name
         - Ivar sheet path
         - bam path
+        - collection date (optional, YYYY-MM-DD) used to order report pages
+    All rows are validated before any files are read, then the rows are parsed concurrently
+    keeping the order of the sheet. With a batch size the rows are processed in batches of that
+    many samples, see process_in_batches. With pipeline the rows are read, their depths found
+    and matched at the same time, see SamplePipeline.
+    metadata may be several sheets, the samples are read and their depths found once then
+    matched against each sheet and a report written per sheet, see panel_outputs.
     """
-    samples = []
+    rows = read_sample_sheet(sample_sheet)
+    read_row = partial(read_sheet_row, read_ivar=ivar_reader(ivar_cache, ivar_cache_size))
+    if batch_size:
+        process_in_batches(rows, read_row, metadata, output_directory, coverage_threshold, output_directory, batch_size,
+                            mnp_cv_threshold, threads, report_style, page_size, page_order, database, verbose)
+        return
+    if pipeline:
+        run_pipeline(rows, read_row, panel_outputs(metadata, output_directory), output_directory, coverage_threshold, mnp_cv_threshold, 
+                    threads, report_style, page_size, page_order, database, verbose)
+        return
     var_data = []
     sheet_cov_data = []
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for ivar_data, cov_data in pool.map(read_row, rows): # map retains the sheet order
+            var_data.append(ivar_data)
+            sheet_cov_data.append(cov_data)
+    samples = [i[0] for i in rows]
+    vlog.logger.info(f"Creating coverage data for {len(samples)} samples and outputting data to {output_directory}.")
+    sample_cov_data = CoverageData.create_sample_coverages(samples, output_directory, sheet_cov_data)
+    for sheet, panel_dir in panel_outputs(metadata, output_directory).items():
+        rendered = RenderHTML.VCFDataHTML(var_data, sheet, None, coverage_threshold, panel_dir, sample_cov_data, mnp_cv_threshold,
+                                            report_style, page_size, page_order, database=database,
+                                            verbose=verbose)
+        rendered.combine_html_plots()
+
+def read_sample_sheet(sample_sheet: str) -> List[List[str]]:
+    """
+    Read and validate the rows of a submission sheet, exiting if a row is malformed or its ivar file or bam
+    is missing, so a bad row is found before any file is parsed
+    """
+    rows = []
     with open(sample_sheet, 'r') as samples_:
-        for i in samples_.readlines():
+        for i in samples_:
+            if not i.strip():
+                continue
             val = i.strip().split("\t")
-            if len(val) != 3:
+            if len(val) not in (3, 4):
                 vlog.logger.critical(val)
                 vlog.logger.critical("Specified sheet does not match needed criteria.")
-                vlog.logger.critical("Sheet should be tab delimited and ordered: sample name, vcf path, bam path")
+                vlog.logger.critical("Sheet should be tab delimited and ordered: sample name, vcf path, bam path, (optional) collection date")
                 exit(-1)
-            ivar_data = ReadIvar(val[1])
-            ivar_data.sample_name = val[0]
-            var_data.append(ivar_data)
-            cov_data = CoverageData.SampleMap(val[0], val[2])
-            cov_data.sample_name = val[0]
-            sheet_cov_data.append(cov_data)
-            samples.append(val[0])
-        
-            #samples_process[val[0]] = (ivar_data, cov_data) # 1: ivardata 2: bam path
-    vlog.logger.info(f"Creating coverage data for {len(samples)} samples and outputting data to {output_directory}.")
-    sample_cov_data = CoverageData.create_sample_coverages(samples, output_directory, sheet_cov_data)
-    rendered = RenderHTML.VCFDataHTML(var_data, metadata, None, coverage_threshold, output_directory, sample_cov_data)
-    rendered.combine_html_plots()
+            if not os.path.isfile(val[1]):
+                vlog.logger.critical(f"Could not find ivar file {val[1]} for sample {val[0]}")
+                exit(-1)
+            bam_error = check_sheet_bam(val[0], val[2])
+            if bam_error is not None:
+                vlog.logger.critical(bam_error)
+                exit(-1)
+            rows.append(val)
+    return rows
+
+def check_sheet_bam(sample_name: str, bam_path: str) -> str:
+    """
+    Return why the bam of a submission sheet row can not be used, None if it can. The bam is
+    either a file, which is indexed if it has no index, or a directory containing the samples bam.
+    """
+    if os.path.isdir(bam_path):
+        if not any(os.path.basename(i).split(".")[0] == sample_name for i in glob.glob(os.path.join(bam_path, "*.bam"))):
+            return f"Could not find a bam for sample {sample_name} in {bam_path}"
+        return None
+    if not os.path.isfile(bam_path):
+        return f"Could not find bam file {bam_path} for sample {sample_name}"
+    if not os.path.isfile(bam_path + ".bai") and shutil.which("samtools") is None:
+        return f"Bam file {bam_path} of sample {sample_name} has no index and samtools is not available to create one"
+    return None
+
+def read_sheet_row(row, read_ivar = ReadIvar):
+    """
+    Parse the ivar file and find the bam (creating its index if needed) of a submission sheet row
+    """
+    sample_name, ivar_path, bam_path = row[:3]
+    ivar_data = read_ivar(ivar_path)
+    ivar_data.sample_name = sample_name
+    if len(row) == 4:
+        ivar_data.collection_date = row[3]
+    cov_data = CoverageData.SampleMap(sample_name, bam_path)
+    cov_data.sample_name = sample_name
+    return ivar_data, cov_data
 
 #Glob directories
-def glob_directories(ivar_directory:str, bam_directory: str, metadata: str, coverage_threshold: int, output_directory: str):
+def glob_directories(ivar_directory:str, bam_directory: str, metadata: Union[str, List[str]], coverage_threshold: int, output_directory: str, mnp_cv_threshold: float = 2.5,
+                    threads: int = DEFAULT_THREADS, report_style: str = "classic", page_size: int = 100, page_order: str = "sheet",
+                    database: str = None, verbose: bool = False, batch_size: int = 0, pipeline: bool = False,
+                    ivar_cache: str = None, ivar_cache_size: int = IvarCache.DEFAULT_CACHE_SIZE, read_ivar = None):
+    """
+    The main function to call in prepareing the samples, with several metadata sheets the
+    samples are read and their depths found once for every sheet
+    read_ivar: the function ivar files are read with, from ivar_reader so several runs can share
+        one ivar cache, it is made from ivar_cache and ivar_cache_size when not given
+    """
+    if read_ivar is None:
+        read_ivar = ivar_reader(ivar_cache, ivar_cache_size)
+    ivar_files = [os.path.join(ivar_directory, i) for i in os.listdir(ivar_directory) if os.path.splitext(i)[-1].lower() == ".tsv"]
+    if batch_size or pipeline:
+        vcf_files = [os.path.join(ivar_directory, i) for i in os.listdir(ivar_directory) if i.lower().endswith((".vcf", ".vcf.gz"))]
+    if batch_size:
+        process_in_batches(ivar_files + vcf_files, partial(read_variant_file, read_ivar=read_ivar), metadata, bam_directory, coverage_threshold, output_directory, 
+                            batch_size, mnp_cv_threshold, threads, report_style, page_size, page_order, database, verbose)
+        return
+    if pipeline:
+        run_pipeline(ivar_files + vcf_files, partial(read_variant_file, read_ivar=read_ivar), panel_outputs(metadata, output_directory), bam_directory, 
+                    coverage_threshold, mnp_cv_threshold, threads, report_style, page_size, page_order, database, verbose)
+        return
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        ivar_data = list(pool.map(read_ivar, ivar_files))
+    # merged multi sample vcfs are read once and split into their samples when rendering
+    ivar_data.extend([ReadVCF(os.path.join(ivar_directory, i)) for i in os.listdir(ivar_directory) 
+                        if i.lower().endswith((".vcf", ".vcf.gz"))])
+    cov_data = None
+    for sheet, panel_dir in panel_outputs(metadata, output_directory).items():
+        vcf_html = VCFDataHTML(ivar_data, sheet, bam_directory, coverage_threshold, panel_dir, cov_data, mnp_cv_thresh=mnp_cv_threshold,
+                                report_style=report_style, page_size=page_size, page_order=page_order, database=database,
+                                verbose=verbose)
+        vcf_html.combine_html_plots()
+        cov_data = vcf_html.cov_info # the depths of the first panel are used by the rest
+
+def read_variant_file(file_path: str, read_ivar = ReadIvar):
+    """
+    Read an ivar tsv or a multi sample vcf
+    """
+    if file_path.lower().endswith((".vcf", ".vcf.gz")):
+        return ReadVCF(file_path)
+    return read_ivar(file_path)
+
+def ivar_reader(ivar_cache: str = None, ivar_cache_size: int = IvarCache.DEFAULT_CACHE_SIZE):
+    """
+    Return the function ivar files are read with, through the parsed ivar cache if a cache directory is given
+    :param ivar_cache: the directory of the parsed ivar cache
+    :param ivar_cache_size: the size cap of the cache in MB
+    """
+    if ivar_cache is None:
+        return ReadIvar
+    return IvarCache.IvarCache(ivar_cache, ivar_cache_size).read
+
+#Bounded memory batches
+def process_in_batches(inputs: list, read_input, metadata: Union[str, List[str]], search_dir: str, coverage_threshold: int, output_directory: str, 
+                        batch_size: int, mnp_cv_threshold: float = 2.5, threads: int = DEFAULT_THREADS, report_style: str = "classic", 
+                        page_size: int = 100, page_order: str = "sheet", database: str = None, verbose: bool = False):
     """
-    The main function to call in prepareing the samples
+    Match the inputs batch_size at a time so the parsed samples, coverage and match data, the
+    bulk of the memory of a run, are bounded by the batch size rather than the number of samples.
+    Each batch is parsed, its coverage found and matched, then its results are spilled to disk
+    and the batch released. The results are saved and the report is rendered from the spilled
+    results a lineage at a time, so this part still grows with the number of samples: one
+    lineage of every sample plus the rendered report of the classic style. With several metadata
+    sheets each batch is matched against every sheet and each sheet has its own spilled results
+    and report.
+    :param inputs: the inputs passed to read_input, e.g. ivar files or sample sheet rows
+    :param read_input: returns a ReadIvar or ReadVCF, or a tuple of a ReadIvar and its SampleMap
+    :param search_dir: the directory searched for bams and where the coverage cache of each batch is kept
     """
-    ivar_data = [ReadIvar(os.path.join(ivar_directory, i)) for i in os.listdir(ivar_directory) if os.path.splitext(i)[-1].lower() == ".tsv"]
-    vcf_html = VCFDataHTML(ivar_data, metadata, bam_directory, coverage_threshold, output_directory)
+    start = datetime.now()
+    panels = panel_outputs(metadata, output_directory)
+    matchers = {sheet: SampleMatcher(sheet, None, mnp_cv_threshold, MatchDiagnostics(verbose)) for sheet in panels}
+    spilled = {sheet: SpilledResults(os.path.join(panels[sheet], SPILL_DIRECTORY), matcher.vcf_metadata.file_name)
+                for sheet, matcher in matchers.items()}
+    n_batches = -(-len(inputs) // batch_size)
+    n_samples = 0
+    for batch_num, batch_start in enumerate(range(0, len(inputs), batch_size), start=1):
+        vlog.logger.info(f"Matching batch {batch_num} of {n_batches}")
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            parsed = list(pool.map(read_input, inputs[batch_start:batch_start + batch_size]))
+        sample_maps = None
+        if parsed and isinstance(parsed[0], tuple):
+            parsed, sample_maps = [i[0] for i in parsed], [i[1] for i in parsed]
+        samples = [view for i in parsed for view in (i.sample_views() if isinstance(i, ReadVCF) else [i])]
+        names = [i.sample_name for i in samples]
+        n_samples += len(names)
+        coverage = CoverageData.create_sample_coverages(names, search_dir, sample_maps, CoverageData.samples_cache_name(names)).samples_coverage
+        for sheet, matcher in matchers.items():
+            matcher.coverage = coverage
+            batch_results = matcher.match(samples)
+            spilled[sheet].add_batch(batch_results)
+            # release the batch before reading the next
+            matcher.coverage, matcher.figure_data, matcher.mnp_calls = None, {}, {}
+            del batch_results
+        del parsed, samples, sample_maps, coverage
+
+    for sheet, matcher in matchers.items():
+        matcher.diagnostics.log_summary()
+        matcher.diagnostics.write_json(os.path.join(panels[sheet], DIAGNOSTICS_FILE))
+        spilled[sheet].save(os.path.join(panels[sheet], RESULTS_FILE), coverage_threshold)
+        if database is not None: # as a single run, not a run per batch
+            store_results(database, spilled[sheet], coverage_threshold, panels[sheet])
+        vcf_html = VCFDataHTML.from_results(spilled[sheet], coverage_threshold, panels[sheet], report_style, page_size, page_order)
+        vcf_html.combine_html_plots()
+        spilled[sheet].cleanup()
+    vlog.logger.info(f"Finished {n_samples} samples in {n_batches} batches in {datetime.now() - start}")
+
+#Append new samples to an existing report
+def append_samples(ivar_directory: str, bam_directory: str, output_directory: str, metadata: str, coverage_threshold: int, 
+                    mnp_cv_threshold: float = 2.5, threads: int = DEFAULT_THREADS, report_style: str = "classic", page_size: int = 100, 
+                    page_order: str = "sheet", database: str = None, verbose: bool = False, ivar_cache: str = None,
+                    ivar_cache_size: int = IvarCache.DEFAULT_CACHE_SIZE):
+    """
+    Match only the samples in the ivar directory that are not in the results saved with an
+    existing report, then add them to the saved results and render the report again.
+    """
+    results_path = os.path.join(output_directory, RESULTS_FILE)
+    if not os.path.isfile(results_path):
+        vlog.logger.critical(f"Could not find saved results {results_path} to append samples to.")
+        exit(-1)
+    prior_results = MatchedResults.load(results_path)
+    if metadata is None:
+        metadata = prior_results.metadata_sheet
+    known_samples = set(prior_results.samples)
+    ivar_files = [os.path.join(ivar_directory, i) for i in os.listdir(ivar_directory) if os.path.splitext(i)[-1].lower() == ".tsv"
+                    and ReadIvar.get_sample_name(i) not in known_samples]
+    vcf_files = [os.path.join(ivar_directory, i) for i in os.listdir(ivar_directory) if i.lower().endswith((".vcf", ".vcf.gz"))]
+    # a multi sample vcf may hold both saved and new samples so only its new sample views are kept
+    vcf_views = [view for i in vcf_files for view in ReadVCF(i).sample_views() if view.sample_name not in known_samples]
+    if not ivar_files and not vcf_views:
+        vlog.logger.info(f"No new samples to add to {results_path}")
+        return
+    vlog.logger.info(f"Appending {len(ivar_files)} ivar files and {len(vcf_views)} vcf samples to the {len(known_samples)} samples in {results_path}")
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        ivar_data = list(pool.map(ivar_reader(ivar_cache, ivar_cache_size), ivar_files))
+    ivar_data.extend(vcf_views)
+    vcf_html = VCFDataHTML(ivar_data, metadata, bam_directory, coverage_threshold, output_directory, mnp_cv_thresh=mnp_cv_threshold,
+                            report_style=report_style, page_size=page_size, page_order=page_order, prior_results=prior_results,
+                            database=database, verbose=verbose)
     vcf_html.combine_html_plots()
 
 #cmd line sample specification
-def wastewater_run(input_directory, metadata, coverage_threshold):
+def wastewater_run(input_directory, metadata, coverage_threshold, mnp_cv_threshold: float = 2.5, threads: int = DEFAULT_THREADS,
+                    report_style: str = "classic", page_size: int = 100, page_order: str = "sheet", database: str = None, verbose: bool = False,
+                    batch_size: int = 0, pipeline: bool = False, ivar_cache: str = None, ivar_cache_size: int = IvarCache.DEFAULT_CACHE_SIZE):
     """
     Run the new vcfparser on the wastewater directories
     """
     start = datetime.now()
+    read_ivar = ivar_reader(ivar_cache, ivar_cache_size) # the cache is opened once for every run
     for i in os.listdir(input_directory):
         variants = os.path.join(input_directory, i, "variants")
         bams = os.path.join(input_directory, i, "bam")
         if os.path.isdir(variants) and os.path.isdir(bams):
             out_dir = os.path.join(input_directory, i)
             try:
-                glob_directories(variants, bams, metadata, coverage_threshold, out_dir)
+                glob_directories(variants, bams, metadata, coverage_threshold, out_dir, mnp_cv_threshold, threads, report_style, 
+                                    page_size, page_order, database, verbose, batch_size, pipeline, read_ivar=read_ivar)
             except RuntimeError:
                 pass
         else:
@@ -76,10 +314,35 @@ def wastewater_run(input_directory, metadata, coverage_threshold):
     end = datetime.now()
     vlog.logger.info(f"Finished: {input_directory} in {end - start}")
 
+#Render saved results
+def render_results(results: str, output_directory: str, coverage_threshold: int, report_style: str = "classic", page_size: int = 100,
+                    page_order: str = "sheet", colour_scale: str = None, excel: bool = False):
+    """
+    Render the results saved by a previous run with a new coverage threshold or style, no ivar
+    files or bams are read.
+    """
+    if os.path.isdir(results):
+        results = os.path.join(results, RESULTS_FILE)
+    if not os.path.isfile(results):
+        vlog.logger.critical(f"Could not find saved results {results} to render.")
+        exit(-1)
+    start = datetime.now()
+    os.makedirs(output_directory, exist_ok=True)
+    saved_results = MatchedResults.load(results)
+    vcf_html = VCFDataHTML.from_results(saved_results, coverage_threshold, output_directory, report_style, page_size, page_order, colour_scale)
+    vcf_html.combine_html_plots()
+    vlog.logger.info(f"Rendered {len(saved_results.samples)} samples from {results} in {datetime.now() - start}")
+    if excel:
+        if report_style != "classic":
+            vlog.logger.warning("The Excel summary is created from the classic report, skipping it.")
+            return
+        create_summary_excel_report(output_directory, output_directory)
+
 def create_summary_excel_report(directory_html, output_path):
     """
     Create a summary report of the html run information output into excel
     """
+    from VCFViz.CreateExcelReports import HTMLToExcel # pandas is only needed for excel output
     vlog.logger.info("Creating Excel summary of HTML information.")
     xx = HTMLToExcel(directory_html, output_path)
     xx.html_dict_to_excel()
@@ -0,0 +1,181 @@
+"""
+An opt-in on disk cache of parsed ivar files, so reruns, re-renders and overlapping runs
+do not parse the same tsvs again.
+
+Each entry is a SharedData block of a samples variants, position sorted typed arrays of
+the numeric columns and the rows as tab delimited text, behind a short json header. Entries are loaded by memory mapping the file, the columns are used in place
+without being copied or parsed and ivar rows are only created for the positions looked up.
+
+Entries are named by a hash of the absolute path, size and modification time of the ivar
+file so a changed file is never read from the cache. Loading an entry updates its
+modification time, when the cache grows past its size cap the least recently used entries
+are removed.
+"""
+
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping
+from functools import cached_property
+import hashlib
+import os
+import threading
+from VCFViz import SharedData
+from VCFViz.VCFToJson import ReadIvar, IvarFields, VariantArray
+from VCFViz.VCFlogging import VCFLogger as vlog
+
+CACHE_MAGIC = b"VCFVIZIV"
+CACHE_VERSION = 1
+ENTRY_SUFFIX = ".ivar"
+DEFAULT_CACHE_SIZE = 1024 # MB
+
+
+class CachedPositions(Mapping):
+    """
+    The position dictionary of a cached sample, ivar rows are only created for the positions looked up
+    """
+    def __init__(self, columns: dict) -> None:
+        self.columns = columns
+        self.found = {}
+
+    def row(self, idx: int) -> IvarFields:
+        offsets = self.columns["row_offsets"]
+        return IvarFields(*bytes(self.columns["rows"][offsets[idx]:offsets[idx + 1]]).decode("utf-8").split("\t"))
+
+    def __getitem__(self, position):
+        rows = self.found.get(position)
+        if rows is not None:
+            return rows
+        try:
+            pos = int(position)
+        except (TypeError, ValueError):
+            raise KeyError(position)
+        positions = self.columns["positions"]
+        start, end = bisect_left(positions, pos), bisect_right(positions, pos)
+        if start == end:
+            raise KeyError(position)
+        rows = self.found[position] = [self.row(i) for i in range(start, end)]
+        return rows
+
+    def __iter__(self):
+        last = None
+        for pos in self.columns["positions"]:
+            if pos != last:
+                yield str(pos)
+                last = pos
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+class CachedIvar:
+    """
+    A samples variants memory mapped from the cache, usable in place of a ReadIvar object
+    """
+    def __init__(self, filename: str, columns: dict) -> None:
+        self.filename = filename
+        self.sample_name = ReadIvar.get_sample_name(filename)
+        self.collection_date = None
+        self.columns = columns
+        self.vcf_info = CachedPositions(columns)
+
+    @cached_property
+    def variant_array(self) -> VariantArray:
+        offsets = self.columns["alt_offsets"]
+        alts = bytes(self.columns["alts"]).decode("utf-8")
+        return VariantArray.from_columns(self.columns["positions"], [alts[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)],
+                                            self.columns["alt_depths"], self.columns["alt_freqs"])
+
+
+class IvarCache:
+    """
+    Read ivar files through the cache, parsing and adding those not in it
+    """
+    def __init__(self, cache_dir: str, max_size: int = DEFAULT_CACHE_SIZE) -> None:
+        """
+        cache_dir: the directory of the cache entries, created if it does not exist
+        max_size: the size cap of the cache in MB
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size * (1 << 20)
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.size = sum(i.stat().st_size for i in self.entries())
+        if self.size > self.max_size: # e.g. the size cap was lowered
+            self.evict()
+        self.hits = 0
+        self.misses = 0
+
+    def entries(self) -> list:
+        with os.scandir(self.cache_dir) as entries:
+            return [i for i in entries if i.name.endswith(ENTRY_SUFFIX) and i.is_file()]
+
+    def entry_path(self, file_name: str) -> str:
+        """
+        The entry of an ivar file, named by its absolute path, size and modification time
+        """
+        abs_path = os.path.abspath(file_name)
+        stat = os.stat(abs_path)
+        key = f"{CACHE_VERSION}\t{abs_path}\t{stat.st_size}\t{stat.st_mtime_ns}"
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ENTRY_SUFFIX)
+
+    def read(self, file_name: str):
+        """
+        Return the cached variants of an ivar file, or parse it and add it to the cache
+        """
+        entry_path = self.entry_path(file_name)
+        cached = self.load(entry_path, file_name)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+        ivar_data = ReadIvar(file_name)
+        self.store(entry_path, ivar_data)
+        return ivar_data
+
+    def load(self, entry_path: str, file_name: str) -> CachedIvar:
+        """
+        Memory map an entry, None is returned if it is missing or can not be used
+        """
+        try:
+            header, columns = SharedData.map_block(entry_path, CACHE_MAGIC)
+            os.utime(entry_path) # most recently used
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            vlog.logger.warning(f"Ignoring ivar cache entry {entry_path}: {err}")
+            return None
+        if header.get("version") != CACHE_VERSION or header.get("file") != os.path.abspath(file_name):
+            vlog.logger.warning(f"Ignoring ivar cache entry {entry_path}: entry of a different version or file")
+            return None
+        return CachedIvar(file_name, columns)
+
+    def store(self, entry_path: str, ivar_data: ReadIvar):
+        """
+        Write the variants of a parsed ivar file to its entry, then evict entries over the size cap
+        """
+        header = {"version": CACHE_VERSION, "file": os.path.abspath(ivar_data.filename)}
+        try:
+            size = SharedData.write_block(entry_path, SharedData.variant_columns([ivar_data]), header, CACHE_MAGIC)
+        except OSError as err:
+            vlog.logger.warning(f"Could not write ivar cache entry {entry_path}: {err}")
+            return
+        with self.lock:
+            self.size += size
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is under its size cap
+        """
+        entries = sorted(self.entries(), key=lambda x: x.stat().st_mtime_ns)
+        self.size = sum(i.stat().st_size for i in entries)
+        for entry in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self.size -= size
+            vlog.logger.debug(f"Evicted ivar cache entry {entry.name}")
@@ -0,0 +1,114 @@
+"""
+Collect why variants of samples did not match the mutations of the metadata sheet. Rather
+than logging every mismatch, each (lineage, mutation, reason) is counted and the first few
+examples kept, then a summary is logged once and the full counts can be written as json.
+Samples without a variant at a mutations position, most of the cells of a run, are counted
+in bulk for each mutation without examples. Logging of every mismatch is still available
+with verbose.
+"""
+
+from collections import Counter
+import json
+from typing import List
+from VCFViz.VCFlogging import VCFLogger as vlog
+
+DIAGNOSTICS_FILE = "VCFViz_diagnostics.json"
+
+# reasons a sample and mutation were not matched, or needed extra work to match
+NO_VARIANT = "no variant at position"
+DELETION_MISMATCH = "deletion mismatch"
+INSERTION_MISMATCH = "insertion mismatch"
+SUBSTITUTION_MISMATCH = "substitution mismatch"
+MNP_BASE_MISMATCH = "mnp first base mismatch"
+MNP_INCOMPLETE = "mnp bases not found"
+MNP_CV_EXCEEDED = "mnp coefficient of variation exceeded"
+MNP_COMBINED = "mnp combined"
+UNSUPPORTED_TYPE = "unsupported mutation type"
+
+
+class MatchDiagnostics:
+    """
+    Counters and sampled examples of each (lineage, mutation, reason), examples are stored as
+    tuples and only formatted when the summary is created.
+    """
+    def __init__(self, verbose: bool = False, max_examples: int = 3) -> None:
+        self.verbose = verbose
+        self.max_examples = max_examples
+        self.counts = Counter()
+        self.examples = {}
+
+    def record(self, lineage: str, mutation: str, reason: str, *example):
+        """
+        Count a diagnostic, the example values are kept for the first max_examples of each key
+        :param example: values describing the occurence, e.g. the sample name and the found allele
+        """
+        key = (lineage, mutation, reason)
+        self.counts[key] += 1
+        if self.counts[key] <= self.max_examples:
+            self.examples.setdefault(key, []).append(example)
+        if self.verbose:
+            vlog.logger.info("%s %s %s: %s", lineage, mutation, reason, example)
+
+    def count(self, lineage: str, mutation: str, reason: str, n: int):
+        """
+        Add n occurences of a diagnostic without examples, for reasons counted in bulk
+        """
+        if n > 0:
+            self.counts[(lineage, mutation, reason)] += n
+
+    def merge(self, other):
+        """
+        Add the counts and examples of other diagnostics to these
+        """
+        self.counts.update(other.counts)
+        for key, examples in other.examples.items():
+            kept = self.examples.setdefault(key, [])
+            kept.extend(examples[:max(self.max_examples - len(kept), 0)])
+
+    def reason_totals(self) -> Counter:
+        totals = Counter()
+        for (_, _, reason), count in self.counts.items():
+            totals[reason] += count
+        return totals
+
+    def summary_table(self, limit: int = 20, exclude: List[str] = (NO_VARIANT,)) -> List[str]:
+        """
+        Return the lines of a table of the totals of each reason followed by the most common
+        (lineage, mutation, reason) keys, reasons in exclude are only shown in the totals.
+        """
+        lines = [f"{'Reason':<40}{'Count':>12}"]
+        lines.extend([f"{reason:<40}{count:>12}" for reason, count in self.reason_totals().most_common()])
+        common = [(key, count) for key, count in self.counts.most_common() if key[2] not in exclude][:limit]
+        if common:
+            lines.append(f"{'Lineage':<16}{'Mutation':<24}{'Reason':<40}{'Count':>12}  Examples")
+            for (lineage, mutation, reason), count in common:
+                examples = "; ".join(" ".join(str(i) for i in example) for example in self.examples.get((lineage, mutation, reason), []))
+                lines.append(f"{lineage:<16}{mutation:<24}{reason:<40}{count:>12}  {examples}")
+        return lines
+
+    def log_summary(self):
+        if not self.counts:
+            return
+        vlog.logger.info("Match diagnostics:\n" + "\n".join(self.summary_table()))
+
+    def to_json(self) -> list:
+        return [{"lineage": lineage, "mutation": mutation, "reason": reason, "count": count,
+                "examples": [list(i) for i in self.examples.get((lineage, mutation, reason), [])]}
+                for (lineage, mutation, reason), count in self.counts.most_common()]
+
+    def write_json(self, file_path: str):
+        with open(file_path, "w") as diagnostics_out:
+            json.dump(self.to_json(), diagnostics_out, indent=1)
+
+    @classmethod
+    def read_json(cls, file_path: str, verbose: bool = False, max_examples: int = 3):
+        """
+        Read diagnostics written with write_json, e.g. to merge those of separate runs
+        """
+        diagnostics = cls(verbose, max_examples)
+        with open(file_path, "r") as diagnostics_in:
+            for entry in json.load(diagnostics_in):
+                key = (entry["lineage"], entry["mutation"], entry["reason"])
+                diagnostics.counts[key] = entry["count"]
+                diagnostics.examples[key] = [tuple(i) for i in entry["examples"]][:max_examples]
+        return diagnostics
@@ -0,0 +1,311 @@
+"""
+Match the variants of samples against the mutations of the metadata sheet. This is the
+in memory api of VCFViz, samples, the metadata sheet and coverage go in and the matched
+results come out without anything being written to disk e.g.
+
+    results = match_samples([ReadIvar(i) for i in ivar_files], "VCFParser.txt", coverage)
+    rows = results.lineage_table("BA.2", 30)
+
+Writing a report or saving the results are separate steps, VCFDataHTML.from_results and
+MatchedResults.save.
+"""
+from collections import Counter
+from typing import NamedTuple, List, Union
+import math
+from VCFViz import CoverageData
+from VCFViz.MatchedResults import MatchedResults
+from VCFViz.MatchDiagnostics import MatchDiagnostics, NO_VARIANT, DELETION_MISMATCH, INSERTION_MISMATCH, SUBSTITUTION_MISMATCH, \
+    MNP_BASE_MISMATCH, MNP_INCOMPLETE, MNP_CV_EXCEEDED, MNP_COMBINED, UNSUPPORTED_TYPE
+from VCFViz.VCFToJson import ReadIvar, ReadVCF, IvarFields
+
+MNP_LINEAGE = "*" # mnps are resolved once for every lineage they are in
+
+class VCFParserRow(NamedTuple):
+        PangoLineage: str
+        NextStrainClade: str 
+        NucName: str
+        AAName: str
+        Key: str
+        SignatureSNV: str 
+        Position: int
+        Type: str
+        Length: str
+        Ref: str
+        Alt: str
+
+
+class DataSheet:
+    """
+    Read in the vcfparser sheet to decide what mutations to index.
+    Columns of used and already know include:
+        - VOC (string)
+        - Position (Int)
+        - Type (Sub, Del, Ins, MNP) Dels and sub, index differently
+        - Ref
+        - Alt
+    The sheet is tab delimited
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.voc_info = self.group_voc_info()
+
+    def group_voc_info(self):
+        """
+        From the vcfparser sheet file group the needed data
+        """    
+        voc_info = {}
+        with open(self.file_name, 'r') as metadata:
+            lines = metadata.readlines()[1:] # header fields stored in named tuple
+            for line in lines:
+                line = line.strip().split("\t") # split on tab delimiter remove new lines
+                voc = line[0]
+                voc_metadata = VCFParserRow(*line[1:])
+                if voc_info.get(voc) is None:
+                    voc_info[voc] = {}
+                
+                voc_info[voc][f"{voc_metadata.Ref}{voc_metadata.Position}{voc_metadata.Alt}"] = voc_metadata
+        return voc_info
+
+class PlotData(NamedTuple):
+    metadata: VCFParserRow
+    ivar_row: IvarFields
+    sample_name: str
+    sample_depth: int = None
+
+
+class SampleMatcher:
+    """
+    Match samples against a metadata sheet, the sheet is read once so a matcher can be
+    reused for every batch of samples.
+    """
+    def __init__(self, vcf_parser_sheet: Union[str, DataSheet], coverage, mnp_cv_thresh: float = 2.5, 
+                diagnostics: MatchDiagnostics = None) -> None:
+        """
+        vcf_parser_sheet: the metadata sheet or an already read DataSheet
+        coverage: a CoverageStore or SamplesCoverage with the depths of the samples to be matched
+        mnp_cv_thresh: the maximum coefficient of variation (%) of depth and alt frequency for MNP bases to be combined
+        diagnostics: collects the reasons samples did not match, a new MatchDiagnostics is used if not given
+        """
+        self.diagnostics = diagnostics if diagnostics is not None else MatchDiagnostics()
+        self.vcf_metadata = vcf_parser_sheet if isinstance(vcf_parser_sheet, DataSheet) else DataSheet(vcf_parser_sheet)
+        self.coverage = getattr(coverage, "samples_coverage", coverage)
+        self.mnp_cv_thresh = mnp_cv_thresh
+        self.mnp_calls = {}
+        self.figure_data = {}
+        self.samples_checked = 0 # samples checked since the NO_VARIANT counts were last added to the diagnostics
+        self.variants_found = Counter() # (lineage, mutation): samples of those with a variant at its position
+
+    def match(self, ivar_data: List[ReadIvar]) -> MatchedResults:
+        """
+        Match the samples, in the order given, and return their results
+        """
+        self.mnp_calls = self.resolve_mnps(ivar_data)
+        self.figure_data = {}
+        for data in ivar_data:
+            # modifies figure data obj in place, adding in data for figures
+            self.figure_data = self.initialize_voc_tables(data, self.figure_data)
+        return self.results(ivar_data)
+
+    def add_sample(self, sample: ReadIvar):
+        """
+        Match a single sample, adding it to the figure data so samples can be matched as soon
+        as they are read. The depths of the sample must already be in the coverage.
+        """
+        self.mnp_calls.update(self.resolve_mnps([sample]))
+        self.figure_data = self.initialize_voc_tables(sample, self.figure_data)
+
+    def results(self, ivar_data: List[ReadIvar]) -> MatchedResults:
+        """
+        The results of the matched samples, in the order given, with their coverage QC
+        """
+        self.count_no_variants()
+        sample_qc = getattr(self.coverage, "sample_qc", None)
+        return MatchedResults.from_figure_data(self.figure_data, ivar_data, self.vcf_metadata.file_name,
+                                                [sample_qc(i.sample_name) for i in ivar_data] if sample_qc is not None else None)
+
+    def count_no_variants(self):
+        """
+        Add the samples without a variant at the position of each mutation to the diagnostics in
+        bulk, as the checked samples less those with a variant, rather than as a record per sample
+        and mutation. With verbose every occurence has already been recorded and logged.
+        """
+        if not self.diagnostics.verbose:
+            for key, mutations in self.vcf_metadata.voc_info.items():
+                for voc in mutations:
+                    self.diagnostics.count(key, voc, NO_VARIANT, self.samples_checked - self.variants_found[(key, voc)])
+        self.samples_checked = 0
+        self.variants_found.clear()
+
+    def initialize_voc_tables(self, datafile, html_plots: dict):
+        """
+        From the vcf metadata initialize a dictionary for each voc that can show a queried postion,
+        and can be grabbed from the vcf_data
+
+        TODO: methods can be divided and mutations cleaned with gaurd statements
+        """
+        self.samples_checked += 1
+        for key in self.vcf_metadata.voc_info.keys():
+            if html_plots.get(key) is None:
+                html_plots[key] = {}
+
+            for voc in self.vcf_metadata.voc_info[key]:
+                #TODO double value addition is probably happening here
+                pos = "".join([i for i in voc if i.isdigit()])
+                if html_plots[key].get(voc) is None:
+                    html_plots[key][voc] = []
+                ivar_data = datafile.vcf_info.get(pos)
+                sample_name = datafile.sample_name
+                # add in coverage check here
+                depth = self.coverage.depth(datafile.sample_name, self.vcf_metadata.voc_info[key][voc].Position)
+                empty_data = PlotData(self.vcf_metadata.voc_info[key][voc], None, sample_name, int(depth))
+
+                if ivar_data is None:
+                    if self.diagnostics.verbose: # otherwise counted in bulk by count_no_variants
+                        self.diagnostics.record(key, voc, NO_VARIANT, sample_name)
+                    html_plots[key][voc].append(empty_data)
+                else:
+                    self.variants_found[(key, voc)] += 1
+                    start_len = len(html_plots[key][voc])
+                    for i in ivar_data:
+                        ret_val = self.append_ivar_info(html_plots, i, key, voc, datafile)
+                    if not ret_val and len(html_plots[key][voc]) == start_len:
+                        html_plots[key][voc].append(empty_data) # add empty value if data could not be found
+        return html_plots
+    
+    def append_ivar_info(self, html_plots_obj: dict, ivar_data_val, key_val, voic, datafile):
+        """
+        As ivar data contains a list of values, a for loop is required to run through the data 
+        of tuples to identify other postitions. No return value is specified as the dictionary will be mutatated in place
+        """
+        
+        depth = self.coverage.depth(datafile.sample_name, self.vcf_metadata.voc_info[key_val][voic].Position)
+        plot_data = PlotData(self.vcf_metadata.voc_info[key_val][voic], ivar_data_val, datafile.sample_name, int(depth))
+        vcf_data_meta = self.vcf_metadata.voc_info[key_val][voic]
+        # to compare indels, vcf parser sheet places ref at front
+        if vcf_data_meta.Type != "Sub":
+            if vcf_data_meta.Type == "Del":
+                # splitting string to rwmove first char as in vcfparser
+                # we include the ref codon and ivar includes a starting -
+                ivar_del = ivar_data_val.ALT[1:] 
+                meta_del = vcf_data_meta.Ref[1:]
+                test = ivar_del == meta_del
+                if not test:
+                    self.diagnostics.record(key_val, voic, DELETION_MISMATCH, datafile.sample_name, ivar_data_val.ALT)
+                    return False
+                else:
+                    html_plots_obj[key_val][voic].append(plot_data)
+            elif vcf_data_meta.Type == "Ins":
+                ivar_ins = ivar_data_val.ALT[1:]
+                meta_ins = vcf_data_meta.Alt[1:]
+                test = ivar_ins == meta_ins
+                if not test:
+                    self.diagnostics.record(key_val, voic, INSERTION_MISMATCH, datafile.sample_name, ivar_data_val.ALT)
+                    return False
+                else:
+                    html_plots_obj[key_val][voic].append(plot_data)
+            elif vcf_data_meta.Type == "Mnp":
+                if ivar_data_val.ALT != vcf_data_meta.Alt[0]:
+                    self.diagnostics.record(key_val, voic, MNP_BASE_MISMATCH, datafile.sample_name, ivar_data_val.ALT)
+                    return False
+                # MNPs are resolved for all samples up front in resolve_mnps
+                alt_avg = self.mnp_calls.get((datafile.sample_name, vcf_data_meta.Position, vcf_data_meta.Ref, vcf_data_meta.Alt))
+                if alt_avg is None:
+                    return False
+                #Change the ivar row in the data to show the average for the mnps
+                plot_data = plot_data._replace(ivar_row = plot_data.ivar_row._replace(ALT_FREQ = alt_avg, 
+                                                ALT = vcf_data_meta.Alt, REF = vcf_data_meta.Ref))
+                html_plots_obj[key_val][voic].append(plot_data)
+
+            else:
+                self.diagnostics.record(key_val, voic, UNSUPPORTED_TYPE, datafile.sample_name, vcf_data_meta.Type)
+                return False
+        else:
+            test_alt = vcf_data_meta.Alt == ivar_data_val.ALT
+            test_ref = vcf_data_meta.Ref == ivar_data_val.REF
+            query_combo = ivar_data_val.REF + str(ivar_data_val.POS) + ivar_data_val.ALT
+            if test_alt and test_ref and self.vcf_metadata.voc_info[key_val].get(query_combo) is not None:
+                html_plots_obj[key_val][voic].append(plot_data)
+            else:
+                self.diagnostics.record(key_val, voic, SUBSTITUTION_MISMATCH, datafile.sample_name, 
+                                        ivar_data_val.REF + str(ivar_data_val.POS) + ivar_data_val.ALT)
+                return False
+
+    def resolve_mnps(self, samples: List[ReadIvar]) -> dict:
+        """
+        Resolve every MNP in the metadata sheet against every sample in one batch. ivar reports
+        the bases of an MNP individually so each base is looked up in the samples position sorted
+        variant array, then the depths and alt frequencies of all candidates are checked at once
+        to make sure the bases occur together.
+
+        Returns a dictionary of (sample name, position, ref, alt) to the averaged alt frequency
+        for each MNP that could be combined.
+        """
+        mnps = {(row.Position, row.Ref, row.Alt) for voc in self.vcf_metadata.voc_info.values()
+                    for row in voc.values() if row.Type == "Mnp"}
+        candidates = []
+        depth_rows = []
+        freq_rows = []
+        for sample in samples:
+            variants = sample.variant_array
+            for mnp in mnps:
+                indices = variants.find_run(int(mnp[0]), mnp[2])
+                if indices is None:
+                    if variants.find(int(mnp[0]), mnp[2][0]) != -1: # only the bases of a partly found mnp are of interest
+                        self.diagnostics.record(MNP_LINEAGE, f"{mnp[1]}{mnp[0]}{mnp[2]}", MNP_INCOMPLETE, sample.sample_name)
+                    continue
+                candidates.append((sample.sample_name, *mnp))
+                depth_rows.append([variants.alt_depths[i] for i in indices])
+                freq_rows.append([variants.alt_freqs[i] for i in indices])
+
+        # CV thresholds are set arbitralily, and should reflect the depth
+        # NOTE: this is based on my faith and not empircical measures
+        depths_cv = self.coefficients_of_variation(depth_rows)
+        alt_cv = self.coefficients_of_variation(freq_rows)
+        mnp_calls = {}
+        for candidate, freqs, d_cv, a_cv in zip(candidates, freq_rows, depths_cv, alt_cv):
+            mnp_key = f"{candidate[2]}{candidate[1]}{candidate[3]}"
+            if d_cv < self.mnp_cv_thresh and a_cv < self.mnp_cv_thresh:
+                self.diagnostics.record(MNP_LINEAGE, mnp_key, MNP_COMBINED, candidate[0])
+                mnp_calls[candidate] = sum(freqs) / len(freqs)
+            else:
+                self.diagnostics.record(MNP_LINEAGE, mnp_key, MNP_CV_EXCEEDED, candidate[0], round(d_cv, 2), round(a_cv, 2))
+        return mnp_calls
+
+    @staticmethod
+    def coefficients_of_variation(rows: List[List[float]]) -> List[float]:
+        """
+        Calculate the population coefficient of variation (%) of each row, rows with a mean
+        of zero are given an infinite coefficient of variation.
+        """
+        means = [sum(row) / len(row) for row in rows]
+        stdevs = [math.sqrt(sum((i - mean) ** 2 for i in row) / len(row)) for row, mean in zip(rows, means)]
+        return [(stdev / mean) * 100 if mean else math.inf for stdev, mean in zip(stdevs, means)]
+
+    def check_alt_prescence(self, combo, voc_key):
+        """
+        check for prescence of alternate combo in vcfparser data
+        """
+        val = self.vcf_metadata.voc_info[voc_key].get(combo)
+        if val is not None:
+            return True
+        return False
+
+
+
+def match_samples(ivar_data: List[Union[ReadIvar, ReadVCF]], vcf_parser_sheet: Union[str, DataSheet], coverage = None,
+                search_dir: str = None, mnp_cv_thresh: float = 2.5, diagnostics: MatchDiagnostics = None) -> MatchedResults:
+    """
+    Match samples against the metadata sheet and return the results, nothing is written to disk
+    apart from the coverage cache when coverage has to be calculated.
+    :param ivar_data: ReadIvar objects or multi sample ReadVCF objects, which are split into a view per sample
+    :param vcf_parser_sheet: the metadata sheet or an already read DataSheet
+    :param coverage: a CoverageStore or SamplesCoverage of the samples, calculated from the bams in search_dir if not given
+    :param search_dir: the directory of the samples bams, only used when coverage is not given
+    :param mnp_cv_thresh: the maximum coefficient of variation (%) of depth and alt frequency for MNP bases to be combined
+    :param diagnostics: collects the reasons samples did not match
+    """
+    samples = [view for i in ivar_data for view in (i.sample_views() if isinstance(i, ReadVCF) else [i])]
+    if coverage is None:
+        coverage = CoverageData.create_sample_coverages([i.sample_name for i in samples], search_dir)
+    return SampleMatcher(vcf_parser_sheet, coverage, mnp_cv_thresh, diagnostics).match(samples)
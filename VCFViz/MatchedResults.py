@@ -0,0 +1,419 @@
+"""
+Hold the matched variant data of every sample against the metadata sheet as
+compact arrays, one mutation by sample matrix per lineage. The matrices do not
+depend on the coverage threshold, the status shown in a cell (alt frequency,
+low coverage, WT etc.) is decided when rendering so the same results can be
+rendered with different thresholds.
+"""
+
+from array import array
+from collections.abc import Mapping
+from datetime import datetime
+import json
+import math
+import os
+import shutil
+import statistics
+import sys
+import zipfile
+from typing import NamedTuple, List
+from VCFViz.CoverageData import SampleQC, QC_LEVELS
+
+NOT_MATCHED = math.nan # alt frequency of a cell without a matched variant
+RESULTS_FILE = "VCFViz_results.zip" # saved alongside the report
+RESULTS_VERSION = 1
+# per sample statistics of a lineage, selected statistics only use the mutations marked as signature snvs in the sheet
+STAT_ROWS = ("Mean alt freq", "Median alt freq", "Covered mean alt freq",
+            "Selected mean alt freq", "Selected median alt freq", "Selected covered mean alt freq")
+# coverage QC of each sample shown above the mutations of every lineage, the panel row is the fraction of
+# the positions of the metadata sheet with a depth below the coverage threshold
+QC_ROWS = ("Mean depth", *[f"Breadth {i}x" for i in QC_LEVELS], "Panel below threshold")
+
+
+class Mutation(NamedTuple):
+    key: str
+    NucName: str
+    AAName: str
+    Position: int
+    Type: str
+    Ref: str
+    Alt: str
+    SignatureSNV: str
+
+
+def cell_status(alt_freq: float, depth: int, alt_flag: int, cov_thresh: int) -> str:
+    """
+    Return the label of a cell as shown in the heatmaps
+    :param alt_freq: the matched alt frequency or NOT_MATCHED
+    :param depth: the depth of the sample at the mutations position
+    :param alt_flag: 1 if the sample has a different alternate allele at the position
+    :param cov_thresh: the minimum depth of coverage for allele prescence
+    """
+    if not math.isnan(alt_freq):
+        if depth >= cov_thresh:
+            return str(round(alt_freq, 3))
+        return "LC"
+    #TODO make logic prepared for mixture of wildtype and alternate
+    #TODO need to add in flag for reversions to show up
+    empt_flag = "ALT" if alt_flag else "WT"
+    if depth == 0:
+        return "NC"
+    elif depth <= cov_thresh:
+        return f"{empt_flag}_LC"
+    return empt_flag
+
+
+class LineageResults:
+    """
+    The matched data of a single lineage, cells are stored row major with a row per
+    mutation and a column per sample.
+    """
+    __slots__ = ["mutations", "n_samples", "alt_freqs", "depths", "alt_flags", "stats_cache"]
+
+    def __init__(self, mutations: List[Mutation], n_samples: int, alt_freqs: array = None, 
+                depths: array = None, alt_flags: array = None) -> None:
+        self.mutations = mutations
+        self.n_samples = n_samples
+        n_cells = len(mutations) * n_samples
+        self.alt_freqs = alt_freqs if alt_freqs is not None else array("d", [NOT_MATCHED]) * n_cells
+        self.depths = depths if depths is not None else array("I", bytes(array("I").itemsize * n_cells))
+        self.alt_flags = alt_flags if alt_flags is not None else array("B", bytes(n_cells))
+        self.stats_cache = {} # coverage threshold to the statistics of each sample
+
+    def cell(self, mutation_idx: int, sample_idx: int) -> int:
+        return mutation_idx * self.n_samples + sample_idx
+
+    def status(self, mutation_idx: int, sample_idx: int, cov_thresh: int) -> str:
+        idx = self.cell(mutation_idx, sample_idx)
+        return cell_status(self.alt_freqs[idx], self.depths[idx], self.alt_flags[idx], cov_thresh)
+
+    def stats(self, cov_thresh: int) -> dict:
+        """
+        Return the STAT_ROWS of every sample as arrays. Sums are accumulated a mutation row at a
+        time across all samples from the row major matrices, medians from the transposed rows.
+        Unmatched mutations count as an alt frequency of 0 and covered statistics only use
+        mutations with a depth of at least the coverage threshold, statistics without any
+        mutations to use are nan. Statistics are cached by coverage threshold and saved with
+        the results.
+        """
+        stats = self.stats_cache.get(cov_thresh)
+        if stats is not None:
+            return stats
+        stats = {}
+        n_samples = self.n_samples
+        selected_rows = [idx for idx, i in enumerate(self.mutations) if str(i.SignatureSNV).strip().lower() == "true"]
+        min_depth = max(cov_thresh, 1)
+        for names, rows in ((STAT_ROWS[:3], range(len(self.mutations))), (STAT_ROWS[3:], selected_rows)):
+            sums, covered_sums, covered_counts = [0] * n_samples, [0] * n_samples, [0] * n_samples
+            freq_rows = []
+            for m_idx in rows:
+                freqs = [0.0 if i != i else i for i in self.alt_freqs[m_idx * n_samples:(m_idx + 1) * n_samples]] # nan is unmatched
+                covered = [i >= min_depth for i in self.depths[m_idx * n_samples:(m_idx + 1) * n_samples]]
+                sums = [i + j for i, j in zip(sums, freqs)]
+                covered_sums = [i + j if k else i for i, j, k in zip(covered_sums, freqs, covered)]
+                covered_counts = [i + k for i, k in zip(covered_counts, covered)]
+                freq_rows.append(freqs)
+            n_rows = len(freq_rows)
+            stats[names[0]] = array("d", [i / n_rows for i in sums] if n_rows else [NOT_MATCHED] * n_samples)
+            stats[names[1]] = array("d", [statistics.median(i) for i in zip(*freq_rows)] if n_rows else [NOT_MATCHED] * n_samples)
+            stats[names[2]] = array("d", [i / j if j else NOT_MATCHED for i, j in zip(covered_sums, covered_counts)])
+        stats = {i: stats[i] for i in STAT_ROWS}
+        self.stats_cache[cov_thresh] = stats
+        return stats
+
+    def columns(self) -> dict:
+        return {"alt_freqs": self.alt_freqs, "depths": self.depths, "alt_flags": self.alt_flags}
+
+    def merge(self, other):
+        """
+        Append the sample columns of another lineages results, the mutations of the
+        other results are matched by their key.
+        """
+        return LineageResults.concat([self, other])
+
+    @staticmethod
+    def concat(parts: list):
+        """
+        Join the sample columns of the results of a lineage in order, the mutations of the
+        later parts are matched to the first by their key.
+        """
+        first = parts[0]
+        keys = {i.key for i in first.mutations}
+        part_rows = []
+        for part in parts:
+            rows = {mutation.key: idx for idx, mutation in enumerate(part.mutations)}
+            if set(rows) != keys:
+                raise ValueError("Mutations of the results being merged do not match, were they created from the same metadata sheet?")
+            part_rows.append(rows)
+        merged = LineageResults(first.mutations, sum(i.n_samples for i in parts), *[array(i.typecode) for i in first.columns().values()])
+        for mutation in first.mutations:
+            for part, rows in zip(parts, part_rows):
+                m_idx = rows[mutation.key]
+                for key, column in merged.columns().items():
+                    column.extend(part.columns()[key][m_idx * part.n_samples:(m_idx + 1) * part.n_samples])
+        # the statistics are per sample so those of thresholds every part has are joined rather than found again
+        for cov_thresh in set.intersection(*[set(i.stats_cache) for i in parts]):
+            merged.stats_cache[cov_thresh] = {stat: array("d", [value for i in parts for value in i.stats_cache[cov_thresh][stat]])
+                                                for stat in STAT_ROWS}
+        return merged
+
+
+class MatchedResults:
+    """
+    The matched results of all samples. Lineages are kept in the order of the metadata
+    sheet and samples in the order they were provided.
+    """
+    def __init__(self, samples: List[str], lineages: dict = None, metadata_sheet: str = None, sample_dates: List[str] = None,
+                created: str = None, sample_qc: List[SampleQC] = None) -> None:
+        self.samples = samples
+        self.sample_dates = sample_dates if sample_dates is not None else [""] * len(samples) # YYYY-MM-DD or empty
+        self.sample_qc = sample_qc if sample_qc is not None else [None] * len(samples) # None without depths e.g. older results
+        self.lineages = lineages if lineages is not None else {}
+        self.metadata_sheet = metadata_sheet
+        self.created = created # when the results were first saved
+        self.panel_cache = {} # coverage threshold to the fraction of panel positions below it of each sample
+
+    @classmethod
+    def from_figure_data(cls, figure_data: dict, samples: list, metadata_sheet: str = None, sample_qc: List[SampleQC] = None):
+        """
+        Create the result matrices from the figure data of VCFDataHTML.
+        :param figure_data: lineage to mutation key to a list of PlotData
+        :param samples: the ReadIvar like objects in column order
+        :param sample_qc: the coverage QC of the samples in column order
+        """
+        sample_idx = {sample.sample_name: idx for idx, sample in enumerate(samples)}
+        results = cls([i.sample_name for i in samples], metadata_sheet=metadata_sheet, 
+                        sample_dates=[getattr(i, "collection_date", None) or "" for i in samples], sample_qc=sample_qc)
+        for lineage, voic_data in figure_data.items():
+            mutations = []
+            for voc, plots in voic_data.items():
+                meta = plots[0].metadata
+                mutations.append(Mutation(voc, meta.NucName, meta.AAName, int(meta.Position), meta.Type, 
+                                            meta.Ref, meta.Alt, meta.SignatureSNV))
+            lineage_results = LineageResults(mutations, len(samples))
+            for m_idx, plots in enumerate(voic_data.values()):
+                seen = set()
+                for plot in plots:
+                    if plot.sample_name in seen: # only the first match of a sample is shown
+                        continue
+                    seen.add(plot.sample_name)
+                    idx = lineage_results.cell(m_idx, sample_idx[plot.sample_name])
+                    lineage_results.depths[idx] = int(plot.sample_depth)
+                    if plot.ivar_row is not None:
+                        lineage_results.alt_freqs[idx] = float(plot.ivar_row.ALT_FREQ)
+                    elif samples[sample_idx[plot.sample_name]].vcf_info.get(plot.metadata.Position) is not None:
+                        lineage_results.alt_flags[idx] = 1
+            results.lineages[lineage] = lineage_results
+        return results
+
+    def has_qc(self) -> bool:
+        return any(i is not None for i in self.sample_qc)
+
+    def panel_below(self, cov_thresh: int) -> array:
+        """
+        The fraction of the unique positions of the metadata sheet with a depth below the coverage
+        threshold in each sample, the depths of a position are taken from the first lineage it is in
+        """
+        below = self.panel_cache.get(cov_thresh)
+        if below is not None:
+            return below
+        counts = [0] * len(self.samples)
+        seen = set()
+        for lineage_results in self.lineages.values():
+            for m_idx, mutation in enumerate(lineage_results.mutations):
+                if mutation.Position in seen:
+                    continue
+                seen.add(mutation.Position)
+                start = lineage_results.cell(m_idx, 0)
+                for s_idx, depth in enumerate(lineage_results.depths[start:start + lineage_results.n_samples]):
+                    if depth < cov_thresh:
+                        counts[s_idx] += 1
+        below = self.panel_cache[cov_thresh] = array("d", [i / len(seen) if seen else NOT_MATCHED for i in counts])
+        return below
+
+    def qc_rows(self, cov_thresh: int) -> List[List[str]]:
+        """
+        Return the QC_ROWS of every sample as formatted strings, NA for samples without QC
+        """
+        values = [[] for _ in QC_ROWS]
+        for s_idx, qc in enumerate(self.sample_qc):
+            if qc is None:
+                for row in values[:-1]:
+                    row.append("NA")
+            else:
+                values[0].append(str(round(qc.mean_depth, 1)))
+                for row, breadth in zip(values[1:-1], qc.breadth):
+                    row.append(str(round(breadth, 3)))
+            panel = self.panel_below(cov_thresh)[s_idx]
+            values[-1].append("NA" if math.isnan(panel) else str(round(panel, 3)))
+        return [[name, *row] for name, row in zip(QC_ROWS, values)]
+
+    def lineage_table(self, lineage: str, cov_thresh: int) -> List[List[str]]:
+        """
+        Return the heatmap of a lineage as rows, a header row of the samples followed by the
+        QC_ROWS when the results have coverage QC, a row of cell statuses for each mutation
+        and then each statistic in STAT_ROWS.
+        """
+        lineage_results = self.lineages[lineage]
+        table = [["NucName+AAName", *self.samples]]
+        if self.has_qc():
+            table.extend(self.qc_rows(cov_thresh))
+        for m_idx, mutation in enumerate(lineage_results.mutations):
+            table.append([f"{mutation.AAName}|{mutation.NucName}", 
+                            *[lineage_results.status(m_idx, s_idx, cov_thresh) for s_idx in range(len(self.samples))]])
+        for stat, values in lineage_results.stats(cov_thresh).items():
+            table.append([stat, *["NA" if math.isnan(i) else str(round(i, 3)) for i in values]])
+        return table
+
+    def merge(self, other):
+        """
+        Create new results with the samples of other results added after these samples
+        """
+        return MatchedResults.concat([self, other])
+
+    @staticmethod
+    def concat(parts: list):
+        """
+        Join the samples of results matched separately against the same metadata sheet, in order
+        """
+        lineages = list(parts[0].lineages)
+        if any(list(i.lineages) != lineages for i in parts[1:]):
+            raise ValueError("Lineages of the results being merged do not match, were they created from the same metadata sheet?")
+        return MatchedResults([sample for i in parts for sample in i.samples],
+                                {key: LineageResults.concat([i.lineages[key] for i in parts]) for key in lineages},
+                                parts[0].metadata_sheet, [date for i in parts for date in i.sample_dates], parts[0].created,
+                                [qc for i in parts for qc in i.sample_qc])
+
+    def save(self, file_path: str, cov_thresh: int = None):
+        """
+        Save the results as a zip of a json description and the raw little endian arrays
+        of each lineage, with the statistics of each lineage found so far.
+        :param cov_thresh: also find and save the statistics of this coverage threshold
+        """
+        if self.created is None:
+            self.created = str(datetime.now())
+        description = {"version": RESULTS_VERSION, "created": self.created, "metadata_sheet": self.metadata_sheet,
+                        "samples": self.samples, "sample_dates": self.sample_dates, "sample_qc": self.sample_qc, "lineages": []}
+        with zipfile.ZipFile(file_path, "w", compression=zipfile.ZIP_DEFLATED) as results_out:
+            for idx, (lineage, lineage_results) in enumerate(self.lineages.items()): # a lineage at a time for spilled results
+                if cov_thresh is not None:
+                    lineage_results.stats(cov_thresh)
+                description["lineages"].append({"name": lineage, "mutations": lineage_results.mutations,
+                                                "stats": list(lineage_results.stats_cache)})
+                columns = {**lineage_results.columns(), **{f"stats_{thresh}": array("d", [value for stat in STAT_ROWS for value in stats[stat]])
+                                                            for thresh, stats in lineage_results.stats_cache.items()}}
+                for key, column in columns.items():
+                    if sys.byteorder != "little":
+                        column = array(column.typecode, column)
+                        column.byteswap()
+                    results_out.writestr(f"{idx}/{key}", column.tobytes())
+            results_out.writestr("results.json", json.dumps(description))
+
+    @classmethod
+    def load(cls, file_path: str, lineages: List[str] = None):
+        """
+        Load saved results
+        :param file_path: the saved results file
+        :param lineages: only load these lineages, all are loaded if not specified
+        """
+        with zipfile.ZipFile(file_path, "r") as results_in:
+            description = json.loads(results_in.read("results.json"))
+            if description["version"] != RESULTS_VERSION:
+                raise ValueError(f"Unsupported results version {description['version']} in {file_path}")
+            sample_qc = [None if i is None else SampleQC(i[0], tuple(i[1])) for i in description.get("sample_qc", [])] # not in older results
+            results = MatchedResults(description["samples"], metadata_sheet=description["metadata_sheet"], 
+                                    sample_dates=description["sample_dates"], created=description["created"], sample_qc=sample_qc or None)
+            for idx, lineage in enumerate(description["lineages"]):
+                if lineages is not None and lineage["name"] not in lineages:
+                    continue
+                lineage_results = LineageResults([Mutation(*i) for i in lineage["mutations"]], len(results.samples))
+                for key, column in lineage_results.columns().items():
+                    loaded = array(column.typecode)
+                    loaded.frombytes(results_in.read(f"{idx}/{key}"))
+                    if sys.byteorder != "little":
+                        loaded.byteswap()
+                    setattr(lineage_results, key, loaded)
+                for thresh in lineage.get("stats", []): # not in older results
+                    loaded = array("d")
+                    loaded.frombytes(results_in.read(f"{idx}/stats_{thresh}"))
+                    if sys.byteorder != "little":
+                        loaded.byteswap()
+                    n_samples = len(results.samples)
+                    lineage_results.stats_cache[thresh] = {stat: loaded[s_idx * n_samples:(s_idx + 1) * n_samples]
+                                                            for s_idx, stat in enumerate(STAT_ROWS)}
+                results.lineages[lineage["name"]] = lineage_results
+        return results
+
+
+class SpilledLineages(Mapping):
+    """
+    The lineages of spilled results, a lineage is read from every batch and joined when
+    it is accessed so only one lineage is in memory at a time. The memory of a lineage is
+    still that of its mutations by all samples, around 13 bytes per cell.
+    """
+    def __init__(self, batch_files: List[str], lineages: List[str]) -> None:
+        self.batch_files = batch_files
+        self.lineages = lineages
+
+    def __getitem__(self, lineage: str) -> LineageResults:
+        if lineage not in self.lineages:
+            raise KeyError(lineage)
+        return LineageResults.concat([MatchedResults.load(i, [lineage]).lineages[lineage] for i in self.batch_files])
+
+    def __iter__(self):
+        return iter(self.lineages)
+
+    def __len__(self) -> int:
+        return len(self.lineages)
+
+
+class SpilledResults(MatchedResults):
+    """
+    Results matched in batches, each batch is saved to the spill directory as it is added
+    and the samples of all batches are read back a lineage at a time. Can be rendered and
+    saved like results held in memory.
+    """
+    def __init__(self, spill_dir: str, metadata_sheet: str = None) -> None:
+        super().__init__([], SpilledLineages([], []), metadata_sheet)
+        self.spill_dir = spill_dir
+        os.makedirs(spill_dir, exist_ok=True)
+
+    def add_batch(self, results: MatchedResults):
+        """
+        Save the results of a batch to the spill directory, after which the batch can be released
+        """
+        if self.lineages.batch_files and list(results.lineages) != self.lineages.lineages:
+            raise ValueError("Lineages of the batch do not match, were they created from the same metadata sheet?")
+        batch_file = os.path.join(self.spill_dir, f"batch_{len(self.lineages.batch_files)}.zip")
+        results.save(batch_file)
+        self.lineages.batch_files.append(batch_file)
+        self.lineages.lineages = list(results.lineages)
+        self.samples.extend(results.samples)
+        self.sample_dates.extend(results.sample_dates)
+        self.sample_qc.extend(results.sample_qc)
+        self.panel_cache = {}
+
+    def merge(self, other):
+        """
+        Add the samples of other results after these samples. Unlike results held in memory the
+        results are merged in place, the batches of other spilled results are added without being
+        copied so they must not be cleaned up before these results. Returns these results.
+        """
+        if not isinstance(other, SpilledResults):
+            self.add_batch(other)
+            return self
+        if self.lineages.batch_files and other.lineages.batch_files and other.lineages.lineages != self.lineages.lineages:
+            raise ValueError("Lineages of the results being merged do not match, were they created from the same metadata sheet?")
+        self.lineages.batch_files.extend(other.lineages.batch_files)
+        self.lineages.lineages = self.lineages.lineages or other.lineages.lineages
+        self.samples.extend(other.samples)
+        self.sample_dates.extend(other.sample_dates)
+        self.sample_qc.extend(other.sample_qc)
+        self.panel_cache = {}
+        return self
+
+    def cleanup(self):
+        """
+        Remove the spilled batches
+        """
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
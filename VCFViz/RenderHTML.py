@@ -9,69 +9,21 @@ from collections import namedtuple
 from dataclasses import dataclass
 from datetime import datetime
 import glob
-from typing import NamedTuple, List
+from typing import NamedTuple, List, Union
 import os
+import math
 from VCFViz import CoverageData
+from VCFViz import DataReport
+from VCFViz.MatchedResults import MatchedResults, LineageResults, RESULTS_FILE
+from VCFViz.ResultsWarehouse import store_results
+from VCFViz.MatchDiagnostics import MatchDiagnostics, DIAGNOSTICS_FILE
+from VCFViz.MatchSamples import DataSheet, PlotData, SampleMatcher, VCFParserRow
 from VCFViz.VCFToJson import ReadIvar, ReadVCF, IvarFields
 from VCFViz.VCFlogging import VCFLogger as vlog
-import statistics
 
 
 
 
-class VCFParserRow(NamedTuple):
-        PangoLineage: str
-        NextStrainClade: str 
-        NucName: str
-        AAName: str
-        Key: str
-        SignatureSNV: str 
-        Position: int
-        Type: str
-        Length: str
-        Ref: str
-        Alt: str
-
-
-class DataSheet:
-    """
-    Read in the vcfparser sheet to decide what mutations to index.
-    Columns of used and already know include:
-        - VOC (string)
-        - Position (Int)
-        - Type (Sub, Del, Ins, MNP) Dels and sub, index differently
-        - Ref
-        - Alt
-    The sheet is tab delimited
-    """
-
-    def __init__(self, file_name):
-        self.file_name = file_name
-        self.voc_info = self.group_voc_info()
-
-    def group_voc_info(self):
-        """
-        From the vcfparser sheet file group the needed data
-        """    
-        voc_info = {}
-        with open(self.file_name, 'r') as metadata:
-            lines = metadata.readlines()[1:] # header fields stored in named tuple
-            for line in lines:
-                line = line.strip().split("\t") # split on tab delimiter remove new lines
-                voc = line[0]
-                voc_metadata = VCFParserRow(*line[1:])
-                if voc_info.get(voc) is None:
-                    voc_info[voc] = {}
-                
-                voc_info[voc][f"{voc_metadata.Ref}{voc_metadata.Position}{voc_metadata.Alt}"] = voc_metadata
-        return voc_info
-
-class PlotData(NamedTuple):
-    metadata: VCFParserRow
-    ivar_row: IvarFields
-    sample_name: str
-    sample_depth: int = None
-
 class VCFDataHTML:
 
     """
@@ -172,231 +124,237 @@ class VCFDataHTML:
                     "#0A2F51",
                     ]
     css_text_colour = "coral"
-
-    def __init__(self, ivar_data: List[ReadIvar], vcf_parser_sheet: str, search_dir: str, cov_thresh: int, out_dir: str, prep_cov_data = None) -> None:
+    COLOUR_SCALES = {"green": CSS_colours,
+                    "blue": ["#E3F2FD", "#C9E3F8", "#AED4F3", "#90C2EC", "#72AFE4", "#549CDB",
+                            "#3B88D0", "#2A74BD", "#1F5FA3", "#164A86", "#0D3566"],
+                    "grey": ["#F2F2F2", "#DCDCDC", "#C6C6C6", "#B0B0B0", "#9A9A9A", "#848484",
+                            "#6E6E6E", "#585858", "#424242", "#2C2C2C", "#161616"]}
+
+    def __init__(self, ivar_data: List[Union[ReadIvar, ReadVCF]], vcf_parser_sheet: Union[str, DataSheet], search_dir: str, cov_thresh: int, out_dir: str, prep_cov_data = None,
+                mnp_cv_thresh: float = 2.5, report_style: str = "classic", page_size: int = 100, page_order: str = "sheet",
+                prior_results: MatchedResults = None, database: str = None, verbose: bool = False) -> None:
         """
         TODO: have flag for coverage info so that it can run without it
         Can be done better for handing off data, but just to rush out a prototype, e.g. not just ivar specific
         prep_cov_data: is a parameter to be added in the case of preprocessed data is provided
+        ivar_data: ReadIvar objects or multi sample ReadVCF objects, which are split into a view per sample
+        vcf_parser_sheet: the metadata sheet or an already read DataSheet, so a sheet can be kept between runs
+        mnp_cv_thresh: the maximum coefficient of variation (%) of depth and alt frequency for MNP bases to be combined
+        report_style: classic writes a html table per lineage, data writes a single report drawn from embedded data
+            and paginated writes a report page per page_size samples
+        page_order: the order samples are placed on pages, either sheet order or by collection date
+        prior_results: previously saved results, only samples not in them are matched and then added to them
+        database: a SQLite database the matched results of the new samples are added to
+        verbose: log every mismatch as it is found rather than only the summary of mismatches
         """
-        self.out_dir = out_dir
-        self.vcfparser_sheet = vcf_parser_sheet
-        self.low_cov_thresh = cov_thresh #TODO make this a param in cmd line
+        # multi sample vcfs are read once and each sample is a view on the shared records
+        ivar_data = [view for i in ivar_data for view in (i.sample_views() if isinstance(i, ReadVCF) else [i])]
+        if prior_results is not None:
+            known_samples = set(prior_results.samples)
+            skipped = [i.sample_name for i in ivar_data if i.sample_name in known_samples]
+            if skipped:
+                vlog.logger.info(f"Skipping samples already in the saved results: {skipped}")
+            ivar_data = [i for i in ivar_data if i.sample_name not in known_samples]
+        self.set_report_options(vcf_parser_sheet, cov_thresh, out_dir, report_style, page_size, page_order)
+        self.mnp_cv_thresh = mnp_cv_thresh
         self.indx_samples = {i.sample_name: i for i in ivar_data}
         if prep_cov_data == None:
             self.cov_info = CoverageData.create_sample_coverages([i.sample_name for i in ivar_data], search_dir)
         else:
             self.cov_info = prep_cov_data
-        self.vcf_metadata = DataSheet(vcf_parser_sheet)
-        #self.voc_table_data = self.initialize_voc_tables()
         self.ivar_data = ivar_data
-        self.figure_data = {}
-        for data in self.ivar_data:
-            # modifies figure data obj in place, adding in data for figures
-            self.figure_data = self.initialize_voc_tables(data, self.figure_data)
-        self.create_heatmaps()
+        matcher = SampleMatcher(vcf_parser_sheet, self.cov_info, mnp_cv_thresh, MatchDiagnostics(verbose))
+        self.results = matcher.match(self.ivar_data)
+        matcher.diagnostics.log_summary()
+        matcher.diagnostics.write_json(os.path.join(self.out_dir, DIAGNOSTICS_FILE))
+        self.vcf_metadata = matcher.vcf_metadata
+        self.figure_data = matcher.figure_data
+        if database is not None and self.ivar_data:
+            store_results(database, self.results, self.low_cov_thresh, self.out_dir)
+        if prior_results is not None:
+            self.results = prior_results.merge(self.results) if self.ivar_data else prior_results
+        self.save_results()
+        if self.report_style == "classic":
+            self.create_heatmaps()
     
-    def initialize_voc_tables(self, datafile, html_plots: dict):
+    @classmethod
+    def from_results(cls, results: MatchedResults, cov_thresh: int, out_dir: str, report_style: str = "classic", page_size: int = 100,
+                    page_order: str = "sheet", colour_scale: str = None):
         """
-        From the vcf metadata initialize a dictionary for each voc that can show a queried postion,
-        and can be grabbed from the vcf_data
-
-        TODO: methods can be divided and mutations cleaned with gaurd statements
+        Render saved results without reading any ivar files or bams, the statuses of the cells
+        are decided by the coverage threshold given here.
+        :param colour_scale: a key of COLOUR_SCALES, the default colours are used if not specified
         """
-
-        for key in self.vcf_metadata.voc_info.keys():
-            if html_plots.get(key) is None:
-                html_plots[key] = {}
-
-            for voc in self.vcf_metadata.voc_info[key]:
-                #TODO double value addition is probably happening here
-                pos = "".join([i for i in voc if i.isdigit()])
-                if html_plots[key].get(voc) is None:
-                    html_plots[key][voc] = []
-                ivar_data = datafile.vcf_info.get(pos)
-                sample_name = datafile.sample_name
-                # add in coverage check here
-                depth = self.cov_info.samples_coverage[datafile.sample_name][self.vcf_metadata.voc_info[key][voc].Position]
-                empty_data = PlotData(self.vcf_metadata.voc_info[key][voc], None, sample_name, int(depth))
-
-                if ivar_data is None:
-                    vlog.logger.debug(f"The no data found VOC {key} mutations {voc}")
-                    html_plots[key][voc].append(empty_data)
-                else:
-                    start_len = len(html_plots[key][voc])
-                    for i in ivar_data:
-                        ret_val = self.append_ivar_info(html_plots, i, key, voc, datafile)
-                    if not ret_val and len(html_plots[key][voc]) == start_len:
-                        html_plots[key][voc].append(empty_data) # add empty value if data could not be found
-        return html_plots
-    
-    def append_ivar_info(self, html_plots_obj: dict, ivar_data_val, key_val, voic, datafile):
+        vcf_html = cls.__new__(cls)
+        vcf_html.set_report_options(results.metadata_sheet, cov_thresh, out_dir, report_style, page_size, page_order)
+        if colour_scale is not None:
+            vcf_html.CSS_colours = cls.COLOUR_SCALES[colour_scale]
+        vcf_html.ivar_data = []
+        vcf_html.indx_samples = {}
+        vcf_html.results = results
+        if vcf_html.report_style == "classic":
+            vcf_html.create_heatmaps()
+        return vcf_html
+
+    def set_report_options(self, vcf_parser_sheet: Union[str, DataSheet], cov_thresh: int, out_dir: str, report_style: str, page_size: int, 
+                            page_order: str):
         """
-        As ivar data contains a list of values, a for loop is required to run through the data 
-        of tuples to identify other postitions. No return value is specified as the dictionary will be mutatated in place
+        Set the options used in rendering the report
         """
-        
-        depth = self.cov_info.samples_coverage[datafile.sample_name][self.vcf_metadata.voc_info[key_val][voic].Position]
-        plot_data = PlotData(self.vcf_metadata.voc_info[key_val][voic], ivar_data_val, datafile.sample_name, int(depth))
-        vcf_data_meta = self.vcf_metadata.voc_info[key_val][voic]
-        # to compare indels, vcf parser sheet places ref at front
-        if vcf_data_meta.Type != "Sub":
-            if vcf_data_meta.Type == "Del":
-                # splitting string to rwmove first char as in vcfparser
-                # we include the ref codon and ivar includes a starting -
-                ivar_del = ivar_data_val.ALT[1:] 
-                meta_del = vcf_data_meta.Ref[1:]
-                test = ivar_del == meta_del
-                if not test:
-                    vlog.logger.info(f"Mismatch in deletion from metadata: {meta_del} and VCF deletion {ivar_data_val.ALT}")
-                    return False
-                else:
-                    html_plots_obj[key_val][voic].append(plot_data)
-            elif vcf_data_meta.Type == "Ins":
-                ivar_ins = ivar_data_val.ALT[1:]
-                meta_ins = vcf_data_meta.Alt[1:]
-                test = ivar_ins == meta_ins
-                if not test:
-                    vlog.logger.info(f"Mismatch in insertion from metadata: {meta_ins} and VCF deletion {ivar_data_val.ALT}")
-                    return False
-                else:
-                    html_plots_obj[key_val][voic].append(plot_data)
-            elif vcf_data_meta.Type == "Mnp":
-                #TODO move cv into static methods
-                meta_alt = vcf_data_meta.Alt
-                l_meta_alt = len(meta_alt)
-                meta_pos = int(vcf_data_meta.Position)
-                mnps_add = []
-                if ivar_data_val.ALT != meta_alt[0]:
-                    return False
-
-                mnps_add.append(ivar_data_val)
-                for i in range(1, l_meta_alt):# skip ivar dataval
-                    pos_test = datafile.vcf_info.get(str(meta_pos + i))
-                    for vcf_val in pos_test: # test one vcfval at a time alter this later
-                        if vcf_val.ALT == meta_alt[i]:
-                            mnps_add.append(vcf_val)
-                
-                # Quick lil CV test for the mnps to make sure the occur together
-                # NOTE: this is based on my faith and not empircical measures
-                alleles = "".join([i.ALT for i in mnps_add])
-                if alleles != meta_alt:
-                    return False
-                depths = [int(i.ALT_DP) for i in mnps_add]
-                d_stdev = statistics.pstdev(depths)
-                d_avg = statistics.mean(depths)
-                depths_cv = (d_stdev / d_avg) * 100
-
-                alt_freqs = [float(i.ALT_FREQ) for i in mnps_add]
-                altf_stdev = statistics.pstdev(alt_freqs)
-                alt_avg = statistics.mean(alt_freqs)
-                alt_cv = (altf_stdev / alt_avg) * 100
-                #Change the ivar row in the data to show the average for the mnps
-                
-                plot_data = plot_data._replace(ivar_row = plot_data.ivar_row._replace(ALT_FREQ = alt_avg))
-                plot_data = plot_data._replace(ivar_row = plot_data.ivar_row._replace(ALT = vcf_data_meta.Alt))
-                plot_data = plot_data._replace(ivar_row = plot_data.ivar_row._replace(REF = vcf_data_meta.Ref))
-                # CV thresholds are set arbitralily, and should reflect the depth
-                cov_var = 2.5
-                if depths_cv < cov_var and alt_cv < cov_var: # TODO make this calculated based on depth
-                    vlog.logger.info(f"Combining {alleles} at position {meta_pos} into MNP")
-                    html_plots_obj[key_val][voic].append(plot_data)
-                else:
-                    vlog.logger.info(f"Could not combine mutations for {voic} due to a Coefficient of Variation greater than {cov_var}.")
-                    return False
+        self.out_dir = out_dir
+        self.vcfparser_sheet = getattr(vcf_parser_sheet, "file_name", vcf_parser_sheet)
+        self.low_cov_thresh = cov_thresh #TODO make this a param in cmd line
+        self.report_style = report_style
+        self.page_size = page_size
+        self.page_order = page_order
 
-            else:
-                vlog.logger.warning(f"Support not provided for mutation type {vcf_data_meta.Type}")
-                return False
-        else:
-            test_alt = vcf_data_meta.Alt == ivar_data_val.ALT
-            test_ref = vcf_data_meta.Ref == ivar_data_val.REF
-            query_combo = ivar_data_val.REF + str(ivar_data_val.POS) + ivar_data_val.ALT
-            if test_alt and test_ref and self.vcf_metadata.voc_info[key_val].get(query_combo) is not None:
-                html_plots_obj[key_val][voic].append(plot_data)
-            else:
-                vlog.logger.info(f"Mismatch in substitution from metadata: {vcf_data_meta.Ref} at"\
-                    f" position {ivar_data_val.POS} and VCF {ivar_data_val.ALT}")
-                return False
-
-    def check_alt_prescence(self, combo, voc_key):
+    def save_results(self):
         """
-        check for prescence of alternate combo in vcfparser data
+        Save the matched results, with the lineage statistics of the coverage threshold, alongside
+        the report so samples can be appended later
         """
-        val = self.vcf_metadata.voc_info[voc_key].get(combo)
-        if val is not None:
-            return True
-        return False
+        results_path = os.path.join(self.out_dir, RESULTS_FILE)
+        vlog.logger.info(f"Saving matched results to {results_path}")
+        self.results.save(results_path, self.low_cov_thresh)
 
     def create_heatmaps(self):
         """
-        Run the code to create the heatmaps from the intialized data sheets
+        Run the code to create the heatmaps from the matched results
         """
-        figure_data = self.figure_data
-        #side_bar_nav = [self.side_bar_nav[0]]
-        for data in figure_data.keys():
-            html_figure = [self.html_meta_start, f"<h1>{data}</h1>", self.table_tags[0],"<thead>",self.row_tags[0], 
-            self.header_tags[0] + "" + self.header_tags[1]]
-
-            voic_data = figure_data[data]
-            positions = list(voic_data.keys())
-
-            # replaceing header tags for samples only
-            val_headers = [f"<th style=\"transform: rotate(180deg);padding:25px;font-size:50px;writing-mode:vertical-lr;\">{i.sample_name}{self.header_tags[1]}" 
-            for i in voic_data[positions[0]]]
-            html_figure.extend(val_headers)
-            html_figure.append("</thead>")
-
-            for voic in voic_data.keys(): # add figure data
-                html_figure.append("<tr style=\"height:200px;width:50px\">")
-                col_name = voic_data[voic][0].metadata.AAName + "|" + voic_data[voic][0].metadata.NucName # getting first value for row name
-                html_figure.append("<td style=\"font-weight: 600;padding: 10px;font-size:50px;\">" + col_name + self.td_tags[1])
-                for vcf_row in voic_data[voic]:
-                    row_info = []
-                    if vcf_row.ivar_row is not None:
-                        alt_freq = "LC"
-                        colour_css = "#ffffff"
-                        if vcf_row.sample_depth >= self.low_cov_thresh:
-                            alt_freq = str(round(float(vcf_row.ivar_row.ALT_FREQ), 3)) # get alt freq col
-                            colour_css = self.CSS_colours[self.pick_colour(alt_freq=alt_freq)] # get index based on colur scale
-
-                        row_data = f"<td bgcolor={colour_css} style=\"color:{self.css_text_colour};font-weight: 600;padding: 10px;font-size:50px\">"
-                        row_info.append(row_data + alt_freq + self.td_tags[1])
-                    else:
-                        cov = vcf_row.sample_depth
-                        #TODO preprocess this to speed it up
-                        #TODO make logic prepared for mixture of wildtype and alternate
-                        #TODO need to add in flag for reversions to show up
-                        
-                        sample_data = self.determine_sample(vcf_row.sample_name)
-                        val = sample_data.vcf_info.get(vcf_row.metadata.Position)
-                        empt_flag = "WT"
-                        if val is not None:
-                            empt_flag = "ALT"
-                        # = "NC" # get alt freq col
-                        if cov == 0:
-                            alt_freq = "NC"
-                        elif cov <= self.low_cov_thresh:
-                            alt_freq = f"{empt_flag}_LC"
-                        elif cov > self.low_cov_thresh:
-                            alt_freq = f"{empt_flag}"
-                        row_data = f"<td style=\"color:{self.css_text_colour};padding: 10px;font-weigth: 600;font-size:50px;\">"
-                        row_info.append(row_data + alt_freq + self.td_tags[1])    
-                    html_figure.extend(row_info)
-                row_info.append(self.row_tags[1])
-                       
-            html_figure.append(self.table_tags[1])
-            html_figure.append(self.html_meta_end)
+        for data, lineage_results in self.results.lineages.items():
+            html_figure = self.lineage_table(data, lineage_results, range(len(self.results.samples)))
             html_figure = "\n".join(html_figure)
 
             with open(os.path.join(self.out_dir, f"{data}_{self.final_tag}.html"), "w") as html_out:
                 vlog.logger.info(f"Creating plot for {data}")
                 html_out.write(html_figure)
+
+    def lineage_table(self, lineage: str, lineage_results: LineageResults, columns: List[int]) -> List[str]:
+        """
+        Create the html heatmap table of a lineage for the samples in columns
+        """
+        html_figure = [self.html_meta_start, f"<h1>{lineage}</h1>", self.table_tags[0],"<thead>",self.row_tags[0], 
+        self.header_tags[0] + "" + self.header_tags[1]]
+
+        # replaceing header tags for samples only
+        val_headers = [f"<th style=\"transform: rotate(180deg);padding:25px;font-size:50px;writing-mode:vertical-lr;\">{self.results.samples[i]}{self.header_tags[1]}" 
+        for i in columns]
+        html_figure.extend(val_headers)
+        html_figure.append("</thead>")
+
+        if self.results.has_qc(): # coverage QC of the samples, not coloured as they are not alt frequencies
+            for qc_row in self.results.qc_rows(self.low_cov_thresh):
+                html_figure.append("<tr style=\"height:200px;width:50px\">")
+                html_figure.append("<td style=\"font-weight: 600;padding: 10px;font-size:50px;\">" + qc_row[0] + self.td_tags[1])
+                html_figure.extend([f"<td style=\"padding: 10px;font-weight: 600;font-size:50px;\">{qc_row[1 + i]}{self.td_tags[1]}" for i in columns])
+
+        for m_idx, mutation in enumerate(lineage_results.mutations): # add figure data
+            html_figure.append("<tr style=\"height:200px;width:50px\">")
+            col_name = mutation.AAName + "|" + mutation.NucName
+            html_figure.append("<td style=\"font-weight: 600;padding: 10px;font-size:50px;\">" + col_name + self.td_tags[1])
+            for s_idx in columns:
+                alt_freq = lineage_results.status(m_idx, s_idx, self.low_cov_thresh)
+                if not math.isnan(lineage_results.alt_freqs[lineage_results.cell(m_idx, s_idx)]):
+                    colour_css = "#ffffff"
+                    if alt_freq != "LC":
+                        colour_css = self.CSS_colours[self.pick_colour(alt_freq=alt_freq)] # get index based on colur scale
+                    row_data = f"<td bgcolor={colour_css} style=\"color:{self.css_text_colour};font-weight: 600;padding: 10px;font-size:50px\">"
+                else:
+                    row_data = f"<td style=\"color:{self.css_text_colour};padding: 10px;font-weigth: 600;font-size:50px;\">"
+                html_figure.append(row_data + alt_freq + self.td_tags[1])
+
+        for stat, values in lineage_results.stats(self.low_cov_thresh).items(): # summary rows of the lineage
+            html_figure.append("<tr style=\"height:200px;width:50px\">")
+            html_figure.append("<td style=\"font-weight: 600;padding: 10px;font-size:50px;\">" + stat + self.td_tags[1])
+            for s_idx in columns:
+                if math.isnan(values[s_idx]):
+                    html_figure.append(f"<td style=\"color:{self.css_text_colour};padding: 10px;font-weigth: 600;font-size:50px;\">NA{self.td_tags[1]}")
+                    continue
+                stat_value = str(round(values[s_idx], 3))
+                html_figure.append(f"<td bgcolor={self.CSS_colours[self.pick_colour(alt_freq=stat_value)]} " \
+                    f"style=\"color:{self.css_text_colour};font-weight: 600;padding: 10px;font-size:50px\">{stat_value}{self.td_tags[1]}")
+
+        html_figure.append(self.table_tags[1])
+        html_figure.append(self.html_meta_end)
+        return html_figure
+
+    def page_columns(self) -> List[List[int]]:
+        """
+        Split the sample columns into pages of page_size samples, in sheet order or by
+        collection date with undated samples last.
+        """
+        order = list(range(len(self.results.samples)))
+        if self.page_order == "date":
+            dates = self.results.sample_dates
+            order.sort(key=lambda x: (dates[x] == "", dates[x]))
+        return [order[i:i + self.page_size] for i in range(0, len(order), self.page_size)]
+
+    def create_paginated_report(self):
+        """
+        Create a report page for every page_size samples and an index linking them, each page
+        is rendered and written on its own so only one page is held in memory.
+        """
+        base_name = os.path.basename(self.out_dir)
+        pages = self.page_columns()
+        index_rows = []
+        for page_num, columns in enumerate(pages, start=1):
+            page_name = f"{base_name}_page{page_num}.html"
+            samples = [self.results.samples[i] for i in columns]
+            dates = sorted(self.results.sample_dates[i] for i in columns if self.results.sample_dates[i])
+            date_range = f"{dates[0]} - {dates[-1]}" if dates else ""
+            index_rows.append(f"<tr><td><a href=\"{page_name}\">Page {page_num}</a></td><td>{len(samples)}</td>" \
+                f"<td>{samples[0]}</td><td>{samples[-1]}</td><td>{date_range}</td></tr>")
+
+            html_pages = []
+            for lineage, lineage_results in self.results.lineages.items():
+                html_pages.append(f"<a id=\"{lineage}\"></a>")
+                html_pages.extend(self.lineage_table(lineage, lineage_results, columns)[1:-1])
+            nav = [f"{self.nav_element[0].replace('#@', f'{base_name}_doc.html')}Index{self.nav_element[1]}"]
+            nav.extend([f"{self.nav_element[0].replace('@', i)}{i}{self.nav_element[1]}" for i in self.results.lineages])
+            html_doc = [self.html_meta_start, *self.report_banner(f"Page {page_num} of {len(pages)}"), 
+                        self.side_bar_nav[0], *nav, self.side_bar_nav[1], "<div class=\"main\">", *html_pages, "</div>", self.html_meta_end]
+            with open(os.path.join(self.out_dir, page_name), "w") as page:
+                vlog.logger.info(f"Creating report page {page_num} of {len(pages)}")
+                page.write("\n".join(html_doc))
+
+        index_table = [self.table_tags[0], "<thead>", self.row_tags[0], 
+            *[f"{self.header_tags[0]}{i}{self.header_tags[1]}" for i in ("Page", "Samples", "First sample", "Last sample", "Dates")],
+            self.row_tags[1], "</thead>", *index_rows, self.table_tags[1]]
+        html_doc = [self.html_meta_start, *self.report_banner(f"Samples per page: {self.page_size}"), "<h1>Report pages</h1>", *index_table, self.html_meta_end]
+        with open(os.path.join(self.out_dir, f"{base_name}_doc.html"), "w") as index:
+            index.write("\n".join(html_doc))
+
+    def report_banner(self, *extra_lines) -> List[str]:
+        """
+        The banner of information shown at the top of a report
+        """
+        return [self.banner_tags[0], 
+        f"<h1>VCFParser sheet used: {self.vcfparser_sheet}</h1>", 
+        f"<h1>Time combined report created: {datetime.now()}</h1>",
+        f"<h1>Depth of Coverage Threshold: {self.low_cov_thresh}</h1>", 
+        *[f"<h1>{i}</h1>" for i in extra_lines],
+        self.banner_tags[1]]
+
+    def create_data_report(self):
+        """
+        Create a single report embedding the result matrices as compact data, the heatmaps are
+        drawn by a small script that only renders the cells in view.
+        """
+        report = DataReport.data_report_html(self.results, self.low_cov_thresh, self.vcfparser_sheet, self.CSS_colours)
+        with open(os.path.join(self.out_dir, f"{os.path.basename(self.out_dir)}_doc.html"), "w") as combined:
+            vlog.logger.info("Creating data report")
+            combined.write(report)
     
     def combine_html_plots(self):
         """
         Create a naviagable webpage of the output plots
         """
+        if self.report_style == "data":
+            self.create_data_report()
+            return
+        if self.report_style == "paginated":
+            self.create_paginated_report()
+            return
         glob_pattern = os.path.join(self.out_dir, f"*{self.final_tag}.html")
         plots = glob.glob(glob_pattern)
         plots = sorted(plots)
@@ -414,11 +372,7 @@ class VCFDataHTML:
                 html_pages.append(lines[lines.index(header_tag):lines.rindex("</body>")].strip())
 
         headers_formatted = [f"{self.nav_element[0].replace('@', i)}{i}{self.nav_element[1]}" for i in headers]
-        banner_formatted = [self.banner_tags[0], 
-        f"<h1>VCFParser sheet used: {self.vcfparser_sheet}</h1>", 
-        f"<h1>Time combined report created: {datetime.now()}</h1>",
-        f"<h1>Depth of Coverage Threshold: {self.low_cov_thresh}</h1>", 
-        self.banner_tags[1]]
+        banner_formatted = self.report_banner()
         side_bar_nav = [self.side_bar_nav[0]]
         side_bar_nav.extend(headers_formatted)
         side_bar_nav.append(self.side_bar_nav[1])
@@ -0,0 +1,146 @@
+"""
+An optional SQLite store of matched results across runs. Each run adds a row per
+sample, lineage and mutation with the alt frequency, depth and status of the
+cell, so months of surveillance data can be queried without re-running VCFViz
+or scraping the html reports.
+
+The result_rows view joins the tables into one row per cell e.g.
+
+    SELECT sample, collection_date, alt_freq FROM result_rows
+    WHERE lineage = 'BA.2' AND nuc_name = 'C10029T' AND collection_date >= '2022-04-01';
+"""
+
+import math
+import os
+import sqlite3
+from datetime import datetime
+from VCFViz.MatchedResults import MatchedResults, LineageResults
+from VCFViz.VCFlogging import VCFLogger as vlog
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    created TEXT NOT NULL,
+    metadata_sheet TEXT,
+    coverage_threshold INTEGER NOT NULL,
+    output_directory TEXT
+);
+CREATE TABLE IF NOT EXISTS samples (
+    sample_id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    name TEXT NOT NULL,
+    collection_date TEXT
+);
+CREATE TABLE IF NOT EXISTS mutations (
+    mutation_id INTEGER PRIMARY KEY,
+    metadata_sheet TEXT NOT NULL,
+    lineage TEXT NOT NULL,
+    key TEXT NOT NULL,
+    nuc_name TEXT,
+    aa_name TEXT,
+    position INTEGER,
+    type TEXT,
+    ref TEXT,
+    alt TEXT,
+    signature_snv TEXT,
+    UNIQUE (metadata_sheet, lineage, key)
+);
+CREATE TABLE IF NOT EXISTS results (
+    sample_id INTEGER NOT NULL REFERENCES samples(sample_id),
+    mutation_id INTEGER NOT NULL REFERENCES mutations(mutation_id),
+    alt_freq REAL,
+    depth INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (sample_id, mutation_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS runs_created ON runs(created);
+CREATE INDEX IF NOT EXISTS samples_name ON samples(name);
+CREATE INDEX IF NOT EXISTS samples_date ON samples(collection_date);
+CREATE INDEX IF NOT EXISTS results_mutation ON results(mutation_id);
+CREATE VIEW IF NOT EXISTS result_rows AS
+    SELECT runs.run_id, runs.created, samples.name AS sample, samples.collection_date,
+        mutations.metadata_sheet, mutations.lineage, mutations.nuc_name, mutations.aa_name, mutations.position,
+        results.alt_freq, results.depth, results.status
+    FROM results
+    JOIN samples ON samples.sample_id = results.sample_id
+    JOIN runs ON runs.run_id = samples.run_id
+    JOIN mutations ON mutations.mutation_id = results.mutation_id;
+"""
+
+
+class ResultsWarehouse:
+    """
+    Write matched results of a run to a SQLite database, the tables are created
+    the first time a database is used.
+    """
+    def __init__(self, database: str) -> None:
+        self.database = database
+        self.connection = sqlite3.connect(database)
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def mutation_ids(self, metadata_sheet: str, lineage: str, mutations: list) -> dict:
+        """
+        Return the id of every mutation key of a lineage, adding those not seen before. Mutations
+        are kept per metadata sheet as panels may define the same lineage and key differently
+        """
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO mutations (metadata_sheet, lineage, key, nuc_name, aa_name, position, type, ref, alt, signature_snv) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ((metadata_sheet, lineage, *mutation) for mutation in mutations))
+        return dict(self.connection.execute("SELECT key, mutation_id FROM mutations WHERE metadata_sheet = ? AND lineage = ?",
+                                            (metadata_sheet, lineage)))
+
+    def add_run(self, results: MatchedResults, cov_thresh: int, output_directory: str = None) -> int:
+        """
+        Add the results of a run in a single transaction and return the runs id
+        :param results: the matched results of the run
+        :param cov_thresh: the coverage threshold the statuses are decided with
+        :param output_directory: where the runs report was written
+        """
+        with self.connection:
+            run_id = self.connection.execute(
+                "INSERT INTO runs (created, metadata_sheet, coverage_threshold, output_directory) VALUES (?, ?, ?, ?)",
+                (str(datetime.now()), results.metadata_sheet, cov_thresh, output_directory)).lastrowid
+            sample_ids = []
+            for name, date in zip(results.samples, results.sample_dates):
+                sample_ids.append(self.connection.execute(
+                    "INSERT INTO samples (run_id, name, collection_date) VALUES (?, ?, ?)",
+                    (run_id, name, date or None)).lastrowid)
+            # a single pass over the lineages as spilled results load each lineage from disk when it is used
+            for lineage, lineage_results in results.lineages.items():
+                mutation_ids = self.mutation_ids(results.metadata_sheet or "", lineage, lineage_results.mutations)
+                self.connection.executemany(
+                    "INSERT INTO results (sample_id, mutation_id, alt_freq, depth, status) VALUES (?, ?, ?, ?, ?)",
+                    self.result_rows(lineage_results, cov_thresh, sample_ids, mutation_ids))
+        vlog.logger.info(f"Added {len(results.samples)} samples to {self.database} as run {run_id}")
+        return run_id
+
+    @staticmethod
+    def result_rows(lineage_results: LineageResults, cov_thresh: int, sample_ids: list, mutation_ids: dict):
+        """
+        Yield a row per cell of a lineages results
+        """
+        for m_idx, mutation in enumerate(lineage_results.mutations):
+            mutation_id = mutation_ids[mutation.key]
+            for s_idx, sample_id in enumerate(sample_ids):
+                idx = lineage_results.cell(m_idx, s_idx)
+                alt_freq = lineage_results.alt_freqs[idx]
+                yield (sample_id, mutation_id, None if math.isnan(alt_freq) else alt_freq, lineage_results.depths[idx],
+                        lineage_results.status(m_idx, s_idx, cov_thresh))
+
+
+def store_results(database: str, results: MatchedResults, cov_thresh: int, output_directory: str = None) -> int:
+    """
+    Add the results of a run to the database, creating it if it does not exist
+    """
+    with ResultsWarehouse(database) as warehouse:
+        return warehouse.add_run(results, cov_thresh, os.path.abspath(output_directory) if output_directory else None)
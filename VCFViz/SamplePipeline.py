@@ -0,0 +1,190 @@
+"""
+Run reading, coverage and matching as a pipeline rather than one step after another for
+every sample. Input files are read by a pool of reader threads, samples without cached
+depths are grouped into chunks whose depths are found by samtools in a pool of coverage
+threads, and samples are matched in the order given as soon as their depths are ready.
+So while samtools runs for one chunk the following samples are still being read and the
+previous ones matched.
+
+The steps are joined by bounded queues, a slow step holds back the steps feeding it rather
+than letting read samples pile up in memory. The lineages are rendered once the last
+sample is matched as every heatmap needs every sample. With several metadata sheets each
+sample is matched against every sheet as it becomes ready, so the samples are read and their
+depths found once for all of the sheets.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import os
+import queue
+import threading
+from typing import Callable
+from VCFViz import CoverageData
+from VCFViz.MatchDiagnostics import MatchDiagnostics, DIAGNOSTICS_FILE
+from VCFViz.MatchSamples import SampleMatcher
+from VCFViz.RenderHTML import VCFDataHTML
+from VCFViz.ResultsWarehouse import store_results
+from VCFViz.VCFToJson import ReadVCF
+from VCFViz.VCFlogging import VCFLogger as vlog
+
+PIPELINE_QUEUE_SIZE = 32 # items waiting between each step
+COVERAGE_WORKERS = 2 # samtools depth calls run at once
+QUEUE_TIMEOUT = 0.1 # seconds between checks for a stopped pipeline
+
+
+class SamplePipeline:
+    """
+    The queues and threads of a pipeline over a list of inputs. The end of a queue is marked
+    with None, an exception raised in a step is passed down the queues and raised again by run.
+    """
+    def __init__(self, read_input: Callable, search_dir: str, cached: CoverageData.CoverageStore, threads: int,
+                queue_size: int = PIPELINE_QUEUE_SIZE, coverage_workers: int = COVERAGE_WORKERS) -> None:
+        """
+        read_input: returns a ReadIvar or ReadVCF, or a tuple of a ReadIvar and its SampleMap
+        search_dir: the directory searched for the bams of samples without a SampleMap
+        cached: depths of samples that do not need samtools to be run
+        """
+        self.read_input = read_input
+        self.search_dir = search_dir
+        self.cached = cached
+        self.readers = ThreadPoolExecutor(max_workers=threads)
+        self.samtools = ThreadPoolExecutor(max_workers=coverage_workers)
+        self.parsed = queue.Queue(maxsize=queue_size) # futures of read inputs, in input order
+        self.ready = queue.Queue(maxsize=queue_size) # samples and the future of their depths, in input order
+        self.stop = threading.Event()
+
+    def put(self, step_queue: queue.Queue, item) -> bool:
+        while not self.stop.is_set():
+            try:
+                step_queue.put(item, timeout=QUEUE_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, step_queue: queue.Queue):
+        while not self.stop.is_set():
+            try:
+                return step_queue.get(timeout=QUEUE_TIMEOUT)
+            except queue.Empty:
+                pass
+        return None
+
+    def read_inputs(self, inputs: list):
+        """
+        Submit the inputs to the readers, the bounded queue limits how far reading runs ahead of matching
+        """
+        try:
+            for i in inputs:
+                if not self.put(self.parsed, self.readers.submit(self.read_input, i)):
+                    return
+        finally:
+            self.put(self.parsed, None)
+
+    def chunk_coverage(self, chunk: list) -> CoverageData.CoverageStore:
+        """
+        Find the depths of a chunk of (sample name, SampleMap or None) with a single samtools call
+        """
+        sample_maps = [i if i is not None else CoverageData.SampleMap(name, self.search_dir) for name, i in chunk]
+        coverage = CoverageData.SamplesCoverage(sample_maps)
+        coverage.call_coverage_program(sample_maps)
+        return coverage.samples_coverage
+
+    def find_coverage(self):
+        """
+        Group the read samples into chunks of samples needing depths, passing each chunk on with
+        the future of its depths. Samples with cached depths are passed on without waiting.
+        """
+        pending, chunk = [], []
+        try:
+            while True:
+                item = self.get(self.parsed)
+                if item is None:
+                    break
+                read = item.result()
+                sample_map = None
+                if isinstance(read, tuple):
+                    read, sample_map = read
+                for sample in (read.sample_views() if isinstance(read, ReadVCF) else [read]):
+                    pending.append(sample)
+                    if sample.sample_name not in self.cached:
+                        chunk.append((sample.sample_name, sample_map))
+                if not chunk or len(chunk) >= CoverageData.COVERAGE_CHUNK_SIZE:
+                    self.put(self.ready, (pending, self.samtools.submit(self.chunk_coverage, chunk) if chunk else None))
+                    pending, chunk = [], []
+            if pending:
+                self.put(self.ready, (pending, self.samtools.submit(self.chunk_coverage, chunk) if chunk else None))
+            self.put(self.ready, None)
+        except Exception as err:
+            self.put(self.ready, err)
+
+    def run(self, inputs: list, *matchers: SampleMatcher):
+        """
+        Match every sample of the inputs with each matcher as its depths become ready. Returns
+        the samples in input order and the depths found with samtools.
+        """
+        steps = [threading.Thread(target=self.read_inputs, args=(inputs,), daemon=True),
+                threading.Thread(target=self.find_coverage, daemon=True)]
+        for step in steps:
+            step.start()
+        samples = []
+        coverage = CoverageData.CoverageStore()
+        computed = CoverageData.CoverageStore()
+        try:
+            while True:
+                item = self.get(self.ready)
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                ready_samples, depths = item
+                if depths is not None:
+                    depths = depths.result()
+                    computed.update(depths)
+                    coverage.update(depths)
+                coverage.update(self.cached.subset([i.sample_name for i in ready_samples if i.sample_name in self.cached]))
+                for matcher in matchers:
+                    matcher.coverage = coverage
+                    for sample in ready_samples:
+                        matcher.add_sample(sample)
+                samples.extend(ready_samples)
+        finally:
+            self.stop.set()
+            self.readers.shutdown(cancel_futures=True)
+            self.samtools.shutdown(cancel_futures=True)
+        return samples, computed
+
+
+def run_pipeline(inputs: list, read_input: Callable, panels: dict, search_dir: str, coverage_threshold: int,
+                mnp_cv_threshold: float = 2.5, threads: int = min(8, os.cpu_count() or 1), report_style: str = "classic", page_size: int = 100,
+                page_order: str = "sheet", database: str = None, verbose: bool = False):
+    """
+    Read, find the depths of and match the inputs as a pipeline, then save the results and
+    render the report of each metadata sheet.
+    :param inputs: the inputs passed to read_input, e.g. ivar files or sample sheet rows
+    :param read_input: returns a ReadIvar or ReadVCF, or a tuple of a ReadIvar and its SampleMap
+    :param panels: metadata sheets to the output directory of their report, see InputOptions.panel_outputs
+    :param search_dir: the directory searched for bams and where the coverage cache is kept
+    """
+    start = datetime.now()
+    cache_path = os.path.join(search_dir, CoverageData.COVERAGE_CACHE)
+    cached = CoverageData.read_cache(cache_path) if os.path.isfile(cache_path) else None
+    if cached is None:
+        cached = CoverageData.CoverageStore()
+    matchers = {sheet: SampleMatcher(sheet, None, mnp_cv_threshold, MatchDiagnostics(verbose)) for sheet in panels}
+    samples, computed = SamplePipeline(read_input, search_dir, cached, threads).run(inputs, *matchers.values())
+    if len(computed):
+        cached.update(computed)
+        CoverageData.write_store(cache_path, cached)
+
+    for sheet, matcher in matchers.items():
+        output_directory = panels[sheet]
+        results = matcher.results(samples)
+        matcher.diagnostics.log_summary()
+        matcher.diagnostics.write_json(os.path.join(output_directory, DIAGNOSTICS_FILE))
+        if database is not None and samples:
+            store_results(database, results, coverage_threshold, output_directory)
+        vcf_html = VCFDataHTML.from_results(results, coverage_threshold, output_directory, report_style, page_size, page_order)
+        vcf_html.save_results()
+        vcf_html.combine_html_plots()
+    vlog.logger.info(f"Finished pipeline of {len(samples)} samples in {datetime.now() - start}")
@@ -0,0 +1,200 @@
+"""
+Split a single directory-glob or input-file run across separate jobs, e.g. nodes of a cluster
+whose time limit a whole run does not fit in.
+
+plan splits the samples of a run into shard manifests, shard reads, finds the depths of and
+matches the samples of one manifest writing its partial results beside it, and merge joins the
+partial results of every shard, in the order of the plan, into the final report. The steps only
+communicate through the files in the plan directory so shards can be run by any scheduler, or
+one after another locally.
+
+The metadata sheets and MNP threshold are fixed by the plan so every shard is matched the same
+way, the coverage threshold and report style are only needed by merge as the partial results do
+not depend on them.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+import glob
+import hashlib
+import json
+import os
+from typing import List, Union
+from VCFViz import CoverageData
+from VCFViz.InputOptions import DEFAULT_THREADS, panel_outputs, read_sample_sheet, read_sheet_row, read_variant_file, \
+    ivar_reader, create_summary_excel_report
+from VCFViz.IvarCache import DEFAULT_CACHE_SIZE
+from VCFViz.MatchDiagnostics import MatchDiagnostics, DIAGNOSTICS_FILE
+from VCFViz.MatchSamples import match_samples
+from VCFViz.MatchedResults import MatchedResults, RESULTS_FILE
+from VCFViz.RenderHTML import VCFDataHTML
+from VCFViz.ResultsWarehouse import store_results
+from VCFViz.VCFToJson import ReadVCF
+from VCFViz.VCFlogging import VCFLogger as vlog
+
+PLAN_VERSION = 2
+MANIFEST_PATTERN = "shard_*.json"
+SHARD_COMPLETE = "shard_complete.json" # written to the shard directory once all of its partial results are
+
+
+def manifest_name(shard: int) -> str:
+    return f"shard_{shard}.json"
+
+
+def shard_directory(manifest_path: str, manifest: dict) -> str:
+    """
+    The directory of the partial results of a shard, beside its manifest
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(manifest_path)), f"shard_{manifest['shard']}")
+
+
+def read_complete(shard_dir: str) -> dict:
+    """
+    The completion record of a shard, None if it has not finished
+    """
+    complete_path = os.path.join(shard_dir, SHARD_COMPLETE)
+    if not os.path.isfile(complete_path):
+        return None
+    with open(complete_path, "r") as complete_in:
+        return json.load(complete_in)
+
+
+def read_manifest(manifest_path: str) -> dict:
+    with open(manifest_path, "r") as manifest_in:
+        manifest = json.load(manifest_in)
+    if manifest.get("version") != PLAN_VERSION:
+        raise ValueError(f"Unsupported shard manifest version {manifest.get('version')} in {manifest_path}")
+    return manifest
+
+
+def plan_shards(output_directory: str, metadata: Union[str, List[str]], shards: int, ivar_directory: str = None, bam_directory: str = None,
+                sample_sheet: str = None, mnp_cv_threshold: float = 2.5) -> List[str]:
+    """
+    Split the samples of an ivar directory, or the rows of a sample sheet, into shard manifests
+    written to the output directory. Samples are split in order into shards of near equal size
+    so the merged report has the samples in the same order as a single run. Returns the manifest paths.
+    :param output_directory: the plan directory the manifests and partial results are written to
+    :param shards: the number of shards, fewer are written if there are fewer inputs
+    """
+    if (sample_sheet is None) == (ivar_directory is None) or (ivar_directory is not None and bam_directory is None):
+        vlog.logger.critical("Either a sample sheet or an ivar and bam directory must be given to plan shards.")
+        exit(-1)
+    if sample_sheet is not None:
+        mode = "sheet"
+        # paths are made absolute as shards may not be run from the same directory
+        inputs = [[row[0], os.path.abspath(row[1]), os.path.abspath(row[2]), *row[3:]] for row in read_sample_sheet(sample_sheet)]
+    else:
+        mode = "glob"
+        file_names = os.listdir(ivar_directory) # in the order of a single directory-glob run
+        inputs = [os.path.abspath(os.path.join(ivar_directory, i)) for i in file_names if os.path.splitext(i)[-1].lower() == ".tsv"]
+        inputs.extend([os.path.abspath(os.path.join(ivar_directory, i)) for i in file_names if i.lower().endswith((".vcf", ".vcf.gz"))])
+    if not inputs:
+        vlog.logger.critical("No samples found to plan shards for.")
+        exit(-1)
+    sheets = metadata if isinstance(metadata, (list, tuple)) else [metadata]
+    shards = max(1, min(shards, len(inputs)))
+    plan = {"shards": shards, "mode": mode, "bam_directory": os.path.abspath(bam_directory) if bam_directory is not None else None,
+            "metadata": [os.path.abspath(i) for i in sheets], "mnp_cv_threshold": mnp_cv_threshold}
+    # shards finished for a previous plan of the directory are only merged if it was the same plan
+    plan_id = hashlib.sha1(json.dumps([plan, inputs]).encode()).hexdigest()
+    os.makedirs(output_directory, exist_ok=True)
+    for stale in glob.glob(os.path.join(output_directory, MANIFEST_PATTERN)): # a previous plan of a different size
+        os.remove(stale)
+    manifests = []
+    for shard in range(shards):
+        manifest = {"version": PLAN_VERSION, "plan_id": plan_id, "shard": shard, **plan,
+                    "inputs": inputs[shard * len(inputs) // shards:(shard + 1) * len(inputs) // shards]}
+        manifest_path = os.path.join(output_directory, manifest_name(shard))
+        with open(manifest_path, "w") as manifest_out:
+            json.dump(manifest, manifest_out, indent=1)
+        manifests.append(manifest_path)
+    vlog.logger.info(f"Planned {len(inputs)} inputs in {shards} shards in {output_directory}")
+    return manifests
+
+
+def run_shard(shard_manifest: str, threads: int = DEFAULT_THREADS, verbose: bool = False, ivar_cache: str = None,
+                ivar_cache_size: int = DEFAULT_CACHE_SIZE):
+    """
+    Read, find the depths of and match the samples of a shard, writing the partial results and
+    diagnostics of each metadata sheet to the shard directory. The depth cache of the shard only
+    holds its samples so shards running at once do not write the same cache.
+    """
+    start = datetime.now()
+    manifest = read_manifest(shard_manifest)
+    shard_dir = shard_directory(shard_manifest, manifest)
+    os.makedirs(shard_dir, exist_ok=True)
+    complete_path = os.path.join(shard_dir, SHARD_COMPLETE)
+    if os.path.isfile(complete_path): # the shard is being run again
+        os.remove(complete_path)
+    vlog.logger.info(f"Running shard {manifest['shard'] + 1} of {manifest['shards']} with {len(manifest['inputs'])} inputs")
+
+    read_ivar = ivar_reader(ivar_cache, ivar_cache_size)
+    read_input = partial(read_sheet_row if manifest["mode"] == "sheet" else read_variant_file, read_ivar=read_ivar)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        parsed = list(pool.map(read_input, manifest["inputs"]))
+    sample_maps = None
+    if manifest["mode"] == "sheet":
+        parsed, sample_maps = [i[0] for i in parsed], [i[1] for i in parsed]
+    samples = [view for i in parsed for view in (i.sample_views() if isinstance(i, ReadVCF) else [i])]
+    names = [i.sample_name for i in samples]
+    search_dir = manifest["bam_directory"] or shard_dir
+    coverage = CoverageData.create_sample_coverages(names, search_dir, sample_maps, CoverageData.samples_cache_name(names))
+
+    for sheet, panel_dir in panel_outputs(manifest["metadata"], shard_dir).items():
+        diagnostics = MatchDiagnostics(verbose)
+        results = match_samples(samples, sheet, coverage, mnp_cv_thresh=manifest["mnp_cv_threshold"], diagnostics=diagnostics)
+        results.save(os.path.join(panel_dir, RESULTS_FILE))
+        diagnostics.write_json(os.path.join(panel_dir, DIAGNOSTICS_FILE))
+    with open(complete_path, "w") as complete:
+        json.dump({"plan_id": manifest["plan_id"], "shard": manifest["shard"], "samples": names, "finished": str(datetime.now())}, complete)
+    vlog.logger.info(f"Finished shard {manifest['shard'] + 1} of {manifest['shards']} in {datetime.now() - start}")
+
+
+def merge_shards(plan_directory: str, output_directory: str, coverage_threshold: int, report_style: str = "classic", page_size: int = 100,
+                    page_order: str = "sheet", database: str = None, excel: bool = True):
+    """
+    Join the partial results of every shard of a plan in order, then save the results and render
+    the report of each metadata sheet. Nothing is merged if a shard has not finished.
+    :param excel: also create the Excel summary of each report (classic style only)
+    """
+    start = datetime.now()
+    manifest_paths = glob.glob(os.path.join(plan_directory, MANIFEST_PATTERN))
+    if not manifest_paths:
+        vlog.logger.critical(f"Could not find any shard manifests in {plan_directory}")
+        exit(-1)
+    manifests = sorted([(read_manifest(i), i) for i in manifest_paths], key=lambda x: x[0]["shard"])
+    shards = manifests[0][0]["shards"]
+    missing = [i for i in range(shards) if i not in {manifest["shard"] for manifest, _ in manifests}]
+    for manifest, path in manifests:
+        complete = read_complete(shard_directory(path, manifest))
+        if complete is None:
+            missing.append(manifest["shard"])
+        elif complete.get("plan_id") != manifest["plan_id"]:
+            vlog.logger.warning(f"Shard {manifest['shard']} of {plan_directory} finished for a previous plan, it must be run again.")
+            missing.append(manifest["shard"])
+    if missing:
+        vlog.logger.critical(f"Shards {sorted(set(missing))} of {plan_directory} have not finished, run them before merging.")
+        exit(-1)
+
+    os.makedirs(output_directory, exist_ok=True)
+    panels = panel_outputs(manifests[0][0]["metadata"], output_directory)
+    for sheet, panel_dir in panels.items():
+        shard_panels = [panel_outputs(manifest["metadata"], shard_directory(path, manifest))[sheet] for manifest, path in manifests]
+        results = MatchedResults.concat([MatchedResults.load(os.path.join(i, RESULTS_FILE)) for i in shard_panels])
+        diagnostics = MatchDiagnostics()
+        for shard_panel in shard_panels:
+            diagnostics.merge(MatchDiagnostics.read_json(os.path.join(shard_panel, DIAGNOSTICS_FILE)))
+        diagnostics.log_summary()
+        diagnostics.write_json(os.path.join(panel_dir, DIAGNOSTICS_FILE))
+        if database is not None:
+            store_results(database, results, coverage_threshold, panel_dir)
+        vcf_html = VCFDataHTML.from_results(results, coverage_threshold, panel_dir, report_style, page_size, page_order)
+        vcf_html.save_results()
+        vcf_html.combine_html_plots()
+        if excel:
+            if report_style != "classic":
+                vlog.logger.warning("The Excel summary is created from the classic report, skipping it.")
+            else:
+                create_summary_excel_report(panel_dir, panel_dir)
+    vlog.logger.info(f"Merged {shards} shards of {plan_directory} in {datetime.now() - start}")
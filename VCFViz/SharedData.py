@@ -0,0 +1,220 @@
+"""
+Lay typed columns, e.g. the variants of samples, out back to back in a single block so
+the block can be written once and its columns used in place by any process that maps
+it. Attaching does not copy the data, the arrays are memoryviews of the block.
+
+Blocks are files behind a short json header, the memory mapped entries of IvarCache are
+blocks and coverage stores or the variants of samples can be published as a block so worker
+processes attach to them by path rather than having them pickled in. The publisher owns the
+file and removes it once the workers are done, attached objects are read only and keep the
+mapping open for as long as they are used.
+"""
+
+from array import array
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+from typing import NamedTuple, Tuple
+
+BLOCK_MAGIC = b"VCFVIZSD"
+BLOCK_SUFFIX = ".block"
+HEADER_ALIGNMENT = 8 # the columns start aligned for every type
+
+
+class ColumnLayout(NamedTuple):
+    offset: int
+    typecode: str
+    length: int
+
+
+def aligned(offset: int) -> int:
+    """
+    Round an offset up to the header alignment
+    """
+    return -(-offset // HEADER_ALIGNMENT) * HEADER_ALIGNMENT
+
+
+def column_layout(columns: dict) -> Tuple[dict, dict, int]:
+    """
+    Lay typed arrays out back to back in a single block. Columns are placed largest
+    item size first so each column stays aligned for its type.
+    :param columns: column name to an array (or bytes, stored as unsigned chars)
+    Returns the columns as arrays, their layout and the size of the block in bytes
+    """
+    columns = {key: val if isinstance(val, array) else array("B", val) for key, val in columns.items()}
+    layout = {}
+    offset = 0
+    for key in sorted(columns, key=lambda x: -columns[x].itemsize):
+        layout[key] = ColumnLayout(offset, columns[key].typecode, len(columns[key]))
+        offset += columns[key].itemsize * len(columns[key])
+    return columns, layout, offset
+
+
+def write_columns(buf, columns: dict, layout: dict):
+    """
+    Copy the columns into a writable buffer at the offsets of their layout
+    """
+    for key, (start, _, _) in layout.items():
+        data = memoryview(columns[key]).cast("B")
+        buf[start:start + len(data)] = data
+
+
+def attach_columns(buf, layout: dict) -> dict:
+    """
+    Create typed memoryviews of each column in a block, e.g. the buffer of a memory mapped file
+    """
+    buf = memoryview(buf)
+    columns = {}
+    for key, (offset, typecode, length) in layout.items():
+        itemsize = array(typecode).itemsize
+        columns[key] = buf[offset:offset + itemsize * length].cast(typecode)
+    return columns
+
+
+def variant_columns(samples: list) -> dict:
+    """
+    Create the columns of the variants of ReadIvar like objects (anything with a sample_name and
+    vcf_info). Each samples rows are stored position sorted as in VariantArray with the numeric
+    columns as typed arrays, the full rows are kept as tab delimited text for matching and the
+    alts separately for building a VariantArray. sample_offsets holds the first row of each
+    sample followed by the total number of rows.
+    """
+    positions = array("I")
+    alt_depths = array("I")
+    alt_freqs = array("d")
+    sample_offsets = array("Q", [0])
+    row_offsets = array("Q", [0])
+    alt_offsets = array("Q", [0])
+    row_text = []
+    alts = []
+    for sample in samples:
+        rows = sorted([row for rows in sample.vcf_info.values() for row in rows], key=lambda x: int(x.POS))
+        positions.extend([int(i.POS) for i in rows])
+        alt_depths.extend([int(i.ALT_DP) for i in rows])
+        alt_freqs.extend([float(i.ALT_FREQ) for i in rows])
+        sample_offsets.append(len(positions))
+        for row in rows:
+            row_text.append("\t".join(row).encode("utf-8"))
+            row_offsets.append(row_offsets[-1] + len(row_text[-1]))
+            alts.append(row.ALT.encode("utf-8"))
+            alt_offsets.append(alt_offsets[-1] + len(alts[-1]))
+    return {"positions": positions, "alt_depths": alt_depths, "alt_freqs": alt_freqs, "sample_offsets": sample_offsets,
+            "row_offsets": row_offsets, "rows": b"".join(row_text), "alt_offsets": alt_offsets, "alts": b"".join(alts)}
+
+
+def write_block(file_path: str, columns: dict, header: dict, magic: bytes = BLOCK_MAGIC) -> int:
+    """
+    Write columns to a block file behind a json header, the file is replaced in one step so a
+    process mapping it never sees a partly written block.
+    :param file_path: the block file
+    :param columns: column name to an array (or bytes, stored as unsigned chars)
+    :param header: json serializable fields stored with the layout of the columns
+    :param magic: the bytes the file starts with
+    Returns the size of the block in bytes
+    """
+    columns, layout, size = column_layout(columns)
+    header = {**header, "byteorder": sys.byteorder, "layout": {key: list(val) for key, val in layout.items()}}
+    encoded = json.dumps(header).encode("utf-8")
+    header_start = len(magic) + 4
+    data_start = aligned(header_start + len(encoded))
+    block = bytearray(data_start + size)
+    block[:header_start] = magic + struct.pack("<I", len(encoded))
+    block[header_start:header_start + len(encoded)] = encoded
+    write_columns(memoryview(block)[data_start:], columns, layout)
+    temp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "wb") as block_out:
+            block_out.write(block)
+        os.replace(temp_path, file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return len(block)
+
+
+def map_block(file_path: str, magic: bytes = BLOCK_MAGIC) -> Tuple[dict, dict]:
+    """
+    Memory map a block file, a ValueError is raised if it is not a block written on a machine of the same byte order
+    Returns the header and the columns as memoryviews of the mapping
+    """
+    with open(file_path, "rb") as block_in:
+        mapped = mmap.mmap(block_in.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if mapped[:len(magic)] != magic:
+            raise ValueError("not a block")
+        header_size, = struct.unpack_from("<I", mapped, len(magic))
+        header_start = len(magic) + 4
+        header = json.loads(mapped[header_start:header_start + header_size])
+        if header["byteorder"] != sys.byteorder:
+            raise ValueError("block written with a different byte order")
+        layout = {key: ColumnLayout(*val) for key, val in header["layout"].items()}
+    except (KeyError, TypeError, struct.error) as err:
+        raise ValueError(f"malformed block header: {err}")
+    return header, attach_columns(memoryview(mapped)[aligned(header_start + header_size):], layout)
+
+
+def block_path(file_path: str = None) -> str:
+    """
+    The path to publish a block to, a new temporary file when none is given
+    """
+    if file_path is not None:
+        return file_path
+    handle, file_path = tempfile.mkstemp(suffix=BLOCK_SUFFIX, prefix="VCFViz_")
+    os.close(handle)
+    return file_path
+
+
+def publish_coverage(store, file_path: str = None) -> str:
+    """
+    Write the depth arrays of a CoverageStore to a block, each sample is a column
+    Returns the path of the block for workers to attach to
+    """
+    file_path = block_path(file_path)
+    write_block(file_path, store.samples, {"contigs": store.contigs, "samples": list(store.samples)})
+    return file_path
+
+
+def attach_coverage(file_path: str):
+    """
+    Map published coverage into a read only CoverageStore, its depths are views of the block
+    """
+    from VCFViz.CoverageData import CoverageStore
+    header, columns = map_block(file_path)
+    store = CoverageStore()
+    store.contigs = {key: list(val) for key, val in header["contigs"].items()}
+    store.samples = {i: columns[i] for i in header["samples"]}
+    return store
+
+
+def publish_variants(samples: list, file_path: str = None) -> str:
+    """
+    Write the variants of ReadIvar like objects to a block in the columns of variant_columns
+    Returns the path of the block for workers to attach to
+    """
+    file_path = block_path(file_path)
+    write_block(file_path, variant_columns(samples), {"samples": [[i.sample_name, i.filename] for i in samples]})
+    return file_path
+
+
+def attach_variants(file_path: str) -> list:
+    """
+    Map published variants into a CachedIvar per sample, usable in place of the ReadIvar objects
+    they were published from. Each samples columns are views of its rows in the block.
+    """
+    from VCFViz.IvarCache import CachedIvar
+    header, columns = map_block(file_path)
+    offsets = columns["sample_offsets"]
+    samples = []
+    for idx, (sample_name, filename) in enumerate(header["samples"]):
+        start, end = offsets[idx], offsets[idx + 1]
+        sample_columns = {key: columns[key][start:end] for key in ("positions", "alt_depths", "alt_freqs")}
+        sample_columns.update({key: columns[key][start:end + 1] for key in ("row_offsets", "alt_offsets")})
+        sample_columns.update({key: columns[key] for key in ("rows", "alts")})
+        sample = CachedIvar(filename, sample_columns)
+        sample.sample_name = sample_name
+        samples.append(sample)
+    return samples
@@ -0,0 +1,260 @@
+"""
+Create a longitudinal trend report from the results saved by each run, showing how
+the mutations of each lineage change over time at each site without re-reading any
+ivar files or bams.
+
+Each run is reduced to per site and collection date sums of the alt frequencies and
+counts of covered samples for every mutation. The reduction is cached next to the
+runs results and reused while the results file is unchanged, so adding a run to a
+year of runs only reads the new run. Runs matched against different metadata sheets
+(panels) are not pooled, a trend report is written for each panel.
+"""
+
+from datetime import datetime
+import html
+import json
+import os
+import re
+from typing import List
+from VCFViz.InputOptions import panel_outputs
+from VCFViz.MatchedResults import MatchedResults, RESULTS_FILE
+from VCFViz.RenderHTML import VCFDataHTML
+from VCFViz.VCFlogging import VCFLogger as vlog
+
+TREND_CACHE = ".VCFViz_trend_cache.json"
+TREND_REPORT = "VCFViz_trend.html"
+TREND_VERSION = 2
+DEFAULT_SITE_PATTERN = r"^[^_]+_(?P<site>[^_]+)" # e.g. AB16 from 22_AB16_GP_0414
+UNASSIGNED_SITE = "Unassigned"
+
+
+def find_results(input_directory: str) -> List[str]:
+    """
+    Find the saved results of every run below the input directory
+    """
+    found = []
+    for root, dirs, files in os.walk(input_directory):
+        dirs.sort()
+        if RESULTS_FILE in files:
+            found.append(os.path.join(root, RESULTS_FILE))
+    return found
+
+
+def sample_groups(results: MatchedResults, site_pattern: re.Pattern) -> dict:
+    """
+    Group the sample columns of the results by site and date, samples without a
+    collection date are placed on the date the results were created.
+    """
+    run_date = (results.created or "")[:10]
+    groups = {}
+    for idx, (name, date) in enumerate(zip(results.samples, results.sample_dates)):
+        match = site_pattern.search(name)
+        site = match.group("site") if match else UNASSIGNED_SITE
+        groups.setdefault((site, date or run_date), []).append(idx)
+    return groups
+
+
+def panel_name(results: MatchedResults) -> str:
+    """
+    The panel of the results, the name of the metadata sheet they were matched against
+    """
+    return os.path.splitext(os.path.basename(results.metadata_sheet or "panel"))[0]
+
+
+def aggregate_run(results: MatchedResults, cov_thresh: int, site_pattern: re.Pattern) -> dict:
+    """
+    Reduce the results of a run to sums of alt frequencies and counts of covered samples
+    for each mutation at each site and date. Covered samples without a matched variant add
+    an alt frequency of 0. The sample columns of each row are reordered once so that every
+    site and date is a contiguous slice, summed without a loop over its samples.
+    """
+    groups = sample_groups(results, site_pattern)
+    points = [{"site": site, "date": date, "samples": len(columns), "lineages": {}} for (site, date), columns in groups.items()]
+    order = [i for columns in groups.values() for i in columns]
+    bounds = []
+    for columns in groups.values():
+        start = bounds[-1][1] if bounds else 0
+        bounds.append((start, start + len(columns)))
+    mutations = {}
+    min_depth = max(cov_thresh, 1)
+    for lineage, lineage_results in results.lineages.items():
+        mutations[lineage] = [f"{i.AAName}|{i.NucName}" for i in lineage_results.mutations]
+        n_samples = lineage_results.n_samples
+        point_data = [{"sums": [], "counts": []} for _ in points]
+        for point, data in zip(points, point_data):
+            point["lineages"][lineage] = data
+        for m_idx in range(len(lineage_results.mutations)):
+            row = slice(m_idx * n_samples, (m_idx + 1) * n_samples)
+            depths, freqs = lineage_results.depths[row], lineage_results.alt_freqs[row]
+            covered = [depths[i] >= min_depth for i in order]
+            values = [0.0 if f != f or not c else f for f, c in zip([freqs[i] for i in order], covered)] # nan is unmatched
+            for data, (start, end) in zip(point_data, bounds):
+                data["sums"].append(sum(values[start:end]))
+                data["counts"].append(sum(covered[start:end]))
+    return {"panel": panel_name(results), "mutations": mutations, "points": points}
+
+
+def run_aggregate(results_path: str, cov_thresh: int, site_pattern: re.Pattern) -> dict:
+    """
+    Return the aggregate of a run, from its cache if the results have not changed since it was made
+    """
+    stat = os.stat(results_path)
+    key = [TREND_VERSION, stat.st_mtime_ns, stat.st_size, cov_thresh, site_pattern.pattern]
+    cache_path = os.path.join(os.path.dirname(results_path), TREND_CACHE)
+    try:
+        with open(cache_path, "r") as cache:
+            cached = json.load(cache)
+        if cached["key"] == key:
+            return cached["aggregate"]
+    except (OSError, ValueError, KeyError):
+        pass
+    vlog.logger.info(f"Aggregating {results_path}")
+    aggregate = aggregate_run(MatchedResults.load(results_path), cov_thresh, site_pattern)
+    try:
+        with open(cache_path, "w") as cache:
+            json.dump({"key": key, "aggregate": aggregate}, cache)
+    except OSError:
+        vlog.logger.warning(f"Could not write trend cache {cache_path}")
+    return aggregate
+
+
+def combine_aggregates(aggregates: List[dict]):
+    """
+    Combine run aggregates into lineage -> site -> date -> mutation -> [sum, count], runs
+    sharing a site and date are pooled. Returns the mutations of each lineage in the order
+    they were first seen, the combined series and the sample counts of each site and date.
+    """
+    mutations = {}
+    series = {}
+    sample_counts = {}
+    for aggregate in aggregates:
+        for lineage, labels in aggregate["mutations"].items():
+            known = mutations.setdefault(lineage, [])
+            known.extend([i for i in labels if i not in known])
+        for point in aggregate["points"]:
+            point_key = (point["site"], point["date"])
+            sample_counts[point_key] = sample_counts.get(point_key, 0) + point["samples"]
+            for lineage, data in point["lineages"].items():
+                cells = series.setdefault(lineage, {}).setdefault(point["site"], {}).setdefault(point["date"], {})
+                for label, m_sum, m_count in zip(aggregate["mutations"][lineage], data["sums"], data["counts"]):
+                    cell = cells.setdefault(label, [0.0, 0])
+                    cell[0] += m_sum
+                    cell[1] += m_count
+    return mutations, series, sample_counts
+
+
+def mean_frequency(cell) -> float:
+    """
+    The mean alt frequency of a combined cell, or None if no sample was covered
+    """
+    if cell is None or not cell[1]:
+        return None
+    return cell[0] / cell[1]
+
+
+def lineage_signal(cells: dict) -> float:
+    """
+    The mean of the mean alt frequencies of the covered mutations of a lineage
+    """
+    means = [i for i in map(mean_frequency, cells.values()) if i is not None]
+    if not means:
+        return None
+    return sum(means) / len(means)
+
+
+def value_cell(value: float) -> str:
+    """
+    A heatmap cell of a trend table
+    """
+    text_style = f"color:{VCFDataHTML.css_text_colour};font-weight: 600;padding: 10px;font-size:50px"
+    if value is None:
+        return f"<td style=\"{text_style}\">NC</td>"
+    colour = VCFDataHTML.CSS_colours[VCFDataHTML.pick_colour(min(value, 1.0))]
+    return f"<td bgcolor={colour} style=\"{text_style}\">{round(value, 3)}</td>"
+
+
+def trend_table(row_names: List[str], dates: List[str], values) -> List[str]:
+    """
+    Create a table with a row per name and a column per date, values is called with
+    the row name and date of each cell.
+    """
+    html_table = [VCFDataHTML.table_tags[0], "<thead>", VCFDataHTML.row_tags[0], "<th></th>"]
+    html_table.extend([f"<th style=\"transform: rotate(180deg);padding:25px;font-size:50px;writing-mode:vertical-lr;\">{i}</th>"
+                        for i in dates])
+    html_table.extend([VCFDataHTML.row_tags[1], "</thead>"])
+    for name in row_names:
+        html_table.append("<tr style=\"height:200px;width:50px\">")
+        html_table.append(f"<td style=\"font-weight: 600;padding: 10px;font-size:50px;\">{name}</td>")
+        html_table.extend([values(name, date) for date in dates])
+        html_table.append(VCFDataHTML.row_tags[1])
+    html_table.append(VCFDataHTML.table_tags[1])
+    return html_table
+
+
+def trend_html(mutations: dict, series: dict, sample_counts: dict, banner: List[str]) -> str:
+    """
+    Create the trend report, a summary table of the lineage signal at each site followed
+    by a mutation by date table for each site.
+    """
+    html_pages = []
+    for lineage, sites in series.items():
+        dates = sorted({date for site in sites.values() for date in site})
+        html_pages.append(f"<a id=\"{lineage}\"></a>")
+        html_pages.append(f"<h1>{lineage}</h1>")
+        html_pages.extend(trend_table(sorted(sites), dates, lambda site, date: value_cell(
+            lineage_signal(sites[site][date]) if date in sites[site] else None)))
+        for site in sorted(sites):
+            site_dates = sorted(sites[site])
+            html_pages.append(f"<h1>{lineage} {site}</h1>")
+            samples_row = ["<tr>", "<td style=\"font-weight: 600;padding: 10px;font-size:50px;\">Samples</td>"]
+            samples_row.extend([f"<td style=\"padding: 10px;font-size:50px;\">{sample_counts[(site, i)]}</td>" for i in site_dates])
+            samples_row.append("</tr>")
+            table = trend_table(mutations[lineage], site_dates, lambda label, date: value_cell(
+                mean_frequency(sites[site][date].get(label))))
+            html_pages.extend(table[:-1] + samples_row + table[-1:])
+
+    nav = [f"{VCFDataHTML.nav_element[0].replace('@', i)}{i}{VCFDataHTML.nav_element[1]}" for i in series]
+    html_doc = [VCFDataHTML.html_meta_start, VCFDataHTML.banner_tags[0], *[f"<h1>{html.escape(i)}</h1>" for i in banner], VCFDataHTML.banner_tags[1],
+                VCFDataHTML.side_bar_nav[0], *nav, VCFDataHTML.side_bar_nav[1], "<div class=\"main\">", *html_pages, "</div>",
+                VCFDataHTML.html_meta_end]
+    return "\n".join(html_doc)
+
+
+def trend_report(input_directory: str, output_directory: str, coverage_threshold: int, site_pattern: str = DEFAULT_SITE_PATTERN,
+                lineages: List[str] = None):
+    """
+    Create a trend report from the saved results of every run below the input directory. Runs
+    are grouped by their panel, with several panels each report is written to a subdirectory of
+    the output directory named after the panel, see panel_outputs.
+    :param site_pattern: regular expression with a named group site, matched against sample names
+    :param lineages: only report these lineages, all are reported if not specified
+    """
+    start = datetime.now()
+    try:
+        pattern = re.compile(site_pattern)
+    except re.error as err:
+        vlog.logger.critical(f"Invalid site pattern {site_pattern}: {err}")
+        exit(-1)
+    if "site" not in pattern.groupindex:
+        vlog.logger.critical(f"Site pattern {site_pattern} needs a named group (?P<site>...)")
+        exit(-1)
+    results_files = find_results(input_directory)
+    if not results_files:
+        vlog.logger.critical(f"No saved results {RESULTS_FILE} found in {input_directory}")
+        exit(-1)
+    panels = {}
+    for results_path in results_files:
+        aggregate = run_aggregate(results_path, coverage_threshold, pattern)
+        panels.setdefault(aggregate["panel"], []).append(aggregate)
+    os.makedirs(output_directory, exist_ok=True)
+    for panel, panel_dir in panel_outputs(list(panels), output_directory).items():
+        mutations, series, sample_counts = combine_aggregates(panels[panel])
+        if lineages is not None:
+            series = {key: val for key, val in series.items() if key in lineages}
+        banner = [f"Trend of {len(panels[panel])} runs of panel {panel} in: {input_directory}", f"Time trend report created: {datetime.now()}",
+                    f"Depth of Coverage Threshold: {coverage_threshold}", f"Site pattern: {site_pattern}"]
+        report_path = os.path.join(panel_dir, TREND_REPORT)
+        with open(report_path, "w") as report:
+            report.write(trend_html(mutations, series, sample_counts, banner))
+        vlog.logger.info(f"Created trend report {report_path} of {len(panels[panel])} runs")
+    vlog.logger.info(f"Finished trend reports of {len(results_files)} runs in {datetime.now() - start}")
@@ -4,9 +4,12 @@ Parse an arbitrary amount of fields in a VCF file converting it into a table for
 2022-03-25: Matthew Wells
 """
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from enum import Enum, auto
+from typing import List, Tuple, Union
+import hashlib
 import os
+import threading
 
 vcffile = namedtuple('VCF', [])
 # defining VCF line types globally, not putting everything in a data class as no need to increase memory usage
@@ -48,69 +51,181 @@ class VCFLines(Enum):
     PEDIGREEDB = auto()
 
 
-def ParseVCFFields(fp: os.path) -> list:
-    """Determine the fields kept within the vcf file
+# table used to dispatch header lines on the key between ## and =
+LINE_TYPES = {
+    "fileformat": VCFLines.FILEFORMAT,
+    "source": VCFLines.SOURCE,
+    "reference": VCFLines.REFERENCE,
+    "fileDate": VCFLines.FILEDATE,
+    "filedate": VCFLines.FILEDATE,
+    "phasing": VCFLines.PHASING,
+    "commandline": VCFLines.COMMANDLINE,
+    "FILTER": VCFLines.FILTER,
+    "INFO": VCFLines.INFO,
+    "FORMAT": VCFLines.FORMAT,
+    "ALT": VCFLines.ALT,
+    "assembly": VCFLines.ASSEMBLY,
+    "contig": VCFLines.CONTIG,
+    "SAMPLE": VCFLines.SAMPLE,
+    "PEDIGREE": VCFLines.PEDIGREE,
+    "pedigreeDB": VCFLines.PEDIGREEDB,
+}
+
+HEADER_CACHE_SIZE = 64 # distinct headers kept, files of one caller share a header
+_header_cache = OrderedDict()
+_header_cache_lock = threading.Lock()
+
+
+class VCFHeader:
+    """
+    The parsed ## lines of a vcf file. Structured lines (e.g. INFO, FORMAT, contig) are kept
+    by line type and ID, all other lines by their key. Headers are shared between files with
+    the same header so should not be modified.
+    """
+    def __init__(self, lines: List[str]) -> None:
+        self.lines = lines
+        self.fileformat = None
+        self.structured = {i: {} for i in VCFLines} # line type to ID to the fields of the line
+        self.meta = {} # key to the values of lines not in LINE_TYPES, and unstructured lines of a known type
+        for line in lines:
+            self.add_line(line)
+
+    def add_line(self, vcf_line: str):
+        line_type, key, value = process_vcf_line(vcf_line)
+        if line_type == VCFLines.FILEFORMAT:
+            self.fileformat = value
+        if isinstance(value, dict) and line_type is not None:
+            if line_type in (VCFLines.INFO, VCFLines.FORMAT) and "ID" not in value:
+                raise ValueError(f"VCF header line has no ID: {vcf_line}")
+            table = self.structured[line_type]
+            table[value.get("ID", str(len(table)))] = value # pedigree lines have no ID
+        else:
+            self.meta.setdefault(key, []).append(value)
+
+    @property
+    def info(self) -> dict:
+        return self.structured[VCFLines.INFO]
+
+    @property
+    def format(self) -> dict:
+        return self.structured[VCFLines.FORMAT]
+
+    @property
+    def filters(self) -> dict:
+        return self.structured[VCFLines.FILTER]
+
+    @property
+    def contigs(self) -> dict:
+        return self.structured[VCFLines.CONTIG]
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+
+def ParseVCFFields(fp: os.path) -> VCFHeader:
+    """Parse the header of a vcf file
     
     VCF file do follow a standard which can be easily googled, however fields may change within them.
-    Additionally, VCF files are often compressed so in the future compression libraries will be required
 
     :param fp: The vcf file to be read
-    :return: Return a list of the column headers within the vcf file
+    :return: The parsed header of the vcf file
     """
-    headers_and_information = []
+    from VCFViz.VCFToJson import open_vcf # VCFToJson imports this module
+    with open_vcf(fp) as vcf:
+        header, _ = read_header(vcf)
+    return header
 
-    with open(fp, 'r') as vcf:
-        for line in vcf:
-            if line.startswith("##"):
-                headers_and_information.append(line)
-            else:
-                break
 
+def read_header(vcf) -> Tuple[VCFHeader, List[str]]:
+    """Read the header lines from an open vcf, stopping after the column header line
 
-def process_vcf_line(vcf_line: str) -> str:
-    """Return values format or info ID
+    :param vcf: An iterable of the lines of a vcf file
+    :return: The parsed ## lines and the column names (including samples) of the vcf table
+    """
+    lines = []
+    columns = []
+    for line in vcf:
+        if line.startswith("##"):
+            lines.append(line.rstrip("\r\n"))
+            continue
+        if line.startswith("#"):
+            columns = line.strip().lstrip("#").split("\t")
+        break
+    return parse_header_lines(lines), columns
+
+
+def parse_header_lines(lines: List[str]) -> VCFHeader:
+    """Parse the ## lines of a vcf, headers are cached by a hash of their content so
+    files sharing a header are only parsed once.
+    """
+    digest = hashlib.sha1("\n".join(lines).encode()).digest()
+    with _header_cache_lock:
+        header = _header_cache.get(digest)
+        if header is not None:
+            _header_cache.move_to_end(digest)
+            return header
+    header = VCFHeader(lines)
+    with _header_cache_lock:
+        _header_cache[digest] = header
+        if len(_header_cache) > HEADER_CACHE_SIZE:
+            _header_cache.popitem(last=False)
+    return header
+
+
+def process_vcf_line(vcf_line: str) -> Tuple[VCFLines, str, Union[str, dict]]:
+    """Return the type, key and value of a header line, the type is None for keys
+    not in LINE_TYPES.
     """
+    key, _, value = vcf_line.strip().lstrip("#").partition("=")
+    line_type = LINE_TYPES.get(key)
+    return line_type, key, split_vcf_line(value)
 
-    if vcf_line.startswith('##fileformat'):
-        split_vcf_line(vcf_line, VCFLines.FILEFORMAT)
-    elif vcf_line.startswith('##source'):
-        split_vcf_line(vcf_line, VCFLines.SOURCE)
-    elif vcf_line.startswith('##reference'):
-        split_vcf_line(vcf_line, VCFLines.REFERENCE)
-    elif vcf_line.startswith('##filedate'):
-        split_vcf_line(vcf_line, VCFLines.FILEDATE)
-    elif vcf_line.startswith('##phasing'):
-        split_vcf_line(vcf_line, VCFLines.PHASING)
-    elif vcf_line.startswith('##commandline'):
-        split_vcf_line(vcf_line, VCFLines.COMMANDLINE)
-    elif vcf_line.startswith('##FILTER'):
-        split_vcf_line(vcf_line, VCFLines.FILTER)
-    elif vcf_line.startswith('##INFO'):
-        split_vcf_line(vcf_line, VCFLines.INFO)
-    elif vcf_line.startswith('##FORMAT'):
-        split_vcf_line(vcf_line, VCFLines.FORMAT)
-    elif vcf_line.startswith('##ALT'):
-        split_vcf_line(vcf_line, VCFLines.ALT)
-    elif vcf_line.startswith('##assembly'):
-        split_vcf_line(vcf_line, VCFLines.ASSEMBLY)
-    elif vcf_line.startswith('##contig'):
-        split_vcf_line(vcf_line, VCFLines.CONTIG)
-    elif vcf_line.startswith('##SAMPLE'):
-        split_vcf_line(vcf_line, VCFLines.SAMPLE)
-    elif vcf_line.startswith('##PEDIGREE'):
-        split_vcf_line(vcf_line, VCFLines.PEDIGREE)
-    elif vcf_line.startswith('##pedigreeDB'):
-        split_vcf_line(vcf_line, VCFLines.PEDIGREEDB)
-
-    return '' # remember to delete this!!!
-
-
-def split_vcf_line(vcf_line: str, line_type: VCFLines) -> vcf_info_format:
-    """Split the vcf line to to extract field info
+
+def split_vcf_line(vcf_line: str) -> Union[str, dict]:
+    """Split the value of a vcf header line to extract field info
     
+    Structured values (<ID=DP,Number=1,...>) are split in to a dictionary of their fields, other
+    values are returned unchanged.
     :return: The split vcf line with format fields specified
     """
-    ...
-
+    if len(vcf_line) > 1 and vcf_line[0] == "<" and vcf_line[-1] == ">":
+        return split_quoted_fields(vcf_line[1:-1])
+    return vcf_line
 
 
+def split_quoted_fields(fields: str) -> dict:
+    """Split comma separated key=value pairs, commas and equals signs within double quotes are
+    part of the value. Quotes are removed and backslash escaped characters within them unescaped,
+    fields without a value are given a value of None.
+    """
+    values = {}
+    key = None
+    token = []
+    in_quotes = False
+    escaped = False
+    for char in fields + ",": # trailing comma ends the last field
+        if escaped:
+            token.append(char)
+            escaped = False
+        elif in_quotes:
+            if char == "\\":
+                escaped = True
+            elif char == "\"":
+                in_quotes = False
+            else:
+                token.append(char)
+        elif char == "\"":
+            in_quotes = True
+        elif char == "=" and key is None:
+            key = "".join(token).strip()
+            token = []
+        elif char == ",":
+            if key is not None:
+                values[key] = "".join(token)
+            elif token:
+                values["".join(token).strip()] = None
+            key = None
+            token = []
+        else:
+            token.append(char)
+    return values
@@ -22,7 +22,13 @@ They must be in that order as well.
 
 from collections import namedtuple
 from dataclasses import dataclass
-from typing import NamedTuple
+from typing import NamedTuple, List
+from array import array
+from bisect import bisect_left
+from functools import cached_property
+from VCFViz.VCFlogging import VCFLogger as vlog
+from VCFViz import VCFTable
+import gzip
 import os
 
 
@@ -36,9 +42,18 @@ class VCFTags:
 
 class FlagDescriptors(NamedTuple):
     ID: str
-    NUMBER: str
-    TYPE: str # specifies what number is as not always a number
-    DESCRIPTION: str
+    NUMBER: str = None # FILTER and ALT lines do not specify a number or type
+    TYPE: str = None # specifies what number is as not always a number
+    DESCRIPTION: str = None
+
+
+def open_vcf(file_name):
+    """
+    Open a vcf file as text, bgzipped output from bcftools is supported
+    """
+    if file_name.endswith(".gz"):
+        return gzip.open(file_name, 'rt')
+    return open(file_name, 'r')
 
 class ReadVCF:
     """
@@ -46,14 +61,16 @@ class ReadVCF:
     """
     __slots__ = ['file_name', '__dict__']
     header_info = VCFTags
-    SPLIT_CHAR = "$" # Trying to find something ascii yet not used in informatics...
     TABLE_DELIMITER = "\t"
     VCFRow = namedtuple("VCFRow", ["row", "INFO", "FORMAT"])
-    vcf_file = {}
 
     def __init__(self, file_name) -> None:
         self.table_start = None
         self.file_name = file_name
+        self.vcf_file = {} # declaring this with the class creates a shared attribute...
+        self.records = [] # every row in file order, multiple rows can share a position
+        self.samples = []
+        self.header = None
         self.read_vcf_header()  
         self.read_vcffile()  
     
@@ -64,14 +81,14 @@ class ReadVCF:
         have to take the vcf table column heads and prepare dictionaries from them of the 
         multiple different pieces of information.
         """
-        with open(self.file_name, 'r') as vcf:
+        with open_vcf(self.file_name) as vcf:
             vcf_data = vcf.readlines()
             iter_data = vcf_data[self.table_start:]
         cols = iter_data[0]
-        vcf_rows = []
         col_vals = cols.strip().strip("#").split("\t")
-        VCFData = namedtuple("VCFRow", col_vals)
+        VCFData = namedtuple("VCFRow", col_vals, rename=True) # sample names are not always valid identifiers
         sample_start = col_vals.index("FORMAT") + 1 # format is last tag in standard vcf file, adding one as 0 indexed in cols
+        self.samples = col_vals[sample_start:]
         for line in iter_data[1:]:
             vcf_row = VCFData(*line.strip().split("\t"))
             """
@@ -83,10 +100,19 @@ class ReadVCF:
             vcf_info_row = self.split_vcf_info_field(vcf_row.INFO)
             form_tags = vcf_row.FORMAT.split(":")
             sample_format_info = {}
-            for sample in vcf_row[sample_start:]:
-                sample_format_info[sample] = dict(zip(form_tags, sample.split(":")))
+            for sample_name, sample in zip(self.samples, vcf_row[sample_start:]):
+                sample_format_info[sample_name] = dict(zip(form_tags, sample.split(":")))
             mut_col = vcf_row.POS
-            self.vcf_file[mut_col] = self.VCFRow(vcf_row, vcf_info_row, sample_format_info)
+            record = self.VCFRow(vcf_row, vcf_info_row, sample_format_info)
+            self.vcf_file[mut_col] = record
+            self.records.append(record)
+
+    def sample_views(self):
+        """
+        Create a view of each sample in the vcf that can be used in place of a ReadIvar object,
+        all views share the records parsed here.
+        """
+        return [VCFSampleView(self, i) for i in self.samples]
 
             
     def split_vcf_info_field(self, vcf_info_field):
@@ -97,48 +123,28 @@ class ReadVCF:
         """
         line_split = vcf_info_field.split(";")
         information_tags = {}
+        if vcf_info_field == ".":
+            return information_tags
         for val in line_split:
-            tags = val.split("=")
-            information_tags[tags[0]] = tags[1]
+            tag, _, value = val.partition("=") # flags have no value
+            information_tags[tag] = value
         return information_tags
         
     def read_vcf_header(self):
         """
-        Open the first vcf file and parse the header attributes, all header
-        attributes begin with a ##
-        """
-        headers = []
-        with open(self.file_name, 'r') as vcf:
-            i = next(vcf)
-            track_table_op = 0
-            while i[:2] == "##":
-                headers.append(i.strip().strip("##"))
-                track_table_op += 1
-                i = next(vcf)
-
-        self.table_start = track_table_op # set where the information starts for the second read
-        for line in headers:
-            split_line = line.strip(">").split("<")
-            split_line_len = len(split_line)
-            if split_line_len > 1:
-                type_line = split_line[0].strip("=")
-                
-                # three commas seperating the values, need to split on 
-                # comma but the description tag
-                # uses those within in it, so split_char replacement makes it 
-                # easy to split the string in the right place
-                info_line = split_line[1].replace(",", self.SPLIT_CHAR, 3).split(self.SPLIT_CHAR) 
-                if type_line == "contig":
-                    #TODO make sure this can be refactored for multiple contigs
-                    type_line, self.header_info.__dict__["__annotations__"][type_line] = info_line
-                elif split_line_len > 1:
-                    type_line = split_line[0].strip("=")
-                    vals_format = {}
-                    for val in info_line:
-                        strlin = val.split("=")
-                        vals_format[strlin[0].strip('=').upper()] = strlin[1]
-                    getattr(self.header_info, type_line.upper())[vals_format["ID"]] = FlagDescriptors(**vals_format)
-                    
+        Open the vcf file and parse the header attributes, all header
+        attributes begin with a ##. Files sharing a header share the parsed header.
+        """
+        with open_vcf(self.file_name) as vcf:
+            self.header, _ = VCFTable.read_header(vcf)
+        self.table_start = len(self.header) # set where the information starts for the second read
+        for line_type in (VCFTable.VCFLines.INFO, VCFTable.VCFLines.FORMAT):
+            header_tags = getattr(self.header_info, line_type.name)
+            for tag_id, fields in self.header.structured[line_type].items():
+                header_tags[tag_id] = FlagDescriptors(**{key.upper(): val for key, val in fields.items() 
+                                                        if key.upper() in FlagDescriptors._fields})
+        self.header_info.contig.update(self.header.contigs)
+
 class IvarFields(NamedTuple):
         REGION: str
         POS: str
@@ -161,6 +167,155 @@ class IvarFields(NamedTuple):
         ALT_AA: str
 
 
+class VariantArray:
+    """
+    Position sorted typed columns of a samples variants, allowing variants to be
+    looked up in batches rather than through the position dictionary.
+    """
+    def __init__(self, rows: List[IvarFields]) -> None:
+        rows = sorted(rows, key=lambda x: int(x.POS))
+        self.positions = array("I", [int(i.POS) for i in rows])
+        self.alts = [i.ALT for i in rows]
+        self.alt_depths = array("I", [int(i.ALT_DP) for i in rows])
+        self.alt_freqs = array("d", [float(i.ALT_FREQ) for i in rows])
+
+    @classmethod
+    def from_columns(cls, positions, alts, alt_depths, alt_freqs):
+        """
+        Create a variant array from already sorted columns, e.g. the memoryviews of a memory
+        mapped IvarCache entry, without copying them.
+        """
+        variants = cls.__new__(cls)
+        variants.positions = positions
+        variants.alts = alts
+        variants.alt_depths = alt_depths
+        variants.alt_freqs = alt_freqs
+        return variants
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def find(self, position: int, alt: str) -> int:
+        """
+        Return the index of the variant with the alternate allele at the position, -1 if absent
+        """
+        idx = bisect_left(self.positions, position)
+        while idx < len(self.positions) and self.positions[idx] == position:
+            if self.alts[idx] == alt:
+                return idx
+            idx += 1
+        return -1
+
+    def find_run(self, position: int, alts: str) -> List[int]:
+        """
+        Find the indices of consecutive single base alternates starting at a position,
+        as ivar reports the bases of an MNP individually. None is returned if any are missing.
+        """
+        indices = [self.find(position + k, alt) for k, alt in enumerate(alts)]
+        if -1 in indices:
+            return None
+        return indices
+
+
+class VCFSampleView:
+    """
+    A single sample of a multi sample vcf (e.g. from bcftools merge) presented like a
+    ReadIvar object so it can be passed to the heatmap rendering. The parsed records are
+    shared with the ReadVCF object and each samples variants are only created when used.
+
+    Alleles are converted to ivar's representation, deletions and insertions are anchored on the
+    base preceding them with an ALT of -/+ the bases and equal length alleles are split into their
+    individual bases as ivar reports MNPs.
+    """
+    def __init__(self, vcf: ReadVCF, sample_name: str) -> None:
+        self.vcf = vcf
+        self.sample_name = sample_name
+        self.filename = vcf.file_name
+        self.collection_date = None
+
+    @cached_property
+    def vcf_info(self) -> dict:
+        """
+        The samples variants in the same position dictionary ReadIvar uses
+        """
+        vcf_info = {}
+        for record in self.vcf.records:
+            for ivar_row in self.record_to_ivar(record):
+                if vcf_info.get(ivar_row.POS) is None:
+                    vcf_info[ivar_row.POS] = []
+                vcf_info[ivar_row.POS].append(ivar_row)
+        return vcf_info
+
+    @cached_property
+    def variant_array(self) -> VariantArray:
+        return VariantArray([row for rows in self.vcf_info.values() for row in rows])
+
+    @staticmethod
+    def split_values(value):
+        """
+        Split a comma separated FORMAT or INFO value, missing values are returned as None
+        """
+        if value is None:
+            return []
+        return [None if i == "." else i for i in value.split(",")]
+
+    def record_to_ivar(self, record) -> List[IvarFields]:
+        """
+        Convert the samples data for a single record into ivar rows, one for each alternate
+        allele observed in the sample.
+        """
+        sample_data = record.FORMAT.get(self.sample_name, {})
+        row = record.row
+        alleles = [row.REF, *row.ALT.split(",")]
+        allele_depths = self.split_values(sample_data.get("AD"))
+        allele_freqs = self.split_values(sample_data.get("AF"))
+        genotype = set(sample_data.get("GT", ".").replace("|", "/").split("/"))
+        total_dp = sample_data.get("DP", record.INFO.get("DP"))
+        if total_dp in (None, ".") and allele_depths:
+            total_dp = sum(int(i) for i in allele_depths if i is not None)
+        passed = "TRUE" if row.FILTER in ("PASS", ".") else "FALSE"
+        ref_dp = allele_depths[0] if allele_depths and allele_depths[0] is not None else "NA"
+
+        has_dp = total_dp not in (None, ".", 0, "0")
+        ivar_rows = []
+        for allele_idx, alt in enumerate(alleles[1:], start=1):
+            alt_dp = allele_depths[allele_idx] if allele_idx < len(allele_depths) else None
+            if alt_dp is not None:
+                if int(alt_dp) == 0:
+                    continue
+            elif str(allele_idx) not in genotype:
+                continue
+            alt_freq = allele_freqs[allele_idx - 1] if allele_idx - 1 < len(allele_freqs) else None
+            if alt_freq is None:
+                if alt_dp is None or not has_dp:
+                    continue # e.g. a GT only call, without a depth there is no frequency to show
+                alt_freq = str(int(alt_dp) / int(total_dp))
+            if alt_dp is None: # only the frequency was given
+                alt_dp = str(round(float(alt_freq) * int(total_dp))) if has_dp else "0"
+
+            for pos, ref, ivar_alt in self.convert_allele(int(row.POS), row.REF, alt):
+                ivar_rows.append(IvarFields(row.CHROM, str(pos), ref, ivar_alt, ref_dp, "NA", "NA", alt_dp, "NA", "NA",
+                        alt_freq, str(total_dp), "NA", passed, "NA", "NA", "NA", "NA", "NA"))
+        return ivar_rows
+
+    @staticmethod
+    def convert_allele(pos: int, ref: str, alt: str):
+        """
+        Convert a vcf allele into ivar's (position, ref, alt) representation
+        """
+        if alt == "*" or alt.startswith("<") or alt == ".":
+            return [] # symbolic and spanning deletion alleles are not reported by ivar
+        if len(ref) == len(alt):
+            return [(pos + k, r, a) for k, (r, a) in enumerate(zip(ref, alt)) if r != a]
+        if len(ref) > len(alt) and ref.startswith(alt):
+            anchor = len(alt) - 1
+            return [(pos + anchor, ref[anchor], "-" + ref[len(alt):])]
+        if len(alt) > len(ref) and alt.startswith(ref):
+            anchor = len(ref) - 1
+            return [(pos + anchor, ref[anchor], "+" + alt[len(ref):])]
+        vlog.logger.debug(f"Complex allele {ref}>{alt} at position {pos} can not be represented as an ivar row")
+        return []
+
 
 class ReadIvar:
     """
@@ -176,6 +331,7 @@ class ReadIvar:
     def __init__(self, filename):
         self.vcf_info = {} # declaring this with the class creates a shared attribute...
         self.filename = filename
+        self.collection_date = None # set from the submission sheet if provided
         self.sample_name = self.get_sample_name(self.filename)
         self.read_ivar_file()
     
@@ -185,6 +341,13 @@ class ReadIvar:
         file_only = file_only[:file_only.index(".")] # drop extension
         return file_only
 
+    @cached_property
+    def variant_array(self) -> VariantArray:
+        """
+        The samples variants as a position sorted array, created on first use
+        """
+        return VariantArray([row for rows in self.vcf_info.values() for row in rows])
+
     def print_ivar_info(self):
         """
         For dev purposes, just to verify the ivar file is read properly
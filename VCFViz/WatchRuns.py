@@ -0,0 +1,216 @@
+"""
+Watch a wastewater input directory and process each run as it lands, rather than
+re-running wastewater-run over every run on a schedule.
+
+The input directory is polled, a run folder is ready once it has a variants and a bam
+directory whose files have not changed for the settle time. Ready runs are put on a
+work queue processed by a fixed number of workers. The metadata sheet is read once and
+only read again when it changes. Processed runs are recorded in a state file in the
+input directory so a restarted watcher does not process them again, a run is processed
+again if files are later added to or removed from it.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
+import os
+import threading
+import time
+from typing import List
+from VCFViz.InputOptions import glob_directories, ivar_reader, DEFAULT_THREADS
+from VCFViz.IvarCache import DEFAULT_CACHE_SIZE
+from VCFViz.MatchSamples import DataSheet
+from VCFViz.VCFlogging import VCFLogger as vlog
+
+WATCH_STATE = ".VCFViz_watch.json"
+DEFAULT_INTERVAL = 60 # seconds between polls
+DEFAULT_SETTLE = 120 # seconds the files of a run must be unchanged before it is processed
+
+
+def run_folders(input_directory: str) -> dict:
+    """
+    Find the run folders of the input directory with a variants and bam directory
+    """
+    runs = {}
+    with os.scandir(input_directory) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            variants = os.path.join(entry.path, "variants")
+            bams = os.path.join(entry.path, "bam")
+            if os.path.isdir(variants) and os.path.isdir(bams):
+                runs[entry.name] = (variants, bams)
+    return runs
+
+
+def folder_key(variants: str, bams: str) -> List[int]:
+    """
+    The modification times of the run directories, which change when files are added or removed
+    """
+    return [os.stat(variants).st_mtime_ns, os.stat(bams).st_mtime_ns]
+
+
+def folder_signature(variants: str, bams: str) -> List[int]:
+    """
+    The number, total size and latest modification time of the files of a run, which change
+    while files are still being written
+    """
+    n_files, total_size, latest = 0, 0, 0
+    for directory in (variants, bams):
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    n_files += 1
+                    total_size += stat.st_size
+                    latest = max(latest, stat.st_mtime_ns)
+    return [n_files, total_size, latest]
+
+
+class RunWatcher:
+    """
+    Poll an input directory and process each stable run folder through a bounded work queue
+    """
+    def __init__(self, input_directory: str, metadata: str, coverage_threshold: int, mnp_cv_threshold: float = 2.5,
+                threads: int = DEFAULT_THREADS, report_style: str = "classic", page_size: int = 100, page_order: str = "sheet",
+                database: str = None, verbose: bool = False, batch_size: int = 0, pipeline: bool = False, 
+                ivar_cache: str = None, ivar_cache_size: int = DEFAULT_CACHE_SIZE, settle: float = DEFAULT_SETTLE,
+                workers: int = 1) -> None:
+        """
+        settle: seconds the files of a run must be unchanged before it is processed
+        workers: the number of runs processed at once, further ready runs wait on the queue
+        The remaining parameters are passed to glob_directories for each run
+        """
+        self.input_directory = input_directory
+        self.metadata = metadata
+        self.run_options = dict(coverage_threshold=coverage_threshold, mnp_cv_threshold=mnp_cv_threshold, threads=threads,
+                                report_style=report_style, page_size=page_size, page_order=page_order, database=database,
+                                verbose=verbose, batch_size=batch_size, pipeline=pipeline,
+                                read_ivar=ivar_reader(ivar_cache, ivar_cache_size)) # one ivar cache for every run
+        self.settle = settle
+        self.workers = workers
+        self.state_path = os.path.join(input_directory, WATCH_STATE)
+        self.processed = self.load_state()
+        self.failed = {}
+        self.changing = {} # run -> (signature, time first seen with it)
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.sheet = None
+        self.sheet_mtime = None
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def load_state(self) -> dict:
+        try:
+            with open(self.state_path, "r") as state:
+                return json.load(state)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self):
+        with open(self.state_path, "w") as state:
+            json.dump(self.processed, state, indent=1)
+
+    def data_sheet(self) -> DataSheet:
+        """
+        The read metadata sheet, which is read again only when it has changed
+        """
+        mtime = os.stat(self.metadata).st_mtime_ns
+        if mtime != self.sheet_mtime:
+            vlog.logger.info(f"Reading metadata sheet {self.metadata}")
+            self.sheet = DataSheet(self.metadata)
+            self.sheet_mtime = mtime
+        return self.sheet
+
+    def ready_runs(self, now: float) -> list:
+        """
+        Return the runs that are not processed and whose files have not changed for the settle time
+        """
+        ready = []
+        for name, (variants, bams) in sorted(run_folders(self.input_directory).items()):
+            if name in self.queued:
+                continue
+            key = folder_key(variants, bams)
+            if self.processed.get(name) == key or self.failed.get(name) == key:
+                continue
+            signature = folder_signature(variants, bams)
+            seen = self.changing.get(name)
+            if seen is None or seen[0] != signature:
+                self.changing[name] = (signature, now)
+            elif now - seen[1] >= self.settle:
+                ready.append((name, variants, bams))
+        return ready
+
+    def process_run(self, name: str, variants: str, bams: str, sheet: DataSheet):
+        """
+        Process a run with glob_directories, writing the report to the run folder
+        """
+        start = datetime.now()
+        vlog.logger.info(f"Processing run {name}")
+        try:
+            glob_directories(variants, bams, sheet, output_directory=os.path.join(self.input_directory, name), **self.run_options)
+        except Exception:
+            vlog.logger.exception(f"Failed to process run {name}, it will be processed again if its files change")
+            with self.lock:
+                self.failed[name] = folder_key(variants, bams)
+                self.queued.discard(name)
+            return
+        with self.lock:
+            # the key is taken after processing as the coverage cache is written to the bam directory
+            self.processed[name] = folder_key(variants, bams)
+            self.changing.pop(name, None)
+            self.queued.discard(name)
+            self.save_state()
+        vlog.logger.info(f"Finished run {name} in {datetime.now() - start}")
+
+    def poll(self) -> int:
+        """
+        Queue the runs that are ready, at most workers runs are queued or running at once.
+        Returns the number of runs queued.
+        """
+        with self.lock:
+            free = self.workers - len(self.queued)
+            if free <= 0:
+                return 0
+            ready = self.ready_runs(time.monotonic())[:free]
+            if ready:
+                sheet = self.data_sheet()
+            for name, variants, bams in ready:
+                self.queued.add(name)
+                self.pool.submit(self.process_run, name, variants, bams, sheet)
+        return len(ready)
+
+    def watch(self, interval: float = DEFAULT_INTERVAL, max_polls: int = None):
+        """
+        Poll every interval seconds until interrupted, or for max_polls polls
+        """
+        vlog.logger.info(f"Watching {self.input_directory} for runs every {interval} seconds")
+        polls = 0
+        try:
+            while max_polls is None or polls < max_polls:
+                self.poll()
+                polls += 1
+                if max_polls is None or polls < max_polls:
+                    time.sleep(interval)
+        except KeyboardInterrupt:
+            vlog.logger.info("Stopping, waiting for the runs being processed to finish")
+        finally:
+            self.pool.shutdown(wait=True)
+
+
+def watch_runs(input_directory: str, metadata: str, coverage_threshold: int, mnp_cv_threshold: float = 2.5, threads: int = DEFAULT_THREADS,
+                report_style: str = "classic", page_size: int = 100, page_order: str = "sheet", database: str = None,
+                verbose: bool = False, batch_size: int = 0, pipeline: bool = False, ivar_cache: str = None,
+                ivar_cache_size: int = DEFAULT_CACHE_SIZE, interval: float = DEFAULT_INTERVAL, settle: float = DEFAULT_SETTLE,
+                workers: int = 1):
+    """
+    Watch a wastewater input directory and process each run folder once its files are stable
+    """
+    if not os.path.isdir(input_directory):
+        vlog.logger.critical(f"Input directory {input_directory} does not exist")
+        exit(-1)
+    if not os.path.isfile(metadata):
+        vlog.logger.critical(f"Metadata sheet {metadata} does not exist")
+        exit(-1)
+    watcher = RunWatcher(input_directory, metadata, coverage_threshold, mnp_cv_threshold, threads, report_style, page_size,
+                        page_order, database, verbose, batch_size, pipeline, ivar_cache, ivar_cache_size, settle, max(workers, 1))
+    watcher.watch(interval)
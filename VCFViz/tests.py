@@ -7,19 +7,63 @@ Create some unit tests for this program cause hell yeah
 
 import VCFViz.CommandLineArgs as CommandLineArgs
 import unittest
+import unittest.mock
+import pytest
 from VCFViz.RenderHTML import VCFDataHTML
+from VCFViz.MatchSamples import SampleMatcher, match_samples
+from VCFViz.MatchDiagnostics import MatchDiagnostics, NO_VARIANT, SUBSTITUTION_MISMATCH
 from VCFViz.VCFToJson import ReadIvar
 from VCFViz.VCFToJson import ReadVCF
-from VCFViz.CoverageData import CoverageData
+from VCFViz.VCFToJson import IvarFields, VariantArray
+from VCFViz import CoverageData
+from VCFViz import SharedData
+from VCFViz import DataReport
+from VCFViz import VCFTable
+from VCFViz.ResultsWarehouse import ResultsWarehouse
+from VCFViz import TrendReport
+from VCFViz import WatchRuns
+from VCFViz import SamplePipeline
+from VCFViz import IvarCache
+from VCFViz import ShardRuns
+from VCFViz import ExportResults
+from VCFViz.MatchedResults import MatchedResults, LineageResults, SpilledResults, Mutation, STAT_ROWS, QC_ROWS, RESULTS_FILE
 from VCFViz.VCFlogging import VCFLogger as vlog
 import logging
 import time
-import InputOptions
+import io
+import os
+import subprocess
+import tempfile
+import base64
+from array import array
+import re
+import math
+import VCFViz.InputOptions as InputOptions
 import sys
 import copy
 
 vlog.logger.setLevel(logging.CRITICAL)
 
+# a metadata sheet of two BA.2 mutations and an ivar file with a variant at the first
+SHEET_LINES = ["VOC\tPangoLineage\tNextStrainClade\tNucName\tAAName\tKey\tSignatureSNV\tPosition\tType\tLength\tRef\tAlt",
+    "BA.2\tBA.2\t21L\tC241T\t5UTR\tk1\tTrue\t241\tSub\t1\tC\tT",
+    "BA.2\tBA.2\t21L\tC10029T\tT3255I\tk2\tFalse\t10029\tSub\t1\tC\tT"]
+IVAR_LINES = ["REGION\tPOS\tREF\tALT\tREF_DP\tREF_RV\tREF_QUAL\tALT_DP\tALT_RV\tALT_QUAL\tALT_FREQ\tTOTAL_DP\tPVAL\tPASS" \
+    "\tGFF_FEATURE\tREF_CODON\tREF_AA\tALT_CODON\tALT_AA",
+    "MN908947.3\t241\tC\tT\t10\t0\t35\t90\t0\t35\t0.9\t100\t0\tTRUE\tNA\tNA\tNA\tNA\tNA"]
+
+
+def write_test_files(directory: str, files: dict) -> list:
+    """
+    Write the lines of each file name to the directory, returning the file paths in order
+    """
+    paths = []
+    for file_name, lines in files.items():
+        paths.append(os.path.join(directory, file_name))
+        with open(paths[-1], "w") as file_out:
+            file_out.write("\n".join(lines) + "\n")
+    return paths
+
 class TestVCFMethods(unittest.TestCase):    
     def test_initialize_voc_tables(self):
         ivar_data = ReadIvar("tests/22_AB16_GP_0414.tsv")
@@ -31,6 +75,12 @@ class TestVCFMethods(unittest.TestCase):
                 vals = len(vcf_html.figure_data[key][mut])
                 self.assertEqual(vals, len(ivar_data_list))
 
+    def test_coefficients_of_variation(self):
+        cvs = SampleMatcher.coefficients_of_variation([[80, 80, 80], [80, 20], [0, 0]])
+        self.assertEqual(cvs[0], 0)
+        self.assertAlmostEqual(cvs[1], 60.0)
+        self.assertEqual(cvs[2], float("inf"))
+
 class TestVCFToJson(unittest.TestCase):
 
     def test_ReadVCF(self):
@@ -44,6 +94,72 @@ class TestVCFToJson(unittest.TestCase):
             for val in ivar_file.vcf_info[pos]:
                 self.assertEqual(pos, val.POS)
 
+    def test_VariantArray(self):
+        rows = [IvarFields("MN908947.3", pos, "G", alt, *["0"] * 3, dp, *["0"] * 2, freq, *["NA"] * 8)
+            for pos, alt, dp, freq in (("28882", "A", "80", "0.8"), ("28881", "A", "80", "0.8"), ("28881", "T", "5", "0.1"))]
+        variants = VariantArray(rows)
+        self.assertEqual(list(variants.positions), [28881, 28881, 28882])
+        self.assertEqual(variants.find(28881, "T"), 1)
+        self.assertEqual(variants.find(28883, "C"), -1)
+        self.assertEqual(variants.find_run(28881, "AA"), [0, 2])
+        self.assertIsNone(variants.find_run(28881, "AAC"))
+
+    def test_VCFSampleView(self):
+        vcf_lines = ["##fileformat=VCFv4.2", "##FILTER=<ID=PASS,Description=\"All filters passed\">",
+            "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2",
+            "MN908947.3\t6513\t.\tGTTC\tG\t200\tPASS\tINDEL;DP=100\tGT:AD:DP\t1:60,40:100\t0:100,0:100",
+            "MN908947.3\t28881\t.\tGGG\tAAC\t200\tPASS\tDP=200\tGT:AD:DP\t1:20,80:100\t0:100,0:100",
+            "MN908947.3\t10029\t.\tC\tA,T\t200\tPASS\tDP=200\tGT:AD:DP\t1:90,10,0:100\t2:30,0,70:100"]
+        with tempfile.TemporaryDirectory() as tmp:
+            vcf_path, = write_test_files(tmp, {"merged.vcf": vcf_lines})
+            views = {i.sample_name: i for i in ReadVCF(vcf_path).sample_views()}
+        self.assertEqual(set(views), {"S1", "S2"})
+        s1 = views["S1"].vcf_info
+        self.assertEqual(s1["6513"][0].ALT, "-TTC")
+        self.assertEqual([s1[i][0].ALT for i in ("28881", "28882", "28883")], ["A", "A", "C"])
+        self.assertEqual(s1["10029"][0].ALT_FREQ, "0.1")
+        self.assertEqual(list(views["S2"].vcf_info), ["10029"])
+        self.assertEqual(views["S2"].vcf_info["10029"][0].ALT, "T")
+
+    def test_VCFSampleView_genotype_only(self):
+        vcf_lines = ["##fileformat=VCFv4.2", "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2",
+            "MN908947.3\t241\t.\tC\tT\t200\tPASS\t.\tGT\t1\t0",
+            "MN908947.3\t10029\t.\tC\tT\t200\tPASS\tDP=100\tGT:AF\t1:0.8\t0:."]
+        coverage = CoverageData.CoverageStore()
+        for name in ("S1", "S2"):
+            coverage.add_depths(name, "MN908947.3", range(1, 30001), [100] * 30000)
+        with tempfile.TemporaryDirectory() as tmp:
+            vcf_path, sheet_path = write_test_files(tmp, {"merged.vcf": vcf_lines, "sheet.txt": SHEET_LINES})
+            views = ReadVCF(vcf_path).sample_views()
+            results = match_samples(views, sheet_path, coverage)
+        self.assertEqual(list(views[0].vcf_info), ["10029"]) # no depth or frequency to show for 241
+        self.assertEqual(views[0].vcf_info["10029"][0].ALT_DP, "80")
+        self.assertEqual(results.lineage_table("BA.2", 30)[1 + len(QC_ROWS):3 + len(QC_ROWS)],
+                        [["5UTR|C241T", "WT", "WT"], ["T3255I|C10029T", "0.8", "WT"]])
+
+class TestVCFTable(unittest.TestCase):
+    """
+    Test the vcf header parser
+    """
+    def test_split_quoted_fields(self):
+        fields = VCFTable.split_quoted_fields('ID=DP,Number=1,Description="Depth, summed \\"raw\\" a=b",Flag')
+        self.assertEqual(fields, {"ID": "DP", "Number": "1", "Description": "Depth, summed \"raw\" a=b", "Flag": None})
+
+    def test_read_header(self):
+        header_lines = ["##fileformat=VCFv4.2", "##INFO=<ID=DP,Number=1,Type=Integer,Description=\"Depth, summed\">",
+            "##contig=<ID=MN908947.3,length=29903>", "##bcftools_mergeCommand=merge -o merged.vcf"]
+        first, columns = VCFTable.read_header(header_lines + ["#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1"])
+        second, other_columns = VCFTable.read_header(header_lines + ["#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS2"])
+        self.assertIs(first, second) # parsed once and shared
+        self.assertEqual((columns[-1], other_columns[-1]), ("S1", "S2"))
+        self.assertEqual(first.fileformat, "VCFv4.2")
+        self.assertEqual(first.info["DP"]["Description"], "Depth, summed")
+        self.assertEqual(first.contigs["MN908947.3"]["length"], "29903")
+        self.assertEqual(first.meta["bcftools_mergeCommand"], ["merge -o merged.vcf"])
+        self.assertEqual(len(first), 4)
+        with self.assertRaisesRegex(ValueError, "Number=1"):
+            VCFTable.parse_header_lines(["##INFO=<Number=1,Type=Integer,Description=\"No ID\">"])
+
 class TestVCFRenderHTML(unittest.TestCase):
     """
     Updated functionality of the class broke the test, need to rewrite
@@ -65,6 +181,240 @@ class TestVCFRenderHTML(unittest.TestCase):
     #    end =  time.time()
     #    vlog.logger.critical(f"Time to run 100 files {round(end - start, 3)} seconds")
 
+class TestMatchedResults(unittest.TestCase):
+    """
+    Test the result matrices and the report data created from them
+    """
+    @staticmethod
+    def create_results():
+        mutations = [Mutation("C241T", "C241T", "5UTR", 241, "Sub", "C", "T", "True"),
+                    Mutation("C10029T", "C10029T", "T3255I", 10029, "Sub", "C", "T", "False")]
+        lineage = LineageResults(mutations, 3)
+        for idx, (freq, depth, flag) in enumerate([(0.9, 100, 0), (0.5, 10, 0), (float("nan"), 0, 0), 
+                                                    (float("nan"), 20, 1), (float("nan"), 100, 0), (float("nan"), 100, 1)]):
+            lineage.alt_freqs[idx], lineage.depths[idx], lineage.alt_flags[idx] = freq, depth, flag
+        return MatchedResults(["s1", "s2", "s3"], {"BA.2": lineage}, "sheet.txt")
+
+    def test_status(self):
+        lineage = self.create_results().lineages["BA.2"]
+        statuses = [lineage.status(m_idx, s_idx, 30) for m_idx in range(2) for s_idx in range(3)]
+        self.assertEqual(statuses, ["0.9", "LC", "NC", "ALT_LC", "WT", "ALT"])
+
+    def test_encode_lineage(self):
+        lineage = self.create_results().lineages["BA.2"]
+        codes = array("h", base64.b64decode(DataReport.encode_lineage(lineage, 30)))
+        self.assertEqual(list(codes[:6]), [900, -1, -2, -4, -5, -6])
+        self.assertEqual(list(codes[6:9]), [450, 250, 0]) # mean of each sample
+        self.assertEqual(len(codes), 6 + 3 * len(STAT_ROWS))
+
+    def test_stats(self):
+        stats = self.create_results().lineages["BA.2"].stats(30)
+        self.assertEqual(list(stats["Mean alt freq"]), [0.45, 0.25, 0.0])
+        self.assertEqual(list(stats["Median alt freq"]), [0.45, 0.25, 0.0])
+        self.assertEqual(list(stats["Covered mean alt freq"]), [0.9, 0.0, 0.0])
+        self.assertTrue(math.isnan(stats["Selected covered mean alt freq"][1]))
+        self.assertEqual(list(stats["Selected mean alt freq"]), [0.9, 0.5, 0.0])
+
+    def test_data_report(self):
+        report = DataReport.data_report_html(self.create_results(), 30, "</script>", VCFDataHTML.CSS_colours)
+        self.assertEqual(report.count("</script>"), 2)
+        self.assertIn("\"samples\":[\"s1\",\"s2\",\"s3\"]", report)
+
+    def test_page_columns(self):
+        vcf_html = VCFDataHTML.__new__(VCFDataHTML)
+        vcf_html.results = self.create_results()
+        vcf_html.results.sample_dates = ["2022-05-01", "", "2022-04-14"]
+        vcf_html.page_size = 2
+        vcf_html.page_order = "sheet"
+        self.assertEqual(vcf_html.page_columns(), [[0, 1], [2]])
+        vcf_html.page_order = "date"
+        self.assertEqual(vcf_html.page_columns(), [[2, 0], [1]])
+
+    def test_from_results(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for cov_thresh, expected in ((30, ">LC</td>"), (5, ">0.5</td>")):
+                VCFDataHTML.from_results(self.create_results(), cov_thresh, tmp, colour_scale="grey")
+                with open(os.path.join(tmp, "BA.2_test.html")) as rendered:
+                    html = rendered.read()
+                self.assertIn(expected, html)
+                self.assertIn(VCFDataHTML.COLOUR_SCALES["grey"][9], html)
+
+    def test_lineage_table(self):
+        table = self.create_results().lineage_table("BA.2", 30)
+        self.assertEqual(table[0], ["NucName+AAName", "s1", "s2", "s3"])
+        self.assertEqual(table[2], ["T3255I|C10029T", "ALT_LC", "WT", "ALT"])
+        self.assertEqual(table[3], ["Mean alt freq", "0.45", "0.25", "0.0"])
+
+    def test_long_format_batches(self):
+        batches = list(ExportResults.long_format_batches(self.create_results(), 30, "run1", batch_rows=4))
+        self.assertEqual([len(i["run"]) for i in batches], [4, 2])
+        self.assertEqual(list(batches[0]), list(ExportResults.EXPORT_COLUMNS))
+        self.assertEqual(batches[0]["sample"], ["s1", "s2", "s3", "s1"])
+        self.assertEqual(batches[1]["status"], ["WT", "ALT"])
+        self.assertIsNone(batches[1]["alt_freq"][0])
+
+    def test_run_names(self):
+        self.assertEqual(ExportResults.run_names(["/out/run1/voc/" + RESULTS_FILE, "/out/run1/markers/" + RESULTS_FILE]),
+                        ["run1/voc", "run1/markers"])
+        self.assertEqual(ExportResults.run_names(["/out/run1/" + RESULTS_FILE, "/out/run2/" + RESULTS_FILE]), ["out/run1", "out/run2"])
+        self.assertEqual(ExportResults.run_names(["/out/run1/" + RESULTS_FILE]), ["run1"])
+
+    def test_write_results_table(self):
+        pa = pytest.importorskip("pyarrow")
+        pq = pytest.importorskip("pyarrow.parquet")
+        with tempfile.TemporaryDirectory() as tmp:
+            for export_format in ("parquet", "arrow"):
+                file_path = os.path.join(tmp, ExportResults.EXPORT_FILES[export_format])
+                n_rows = ExportResults.write_results_table([("run1", self.create_results()), ("run2", self.create_results())],
+                                                            file_path, 30, export_format, row_group_size=4)
+                self.assertEqual(n_rows, 12)
+                if export_format == "parquet":
+                    self.assertEqual(pq.ParquetFile(file_path).metadata.num_row_groups, 4)
+                    table = pq.read_table(file_path)
+                else:
+                    table = pa.ipc.open_file(file_path).read_all()
+                self.assertEqual(table.column_names, list(ExportResults.EXPORT_COLUMNS))
+                self.assertEqual(table.column("run").to_pylist(), ["run1"] * 6 + ["run2"] * 6)
+                self.assertEqual(table.column("status").to_pylist()[:6], ["0.9", "LC", "NC", "ALT_LC", "WT", "ALT"])
+            self.assertEqual(sorted(os.listdir(tmp)), sorted(ExportResults.EXPORT_FILES.values())) # no temporary files left
+
+    def test_match_samples(self):
+        coverage = CoverageData.CoverageStore()
+        coverage.add_depths("S1", "MN908947.3", range(1, 30001), [100] * 30000)
+        with tempfile.TemporaryDirectory() as tmp:
+            sheet_path, ivar_path = write_test_files(tmp, {"sheet.txt": SHEET_LINES, "S1.tsv": IVAR_LINES})
+            diagnostics = MatchDiagnostics()
+            results = match_samples([ReadIvar(ivar_path)], sheet_path, coverage, diagnostics=diagnostics)
+            self.assertEqual(sorted(os.listdir(tmp)), ["S1.tsv", "sheet.txt"]) # nothing is written
+            verbose = MatchDiagnostics(verbose=True)
+            match_samples([ReadIvar(ivar_path)], sheet_path, coverage, diagnostics=verbose)
+        self.assertEqual(verbose.counts, diagnostics.counts) # counted per cell rather than in bulk
+        self.assertEqual((diagnostics.examples, verbose.examples[("BA.2", "C10029T", NO_VARIANT)]), ({}, [("S1",)]))
+        self.assertEqual(results.samples, ["S1"])
+        table = results.lineage_table("BA.2", 30)
+        self.assertEqual(table[1:1 + len(QC_ROWS)], [["Mean depth", "100.0"], ["Breadth 1x", "1.0"], ["Breadth 10x", "1.0"],
+                                                    ["Breadth 30x", "1.0"], ["Breadth 100x", "1.0"], ["Panel below threshold", "0.0"]])
+        self.assertEqual(table[1 + len(QC_ROWS):3 + len(QC_ROWS)], [["5UTR|C241T", "0.9"], ["T3255I|C10029T", "WT"]])
+        self.assertEqual(dict(diagnostics.counts), {("BA.2", "C10029T", NO_VARIANT): 1})
+
+    def test_sample_pipeline(self):
+        cached = CoverageData.CoverageStore()
+        names = [f"S{i}" for i in range(12)]
+        for name in names:
+            cached.add_depths(name, "MN908947.3", range(1, 30001), [20 if name == "S3" else 100] * 30000)
+        with tempfile.TemporaryDirectory() as tmp:
+            sheet_path, = write_test_files(tmp, {"sheet.txt": SHEET_LINES[:2]})
+            ivar_paths = write_test_files(tmp, {f"{name}.tsv": IVAR_LINES for name in names})
+            matcher = SampleMatcher(sheet_path, None)
+            pipeline = SamplePipeline.SamplePipeline(ReadIvar, tmp, cached, threads=4, queue_size=2)
+            samples, computed = pipeline.run(ivar_paths, matcher)
+        results = matcher.results(samples)
+        self.assertEqual(results.samples, names) # input order is kept
+        self.assertEqual(len(computed), 0) # every depth was cached
+        self.assertEqual(results.lineage_table("BA.2", 30)[1 + len(QC_ROWS)][1:5], ["0.9", "0.9", "0.9", "LC"])
+
+    def test_match_diagnostics(self):
+        diagnostics = MatchDiagnostics(max_examples=2)
+        for sample in ("s1", "s2", "s3"):
+            diagnostics.record("BA.2", "C241T", SUBSTITUTION_MISMATCH, sample, "C241A")
+        other = MatchDiagnostics(max_examples=2)
+        other.record("BA.2", "C241T", SUBSTITUTION_MISMATCH, "s4", "C241G")
+        other.record("BA.2", "C10029T", NO_VARIANT, "s4")
+        diagnostics.merge(other)
+        self.assertEqual(diagnostics.counts[("BA.2", "C241T", SUBSTITUTION_MISMATCH)], 4)
+        self.assertEqual(diagnostics.examples[("BA.2", "C241T", SUBSTITUTION_MISMATCH)], [("s1", "C241A"), ("s2", "C241A")])
+        table = diagnostics.summary_table()
+        self.assertEqual(len(table), 5) # header, two reason totals, header and the substitution mismatch
+        self.assertIn("s1 C241A; s2 C241A", table[-1])
+        self.assertEqual(diagnostics.to_json()[0]["count"], 4)
+
+    def test_save_load_merge(self):
+        results = self.create_results()
+        with tempfile.TemporaryDirectory() as tmp:
+            results_path = os.path.join(tmp, "results.zip")
+            results.save(results_path, 30)
+            loaded = MatchedResults.load(results_path)
+        self.assertEqual(loaded.samples, results.samples)
+        self.assertEqual(list(loaded.lineages["BA.2"].stats_cache[30]["Mean alt freq"]), [0.45, 0.25, 0.0]) # saved, not found again
+        self.assertEqual(loaded.metadata_sheet, "sheet.txt")
+        self.assertEqual([loaded.lineages["BA.2"].status(1, s_idx, 30) for s_idx in range(3)], ["ALT_LC", "WT", "ALT"])
+        added = MatchedResults(["s4"], {"BA.2": LineageResults(results.lineages["BA.2"].mutations, 1)})
+        merged = loaded.merge(added)
+        self.assertEqual(merged.samples, ["s1", "s2", "s3", "s4"])
+        self.assertEqual(merged.lineages["BA.2"].status(0, 0, 30), "0.9")
+        self.assertEqual(merged.lineages["BA.2"].status(0, 3, 30), "NC")
+        self.assertEqual(list(merged.lineages["BA.2"].stats(30)["Mean alt freq"]), [0.45, 0.25, 0.0, 0.0])
+
+    def test_spilled_results(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            spilled = SpilledResults(os.path.join(tmp, "batches"), "sheet.txt")
+            spilled.add_batch(self.create_results())
+            spilled.add_batch(self.create_results())
+            self.assertEqual(spilled.samples, ["s1", "s2", "s3"] * 2)
+            lineage = spilled.lineages["BA.2"]
+            self.assertEqual([lineage.status(1, s_idx, 30) for s_idx in range(6)], ["ALT_LC", "WT", "ALT"] * 2)
+            results_path = os.path.join(tmp, "results.zip")
+            spilled.save(results_path)
+            spilled.cleanup()
+            self.assertFalse(os.path.exists(os.path.join(tmp, "batches")))
+            loaded = MatchedResults.load(results_path)
+        self.assertEqual(loaded.lineages["BA.2"].n_samples, 6)
+        self.assertEqual(loaded.lineages["BA.2"].status(0, 3, 30), "0.9")
+
+    def test_spilled_merge(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            spilled = SpilledResults(os.path.join(tmp, "batches"))
+            spilled.add_batch(self.create_results())
+            other = SpilledResults(os.path.join(tmp, "other"))
+            other.add_batch(self.create_results())
+            merged = spilled.merge(other).merge(self.create_results())
+            self.assertIs(merged, spilled)
+            self.assertEqual(len(merged.samples), 9)
+            self.assertEqual([merged.lineages["BA.2"].status(1, s_idx, 30) for s_idx in range(9)], ["ALT_LC", "WT", "ALT"] * 3)
+
+    def test_results_warehouse(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            database = os.path.join(tmp, "results.db")
+            with ResultsWarehouse(database) as warehouse:
+                warehouse.add_run(self.create_results(), 30)
+                run_id = warehouse.add_run(self.create_results(), 5)
+                rows = warehouse.connection.execute("SELECT sample, alt_freq, status FROM result_rows WHERE run_id = ? "
+                                                    "AND nuc_name = 'C241T' ORDER BY sample", (run_id,)).fetchall()
+                self.assertEqual(rows, [("s1", 0.9, "0.9"), ("s2", 0.5, "0.5"), ("s3", None, "NC")])
+                self.assertEqual(warehouse.connection.execute("SELECT COUNT(*) FROM mutations").fetchone()[0], 2)
+                other_panel = self.create_results()
+                other_panel.metadata_sheet = "markers.tsv"
+                other_panel.lineages["BA.2"].mutations[0] = Mutation("C241T", "C241T", "5UTR", 241, "Sub", "C", "G", "True")
+                run_id = warehouse.add_run(other_panel, 30)
+                self.assertEqual(warehouse.connection.execute("SELECT COUNT(*) FROM mutations").fetchone()[0], 4)
+                self.assertEqual(warehouse.connection.execute("SELECT DISTINCT mutations.alt FROM results JOIN samples USING (sample_id) "
+                                                            "JOIN mutations USING (mutation_id) WHERE run_id = ? AND key = 'C241T'",
+                                                            (run_id,)).fetchall(), [("G",)])
+
+    def test_trend_aggregate(self):
+        aggregate = TrendReport.aggregate_run(self.create_results(), 30, re.compile(r"^(?P<site>s[12])"))
+        self.assertEqual([(i["site"], i["samples"]) for i in aggregate["points"]], [("s1", 1), ("s2", 1), ("Unassigned", 1)])
+        self.assertEqual(aggregate["points"][0]["lineages"]["BA.2"], {"sums": [0.9, 0.0], "counts": [1, 0]})
+        mutations, series, sample_counts = TrendReport.combine_aggregates([aggregate, aggregate])
+        self.assertEqual(series["BA.2"]["s2"][""], {"5UTR|C241T": [0.0, 0], "T3255I|C10029T": [0.0, 2]})
+        self.assertEqual(TrendReport.lineage_signal(series["BA.2"]["s1"][""]), 0.9)
+        self.assertEqual(sample_counts[("s1", "")], 2)
+        self.assertEqual(aggregate["panel"], "sheet")
+
+    def test_trend_report_panels(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for panel in ("voc", "markers"):
+                results = self.create_results()
+                results.metadata_sheet = f"/sheets/{panel}.txt"
+                for run in ("run1", "run2"):
+                    os.makedirs(os.path.join(tmp, "runs", run, panel))
+                    results.save(os.path.join(tmp, "runs", run, panel, RESULTS_FILE))
+            out_dir = os.path.join(tmp, "trend") # created by the report
+            TrendReport.trend_report(os.path.join(tmp, "runs"), out_dir, 30, r"^(?P<site>s[12])")
+            self.assertEqual(sorted(os.listdir(out_dir)), ["markers", "voc"])
+            with open(os.path.join(out_dir, "voc", TrendReport.TREND_REPORT)) as report:
+                self.assertIn("Trend of 2 runs of panel voc", report.read())
+
 class TestSampleMap(unittest.TestCase):
     """
     Test the sample Coverage examples
@@ -81,8 +431,118 @@ class TestSamplesCoverage(unittest.TestCase):
     """
     Test Samplescoverage Fucntions
     """
-    ...
+    depth_output = b"MN908947.3\t1\t0\t3\nMN908947.3\t2\t5\t10\nMN908947.3\t3\t7\t12\n"
+
+    def test_parse_depth_block(self):
+        segments = CoverageData.parse_depth_block(self.depth_output, 2)
+        self.assertEqual(len(segments), 1)
+        contig, positions, columns = segments[0]
+        self.assertEqual(contig, "MN908947.3")
+        self.assertEqual(list(positions), [1, 2, 3])
+        self.assertEqual([list(i) for i in columns], [[0, 5, 7], [3, 10, 12]])
+
+    def test_parse_depth_block_contigs(self):
+        block = self.depth_output + b"contig2\t1\t4\t6\n"
+        segments = CoverageData.parse_depth_block(block, 2)
+        self.assertEqual([i[0] for i in segments], ["MN908947.3", "contig2"])
+        self.assertEqual([list(i) for i in segments[1][2]], [[4], [6]])
+
+    def test_read_depth_stream(self):
+        # small blocks split lines across reads
+        segments = list(CoverageData.read_depth_stream(io.BytesIO(self.depth_output), 2, block_size=7))
+        positions = [pos for _, i, _ in segments for pos in i]
+        depths = [depth for _, _, i in segments for depth in i[1]]
+        self.assertEqual(positions, [1, 2, 3])
+        self.assertEqual(depths, [3, 10, 12])
+
+    def test_coverage_store(self):
+        store = CoverageData.CoverageStore()
+        for contig, positions, columns in CoverageData.parse_depth_block(self.depth_output + b"contig2\t1\t4\t6\n", 2):
+            store.add_depths("s1", contig, positions, columns[0])
+            store.add_depths("s2", contig, positions, columns[1])
+        self.assertEqual(store.depth("s1", "2"), 5)
+        self.assertEqual(store.depth("s2", 3), 12)
+        self.assertEqual(store.depth("s2", 1, "contig2"), 6)
+        self.assertEqual(store.depth("s1", 40), 0)
+        self.assertEqual(list(store.depths("s2", [3, 1, "2"])), [12, 3, 10])
+        reloaded = CoverageData.CoverageStore.from_json(store.to_json())
+        self.assertEqual(reloaded.samples, store.samples)
+        self.assertEqual(reloaded.contigs, store.contigs)
 
+    def test_sample_qc(self):
+        store = CoverageData.CoverageStore()
+        for contig, positions, columns in CoverageData.read_depth_stream(io.BytesIO(self.depth_output), 2, block_size=8):
+            store.add_depths("s1", contig, positions, columns[0])
+        cached = CoverageData.CoverageStore.from_json(store.to_json()) # found from the array rather than the stream
+        for qc in (store.sample_qc("s1"), cached.sample_qc("s1")):
+            self.assertEqual(qc.mean_depth, 4.0)
+            self.assertEqual(qc.breadth, (2 / 3, 0.0, 0.0, 0.0))
+        self.assertIsNone(store.sample_qc("s2"))
+        results = MatchedResults(["s1", "s2"], {"BA.2": LineageResults([Mutation("k1", "C3T", "5UTR", 3, "Sub", "C", "T", "True")],
+                                2, depths=array("I", [5, 40]))}, sample_qc=[store.sample_qc("s1"), None])
+        self.assertEqual(results.qc_rows(30)[0], ["Mean depth", "4.0", "NA"])
+        self.assertEqual(results.qc_rows(30)[-1], ["Panel below threshold", "1.0", "0.0"])
+
+    def test_coverage_store_per_instance(self):
+        t1 = CoverageData.SamplesCoverage([])
+        t2 = CoverageData.SamplesCoverage([])
+        t1.samples_coverage.add_sample("s1")
+        self.assertNotIn("s1", t2.samples_coverage)
+
+
+class TestSharedData(unittest.TestCase):
+    """
+    Lay columns out in a block and attach to them
+    """
+    def test_variant_columns(self):
+        sample = type("Sample", (), {})()
+        sample.sample_name = "s1"
+        sample.vcf_info = {pos: [IvarFields("MN908947.3", pos, "G", "A", *["0"] * 3, "80", *["0"] * 2, "0.8", *["NA"] * 8)]
+                            for pos in ("28882", "28881")}
+        columns, layout, size = SharedData.column_layout(SharedData.variant_columns([sample]))
+        block = bytearray(size)
+        SharedData.write_columns(block, columns, layout)
+        attached = SharedData.attach_columns(block, layout)
+        self.assertEqual(list(attached["sample_offsets"]), [0, 2])
+        self.assertEqual(list(attached["positions"]), [28881, 28882])
+        self.assertEqual(list(attached["alt_freqs"]), [0.8, 0.8])
+        self.assertEqual(bytes(attached["rows"][:attached["row_offsets"][1]]).decode().split("\t")[1], "28881")
+
+    def test_publish_coverage(self):
+        store = CoverageData.CoverageStore()
+        store.add_depths("s1", "MN908947.3", range(1, 101), range(100))
+        store.add_depths("s2", "MN908947.3", range(1, 51), [7] * 50)
+        with tempfile.TemporaryDirectory() as tmp:
+            block_path = SharedData.publish_coverage(store, os.path.join(tmp, "coverage.block"))
+            attached = SharedData.attach_coverage(block_path)
+            self.assertIsInstance(attached.samples["s1"], memoryview)
+            self.assertEqual(attached.depths("s1", [1, 50, 100]), array("I", [0, 49, 99]))
+            self.assertEqual(attached.depth("s2", 80), 0) # past the end of the samples depths
+            self.assertEqual(attached.sample_qc("s2"), store.sample_qc("s2"))
+            del attached
+            with open(block_path, "r+b") as block: # not a block
+                block.write(b"X")
+            with self.assertRaises(ValueError):
+                SharedData.attach_coverage(block_path)
+
+    def test_publish_variants(self):
+        samples = []
+        for name, rows in (("s1", (("28882", "A"), ("28881", "A"))), ("s2", ()), ("s3", (("241", "T"), ("241", "G")))):
+            sample = type("Sample", (), {})()
+            sample.sample_name, sample.filename = name, f"{name}.tsv"
+            sample.vcf_info = {}
+            for pos, alt in rows:
+                sample.vcf_info.setdefault(pos, []).append(
+                    IvarFields("MN908947.3", pos, "G", alt, *["0"] * 3, "80", *["0"] * 2, "0.8", *["NA"] * 8))
+            samples.append(sample)
+        with tempfile.TemporaryDirectory() as tmp:
+            attached = SharedData.attach_variants(SharedData.publish_variants(samples, os.path.join(tmp, "variants.block")))
+            self.assertEqual([i.sample_name for i in attached], ["s1", "s2", "s3"])
+            for sample, view in zip(samples, attached):
+                self.assertEqual(dict(view.vcf_info), sample.vcf_info)
+            self.assertEqual(attached[0].variant_array.find_run(28881, "AA"), [0, 1])
+            self.assertEqual(attached[2].variant_array.find(241, "G"), 1)
+            self.assertEqual(len(attached[1].variant_array.positions), 0)
 
 class TestInputOptions(unittest.TestCase):
     """
@@ -96,6 +556,141 @@ class TestInputOptions(unittest.TestCase):
         outdir = "/tmp"
         InputOptions.process_submission_sheet(test_sub_sheet, test_metadata_sheet, cov_thresh, outdir)
 
+    def test_read_sample_sheet(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            rows = []
+            for name in ("S2", "S10", "S1"):
+                for suffix in (".tsv", ".bam", ".bam.bai"):
+                    open(os.path.join(tmp, name + suffix), "w").close()
+                rows.append([name, os.path.join(tmp, name + ".tsv"), os.path.join(tmp, name + ".bam")])
+            rows.append(["S1", os.path.join(tmp, "S1.tsv"), tmp, "2022-05-01"]) # bam found in a directory
+            sheet_path = os.path.join(tmp, "sheet.tsv")
+            for sheet_rows in (rows, rows + [["S3", rows[0][1], tmp]], rows + [["S4", rows[0][1], os.path.join(tmp, "S4.bam")]]):
+                with open(sheet_path, "w") as sheet:
+                    sheet.write("\n".join("\t".join(i) for i in sheet_rows) + "\n")
+                if sheet_rows is rows:
+                    self.assertEqual(InputOptions.read_sample_sheet(sheet_path), rows) # sheet order
+                    continue
+                with self.assertRaises(SystemExit): # no S3 bam in the directory, no S4 bam file
+                    InputOptions.read_sample_sheet(sheet_path)
+            with unittest.mock.patch.object(InputOptions, "read_sheet_row") as read_row:
+                with self.assertRaises(SystemExit): # the missing bam of the last row is found before any row is read
+                    InputOptions.process_submission_sheet(sheet_path, "sheet.txt", 30, tmp)
+                read_row.assert_not_called()
+
+    def test_append_samples_vcf(self):
+        vcf_lines = ["##fileformat=VCFv4.2", "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2",
+            "MN908947.3\t241\t.\tC\tT\t200\tPASS\tDP=100\tGT:AD:DP\t1:10,90:100\t0:100,0:100"]
+        with tempfile.TemporaryDirectory() as tmp:
+            write_test_files(tmp, {"merged.vcf": vcf_lines})
+            open(os.path.join(tmp, RESULTS_FILE), "w").close()
+            prior = unittest.mock.Mock(samples=["S1"], metadata_sheet="sheet.txt")
+            with unittest.mock.patch.object(InputOptions.MatchedResults, "load", return_value=prior), \
+                    unittest.mock.patch.object(InputOptions, "VCFDataHTML") as vcf_html:
+                InputOptions.append_samples(tmp, tmp, tmp, None, 30)
+                self.assertEqual([i.sample_name for i in vcf_html.call_args[0][0]], ["S2"])
+                vcf_html.reset_mock()
+                prior.samples = ["S1", "S2"]
+                InputOptions.append_samples(tmp, tmp, tmp, None, 30)
+                vcf_html.assert_not_called() # every vcf sample is already saved
+
+    def test_panel_outputs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertEqual(InputOptions.panel_outputs("voc.txt", tmp), {"voc.txt": tmp})
+            panels = InputOptions.panel_outputs(["voc.txt", "legacy/markers.tsv", "other/voc.txt"], tmp)
+            self.assertEqual(list(panels.values()), [os.path.join(tmp, i) for i in ("voc", "markers", "voc_2")])
+            self.assertTrue(all(os.path.isdir(i) for i in panels.values()))
+
+class TestIvarCache(unittest.TestCase):
+    """
+    Read ivar files through the memory mapped cache
+    """
+    def test_ivar_cache(self):
+        header = "\t".join(IvarFields._fields)
+        rows = ["\t".join(["MN908947.3", pos, "G", alt, *["0"] * 3, "80", *["0"] * 2, "0.8", *["NA"] * 8])
+                for pos, alt in (("28882", "A"), ("28881", "A"), ("28881", "T"))]
+        with tempfile.TemporaryDirectory() as tmp:
+            ivar_path, = write_test_files(tmp, {"s1.tsv": [header, *rows]})
+            cache = IvarCache.IvarCache(os.path.join(tmp, "cache"))
+            parsed = cache.read(ivar_path)
+            cached = cache.read(ivar_path)
+            self.assertEqual((cache.misses, cache.hits), (1, 1))
+            self.assertIsInstance(cached, IvarCache.CachedIvar)
+            self.assertEqual(cached.sample_name, "s1")
+            self.assertEqual(dict(cached.vcf_info), parsed.vcf_info)
+            self.assertIsNone(cached.vcf_info.get("241"))
+            self.assertEqual(cached.variant_array.find_run(28881, "AA"), [0, 2])
+            del cached
+            with open(ivar_path, "a") as tsv: # a changed file is parsed again
+                tsv.write(rows[0] + "\n")
+            self.assertIsInstance(cache.read(ivar_path), ReadIvar)
+            small_cache = IvarCache.IvarCache(os.path.join(tmp, "cache"), max_size=0)
+            small_cache.read(ivar_path)
+            self.assertEqual(small_cache.entries(), []) # evicted past the size cap
+
+class TestWatchRuns(unittest.TestCase):
+    """
+    Find the runs of a watched directory that are ready to process
+    """
+    def test_watch_ready_runs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for sub_dir in ("variants", "bam"):
+                os.makedirs(os.path.join(tmp, "run1", sub_dir))
+            os.makedirs(os.path.join(tmp, "not_a_run"))
+            watcher = WatchRuns.RunWatcher(tmp, "sheet.txt", 30, settle=10)
+            self.assertEqual(watcher.ready_runs(0), []) # first seen
+            self.assertEqual(watcher.ready_runs(5), []) # not settled
+            self.assertEqual([i[0] for i in watcher.ready_runs(10)], ["run1"])
+            with open(os.path.join(tmp, "run1", "variants", "s1.tsv"), "w") as tsv:
+                tsv.write("REGION")
+            self.assertEqual(watcher.ready_runs(20), []) # changed, settles again
+            watcher.processed["run1"] = WatchRuns.folder_key(*WatchRuns.run_folders(tmp)["run1"])
+            self.assertEqual(watcher.ready_runs(40), [])
+            watcher.pool.shutdown()
+            watcher = WatchRuns.RunWatcher(tmp, "sheet.txt", 30, ivar_cache=os.path.join(tmp, "cache"))
+            with unittest.mock.patch.object(WatchRuns, "glob_directories") as glob_run:
+                for name in ("run1", "run2"):
+                    watcher.process_run(name, *WatchRuns.run_folders(tmp)["run1"], None)
+            readers = [i.kwargs["read_ivar"] for i in glob_run.call_args_list]
+            self.assertIs(readers[0].__self__, readers[1].__self__) # one ivar cache for every run
+            watcher.pool.shutdown()
+
+class TestShardRuns(unittest.TestCase):
+    """
+    Plan, run and merge the shards of a run
+    """
+    def test_shard_runs(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sheet_path, = write_test_files(tmp, {"sheet.txt": SHEET_LINES[:2]})
+            ivar_dir, bam_dir, plan_dir, out_dir = [os.path.join(tmp, i) for i in ("variants", "bam", "plan", "out")]
+            os.makedirs(ivar_dir)
+            os.makedirs(bam_dir)
+            write_test_files(ivar_dir, {f"{name}.tsv": IVAR_LINES for name in ("S0", "S1", "S2", "S3", "S4")})
+            for name in ("S0", "S1", "S2", "S3", "S4"):
+                for suffix in (".bam", ".bam.bai"):
+                    open(os.path.join(bam_dir, name + suffix), "w").close()
+            manifests = ShardRuns.plan_shards(plan_dir, sheet_path, 2, ivar_dir, bam_dir)
+            planned = []
+            for manifest_path in manifests: # depths cached for each shard so samtools is not needed
+                names = [ReadIvar.get_sample_name(i) for i in ShardRuns.read_manifest(manifest_path)["inputs"]]
+                store = CoverageData.CoverageStore()
+                for name in names:
+                    store.add_depths(name, "MN908947.3", range(1, 30001), [100] * 30000)
+                CoverageData.write_store(os.path.join(bam_dir, CoverageData.samples_cache_name(names)), store)
+                planned.extend(names)
+            with self.assertRaises(SystemExit): # shards have not been run
+                ShardRuns.merge_shards(plan_dir, out_dir, 30, excel=False)
+            for manifest_path in reversed(manifests):
+                ShardRuns.run_shard(manifest_path, threads=2)
+            ShardRuns.merge_shards(plan_dir, out_dir, 30, excel=False)
+            results = MatchedResults.load(os.path.join(out_dir, RESULTS_FILE))
+            ShardRuns.plan_shards(plan_dir, sheet_path, 2, ivar_dir, bam_dir, mnp_cv_threshold=5.0)
+            with self.assertRaises(SystemExit): # finished for the previous plan
+                ShardRuns.merge_shards(plan_dir, out_dir, 30, excel=False)
+        self.assertEqual(len(manifests), 2)
+        self.assertEqual(results.samples, planned)
+        self.assertEqual(results.lineage_table("BA.2", 30)[-len(STAT_ROWS) - 1][1:], ["0.9"] * 5)
+
 class TestCommandLineArgs(unittest.TestCase):
     """
     Tests for the various command line args, they should return type errors
@@ -121,6 +716,29 @@ class TestCommandLineArgs(unittest.TestCase):
         with self.assertRaises(TypeError):
             t3()
 
+    def test_Argparser_resolve_handler(self):
+        t4 = CommandLineArgs.Argparser(["VCFViz"])
+        for run_mode in t4.functions_call:
+            self.assertTrue(callable(t4.resolve_handler(run_mode)))
+
+
+class TestStartupTime(unittest.TestCase):
+    """
+    Benchmark the command line start up, no run mode should pay for importing pandas or pyarrow.
+    The time is only logged as it depends on the machine running the tests.
+    """
+    def test_startup_time(self):
+        bench = "import sys, time\n" \
+            "start = time.perf_counter()\n" \
+            "import VCFViz.CommandLineArgs as cmd\n" \
+            "cmd.Argparser(['VCFViz']).resolve_handler('directory-glob')\n" \
+            "print(time.perf_counter() - start)\n" \
+            "print(any(i in sys.modules for i in ('pandas', 'openpyxl', 'pyarrow')))"
+        out = subprocess.run([sys.executable, "-c", bench], capture_output=True, text=True, check=True)
+        elapsed, heavy_imports = out.stdout.split()
+        vlog.logger.critical(f"Start up time {round(float(elapsed), 3)} seconds")
+        self.assertEqual(heavy_imports, "False")
+
 
 
 if __name__ == '__main__':